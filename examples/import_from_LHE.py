@@ -1,5 +1,9 @@
 import sys
 import pyhep.convert
 
+
+def report(stats):
+    print "%d events, %.0f events/s" % (stats.events, stats.events_per_second)
+
 outfile = sys.argv[1].split('.')[0]+".pyhep"
-pyhep.convert.convert_from_LHE(sys.argv[1], outfile)
+pyhep.convert.convert_from_LHE(sys.argv[1], outfile, on_progress=report)
@@ -3,7 +3,7 @@ import sys
 import matplotlib.pylab as plt
 import itertools
 
-mee = []
+mee = pyhep.Hist1D(50, 0, 200)
 
 def good_electron(ele):
     return (ele.p4.pt > 20)
@@ -20,10 +20,10 @@ for e in itertools.ifilter(pass_met, evt_col.events()):
     electrons.sort(key=lambda p: p.p4.pt, reverse=True)
 
     ee = electrons[0].p4+electrons[1].p4
-    mee.append(ee.mass)
+    mee.fill(ee.mass)
 evt_col.close()
 
-plt.hist(mee)
+mee.plot()
 plt.show()
 raw_input("...")
 
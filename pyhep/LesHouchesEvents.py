@@ -2,48 +2,125 @@
 
 # http://lcgapp.cern.ch/project/docs/lhef5.pdf
 
+import bz2
 import math
-import xml.etree.cElementTree as ET
+import os
+import multiprocessing
+import threading
+import zlib
+from array import array
+from collections import deque, namedtuple
+from io import BytesIO
+from itertools import chain, islice
+from Queue import Queue, Full
+
+import numpy as np
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 def split_line(l):
-    l = l.replace('\n','').replace('\t',' ')
-    while '  ' in l:
-        l = l.replace('  ', ' ')
-    return [x for x in l.split(' ') if x]
+    return l.split()
+
+HEADER_DTYPE = np.dtype([
+    ('nup', np.int32),
+    ('idprup', np.int32),
+    ('xwgtup', np.float64),
+    ('scalup', np.float64),
+    ('aqedup', np.float64),
+    ('aqcdup', np.float64),
+    ])
+
+PARTICLE_DTYPE = np.dtype([
+    ('idup', np.int32),
+    ('istup', np.int32),
+    ('mothup1', np.int32),
+    ('mothup2', np.int32),
+    ('icolup1', np.int32),
+    ('icolup2', np.int32),
+    ('pup1', np.float64),
+    ('pup2', np.float64),
+    ('pup3', np.float64),
+    ('pup4', np.float64),
+    ('pup5', np.float64),
+    ('vtimup', np.float64),
+    ('spinup', np.float64),
+    ])
+
+
+class LHEventBatch(namedtuple('LHEventBatch', ['headers', 'particles', 'offsets', 'comments'])):
+    """
+    A chunk of events in columnar form.
+
+    headers - structured array with one HEADER_DTYPE entry per event
+    particles - structured array with one PARTICLE_DTYPE entry per particle,
+                for all of the events in the chunk
+    offsets - array of length len(headers)+1. The particles of event i are
+              particles[offsets[i]:offsets[i+1]]
+    comments - list with the comment line of each event, or None
+    """
+    __slots__ = ()
 
-class LHParticle:
+
+class LHParticle(object):
+    """
+    One particle line of an event (one entry of the HEPEUP common block).
+    The line is converted to numbers once, when the particle is created,
+    and the 13 fields are kept in a single array of doubles, so a particle
+    takes about 200 bytes. Integer fields are returned as ints (doubles
+    hold them exactly).
+    """
+    __slots__ = ('_values',)
     invalid = 1e99
 
     def __init__(self, raw_line):
-        self.raw = split_line(raw_line)
-        assert(len(self.raw) == 13)
+        raw = split_line(raw_line)
+        assert(len(raw) == 13)
+        self._values = array('d', map(float, raw))
+
+    def fields(self):
+        """Return all 13 fields of the particle as a tuple"""
+        return (self.idup(), self.istup(), self.mothup1(), self.mothup2(), self.icolup1(),
+                self.icolup2(), self.pup1(), self.pup2(), self.pup3(), self.pup4(), self.pup5(),
+                self.vtimup(), self.spinup())
+
+    def __getstate__(self):
+        return self.fields()
+
+    def __setstate__(self, state):
+        self._values = array('d', state)
 
     def idup(self):
-        return int(self.raw[0])
+        return int(self._values[0])
     def istup(self):
-        return int(self.raw[1])
+        return int(self._values[1])
     def mothup1(self):
-        return int(self.raw[2])
+        return int(self._values[2])
     def mothup2(self):
-        return int(self.raw[3])
+        return int(self._values[3])
     def icolup1(self):
-        return int(self.raw[4])
+        return int(self._values[4])
     def icolup2(self):
-        return int(self.raw[5])
+        return int(self._values[5])
     def pup1(self):
-        return float(self.raw[6])
+        return self._values[6]
     def pup2(self):
-        return float(self.raw[7])
+        return self._values[7]
     def pup3(self):
-        return float(self.raw[8])
+        return self._values[8]
     def pup4(self):
-        return float(self.raw[9])
+        return self._values[9]
     def pup5(self):
-        return float(self.raw[10])
+        return self._values[10]
     def vtimup(self):
-        return float(self.raw[11])
+        return self._values[11]
     def spinup(self):
-        return float(self.raw[12])
+        return self._values[12]
     def id(self):
         return self.idup()
     def mothers(self):
@@ -59,7 +136,7 @@ class LHParticle:
     def mass(self):
         return self.pup5()
     def pt(self):
-        return (self.px()**2 + self.py()**2)**0.5
+        return (self.pup1()**2 + self.pup2()**2)**0.5
 
 #        self.theta = math.atan2(self.py, self.px)
 #        den = self.e - self.pz
@@ -79,62 +156,755 @@ class LHParticle:
 #        else:
 #            self.eta = -math.log(ttho2)
 
-class LHEvent:
+class LHEvent(object):
+    """
+    An event: the header line (the HEPEUP event-level fields), the particles
+    and the optional comment line. Like for LHParticle, the header fields are
+    converted to numbers once and kept in an array of doubles.
+    """
+    __slots__ = ('particles', 'comment', '_values')
+
     def __init__(self, raw_header, raw_lines):
         self.particles = []
+        self.comment = None
         self.parse_header(raw_header)
         self.parse_particle_lines(raw_lines)
 
     def parse_header(self, raw_header):
-        self.raw = split_line(raw_header)
-        assert(len(self.raw) == 6)
+        raw = split_line(raw_header)
+        assert(len(raw) == 6)
+        self._values = array('d', map(float, raw))
+
+    def fields(self):
+        """Return the 6 fields of the header line as a tuple"""
+        return (self.nup(), self.idprup(), self.xwgtup(), self.scalup(), self.aqedup(),
+                self.aqcdup())
+
+    def __getstate__(self):
+        return self.fields(), self.particles, self.comment
+
+    def __setstate__(self, state):
+        header, self.particles, self.comment = state
+        self._values = array('d', header)
 
     def nup(self):
-        return int(self.raw[0])
+        return int(self._values[0])
     def idprup(self):
-        return int(self.raw[1])
+        return int(self._values[1])
     def xwgtup(self):
-        return float(self.raw[2])
+        return self._values[2]
     def scalup(self):
-        return float(self.raw[3])
+        return self._values[3]
     def aqedup(self):
-        return float(self.raw[4])
+        return self._values[4]
     def aqcdup(self):
-        return float(self.raw[5])
+        return self._values[5]
 
     def parse_particle_lines(self, raw_lines):
         for line in raw_lines:
             if not '#' in line :
                 self.particles.append(LHParticle(line))
             else :
-                self.comment = line
+                self.comment = line.rstrip('\r\n')
         assert(self.nup() == len(self.particles))
 
 
 class LHEventReader:
+    """
+    Streaming reader for Les Houches Event files.
+
+    The file is scanned line by line for <init> and <event> blocks rather
+    than being run through an XML parser, so only the text of one event is
+    held in memory at a time. As with an XML parser, only the text up to the
+    first child element of an <event> (e.g. <rwgt>) is treated as event data.
+
+    The reader also supports random access. reader[k] returns event k and
+    reader[a:b] a list of events, using an index of the byte offset of every
+    event (see index()).
+
+    Files compressed with gzip, bzip2 or xz are detected automatically and
+    decompressed in a background thread while they are being parsed.
+    Random access and parallel parsing need an uncompressed file.
+
+    Once reading from the start of the file has reached the first event,
+    preamble holds everything before it (the opening tag, the header and
+    the <init> block) exactly as it is in the file, for LHEventWriter.
+    """
     def __init__(self, filename, max_events=None):
         self.init = None
+        self.preamble = None
         self.filename = filename
         self.max_events = max_events
         self.evnum = 0
+        self.start_offset = 0
+        self._index = None
+        self.compression = _compression(filename)
+
+    def __len__(self):
+        return len(self.index())
+
+    def __getitem__(self, k):
+        """Return event k as an LHEvent, or a list of LHEvents for a slice"""
+        offsets = self.index()
+        if isinstance(k, slice):
+            start, stop, step = k.indices(len(offsets))
+            if step != 1:
+                return [self[i] for i in xrange(start, stop, step)]
+            if start >= stop:
+                return []
+            stop_offset = int(offsets[stop]) if stop < len(offsets) else None
+            with open(self.filename, 'rb') as f:
+                return [_parse_event_block(block) for offset, block in
+                        self._event_blocks(f, int(offsets[start]), stop_offset)]
+        if k < 0:
+            k += len(offsets)
+        if not 0 <= k < len(offsets):
+            raise IndexError("event index out of range")
+        with open(self.filename, 'rb') as f:
+            for offset, block in self._event_blocks(f, int(offsets[k])):
+                return _parse_event_block(block)
+
+    def seek(self, k):
+        """
+        Make the next call to events(), batches() or the parallel versions
+        start at event k.
+        """
+        offsets = self.index()
+        if k < 0:
+            k += len(offsets)
+        if not 0 <= k <= len(offsets):
+            raise IndexError("event index out of range")
+        if self.init is None:
+            with open(self.filename, 'rb') as f:
+                self._first_event_offset(f)
+        if k == len(offsets):
+            self.start_offset = os.path.getsize(self.filename)
+        else:
+            self.start_offset = int(offsets[k])
+
+    def index(self):
+        """
+        Return an array with the byte offset of every event in the file.
+
+        The index is built by scanning the file once, and is saved next to
+        the file in filename.idx.npz along with the file's size and
+        modification time. A saved index is only used if these still match.
+        """
+        if self.compression is not None:
+            raise ValueError("Random access is not supported for %s compressed files" % self.compression)
+        if self._index is None:
+            self._index = self._load_index()
+        if self._index is None:
+            self._index = self._build_index()
+        return self._index
+
+    def _index_filename(self):
+        return self.filename + '.idx.npz'
+
+    def _load_index(self):
+        """Return the saved index, or None if it is missing or out of date"""
+        index_filename = self._index_filename()
+        if not os.path.exists(index_filename):
+            return None
+        stat = os.stat(self.filename)
+        try:
+            saved = np.load(index_filename)
+            if int(saved['size']) != stat.st_size or float(saved['mtime']) != stat.st_mtime:
+                return None
+            return saved['offsets']
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def _build_index(self):
+        """Scan the file for event offsets, and try to save them"""
+        stat = os.stat(self.filename)
+        with open(self.filename, 'rb') as f:
+            offsets = np.fromiter((offset for offset, block in self._event_blocks(f)), np.int64)
+        # write to a temporary file first so other readers never see a partial index
+        index_filename = self._index_filename()
+        tmp_filename = '%s.%d.tmp' % (index_filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wb') as f:
+                np.savez(f, offsets=offsets, size=stat.st_size, mtime=stat.st_mtime)
+            os.rename(tmp_filename, index_filename)
+        except (IOError, OSError):
+            # the index is still usable, just not saved for next time
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+        return offsets
+
     def events(self) :
-        for event, elem in ET.iterparse(self.filename):
-            if elem.tag == 'init':
-                self.init = elem.text
-            elif elem.tag == 'event':
-                e = [x for x in elem.text.split('\n') if x]
-                header = e[0]
-                particle_lines = e[1:]
-                lhe = LHEvent(header, particle_lines)
-                yield lhe
+        """Iterate through the events in the file, yielding an LHEvent for each"""
+        with self._open() as f:
+            for offset, block in self._event_blocks(f, self.start_offset):
+                yield _parse_event_block(block)
+                self.evnum += 1
+                if self.evnum == self.max_events:
+                    return
+
+    def batches(self, n):
+        """
+        Iterate through the events in the file in chunks of (at most) n
+        events, yielding an LHEventBatch of numpy arrays for each chunk.
+        No LHEvent or LHParticle objects are created, so this is much faster
+        than events() when the cuts can be written in terms of arrays.
+        """
+        for blocks in self._block_chunks(n):
+            yield _parse_event_blocks(blocks)
+
+    def raw_events(self):
+        """
+        Like events(), but yield (raw, event) pairs, where raw is the text of
+        the whole <event> block exactly as it is in the file
+        """
+        with self._open() as f:
+            for offset, block in self._event_blocks(f, self.start_offset):
+                yield ''.join(block), _parse_event_block(block)
+                self.evnum += 1
+                if self.evnum == self.max_events:
+                    return
+
+    def raw_batches(self, n):
+        """
+        Like batches(n), but yield (raw, batch) pairs, where raw is a list
+        with the text of each <event> block of the batch exactly as it is in
+        the file
+        """
+        for blocks in self._block_chunks(n):
+            yield [''.join(block) for block in blocks], _parse_event_blocks(blocks)
+
+    def _block_chunks(self, n):
+        """Iterate through the raw event blocks in lists of (at most) n"""
+        with self._open() as f:
+            chunk = []
+            for offset, block in self._event_blocks(f, self.start_offset):
+                chunk.append(block)
+                self.evnum += 1
+                if self.evnum == self.max_events:
+                    break
+                if len(chunk) == n:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+    def parallel_events(self, processes=None, ordered=True, chunk_bytes=8*1024*1024):
+        """
+        Iterate through the events in the file, parsing them in a pool of
+        worker processes. The file is split into byte ranges of about
+        chunk_bytes, aligned on <event> boundaries, and each range is parsed
+        by one worker.
+
+        Arguments:
+        processes - number of worker processes. Defaults to the number of CPUs.
+        ordered - if True, events are yielded in the order they appear in the
+        file. Otherwise they are yielded as soon as their range is parsed.
+        chunk_bytes - approximate size of the byte range handled by a worker
+        """
+        for events in self._parallel_map(None, processes, ordered, chunk_bytes):
+            for event in events:
+                yield event
                 self.evnum += 1
                 if self.evnum == self.max_events:
-                    raise StopIteration
+                    return
+
+    def parallel_batches(self, n, processes=None, ordered=True, chunk_bytes=8*1024*1024):
+        """
+        Like batches(n), but parse the file in a pool of worker processes.
+        See parallel_events() for the arguments. Batches never span two byte
+        ranges, so some may hold fewer than n events.
+        """
+        for batches in self._parallel_map(n, processes, ordered, chunk_bytes):
+            for batch in batches:
+                if self.max_events is not None and self.evnum+len(batch.headers) >= self.max_events:
+                    yield _slice_batch(batch, self.max_events-self.evnum)
+                    self.evnum = self.max_events
+                    return
+                yield batch
+                self.evnum += len(batch.headers)
+
+    def _parallel_map(self, batch_size, processes, ordered, chunk_bytes):
+        """Parse the byte ranges of the file in a process pool"""
+        if self.compression is not None:
+            raise ValueError("Parallel parsing is not supported for %s compressed files" % self.compression)
+        with open(self.filename, 'rb') as f:
+            start = self._first_event_offset(f)
+        if start is None:
+            return
+        start = max(start, self.start_offset)
+        size = os.path.getsize(self.filename)
+        ranges = ((self.filename, a, min(a+chunk_bytes, size), batch_size)
+                  for a in xrange(start, size, chunk_bytes))
+        processes = processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        # unordered results are handed over by the pool's callbacks as they finish
+        finished = Queue()
+
+        def submit(r):
+            if ordered:
+                return pool.apply_async(_parse_byte_range, (r,))
+            return pool.apply_async(_parse_byte_range_or_error, (r,), callback=finished.put)
+
+        try:
+            # keep a bounded number of ranges in flight, so that results
+            # don't pile up in memory if the caller is slower than the workers
+            pending = deque(submit(r) for r in islice(ranges, 2*processes))
+            while pending:
+                if ordered:
+                    result = pending.popleft().get()
+                else:
+                    pending.popleft()
+                    result, error = finished.get()
+                    if error is not None:
+                        raise error
+                for r in islice(ranges, 1):
+                    pending.append(submit(r))
+                yield result
+        finally:
+            # at most 2*processes ranges are still being parsed, so let them
+            # finish rather than terminating the workers
+            pool.close()
+            pool.join()
+
+    def _open(self):
+        """Open the file for reading, decompressing it on the fly if needed"""
+        f = open(self.filename, 'rb')
+        if self.compression is None:
+            return f
+        return _DecompressingReader(f, self.compression)
+
+    def _first_event_offset(self, f):
+        """
+        Scan the start of an open LHE file, reading the <init> block, and
+        return the byte offset of the first event (None if there are none).
+        """
+        for offset, block in self._event_blocks(f):
+            return offset
+        return None
+
+    def _event_blocks(self, f, offset=0, stop=None):
+        """
+        Scan an open LHE file and yield (offset, lines) for each <event>
+        block, where offset is the byte offset of the line holding the
+        <event> tag and lines are the raw lines of the block, tags included.
+
+        Arguments:
+        f - LHE file opened in binary mode
+        offset - byte offset to start scanning from
+        stop - if given, stop at the first event starting at or after this
+        byte offset
+
+        Reaching the end of the file inside an event, or without finding the
+        closing </LesHouchesEvents> tag, raises a ValueError, as the file
+        must have been cut short.
+        """
+        if offset:
+            f.seek(offset)
+        block = None
+        init = None
+        closed = False
+        # lines before the first event, when starting from the beginning
+        preamble = [] if offset == 0 else None
+        for line in f:
+            start = offset
+            offset += len(line)
+            if block is not None:
+                block.append(line)
+                if '</event' in line:
+                    yield block_start, block
+                    block = None
+                continue
+            if preamble is not None:
+                preamble.append(line)
+            if '<' in line:
+                tag = line.lstrip()
+                if tag.startswith('<event') and tag[6:7] in ('>', ' ', '\t', '\n', '\r'):
+                    if preamble is not None:
+                        self.preamble = ''.join(preamble[:-1])
+                        preamble = None
+                    if stop is not None and start >= stop:
+                        return
+                    block_start = start
+                    block = [line]
+                    init = None
+                elif tag.startswith('</LesHouchesEvents'):
+                    closed = True
+                    if preamble is not None:
+                        # a file without events
+                        self.preamble = ''.join(preamble[:-1])
+                        preamble = None
+                elif tag.startswith('<init'):
+                    init = []
+                elif init is not None:
+                    self.init = ''.join(init)
+                    init = None
+            elif init is not None:
+                init.append(line)
+        if block is not None:
+            raise ValueError("%s is truncated: it ends inside an event" % self.filename)
+        if not closed:
+            raise ValueError("%s is truncated: the closing </LesHouchesEvents> tag is missing" %
+                             self.filename)
+
+
+class LHEventWriter(object):
+    """
+    Buffered writer for Les Houches Event files.
+
+    The preamble (the opening tag, header and <init> block) is written
+    unchanged, usually the one of the file being read (see
+    LHEventReader.preamble). Events are either passed through as the raw
+    text read from another file, which keeps them byte for byte and is
+    much faster than formatting the numbers again, or written from LHEvent
+    objects. The closing tag is written by close().
+
+    Example:
+    >>> reader = LHEventReader("in.lhe")                          # doctest: +SKIP
+    >>> events = reader.raw_events()                              # doctest: +SKIP
+    >>> raw, event = next(events)                                 # doctest: +SKIP
+    >>> with LHEventWriter("out.lhe", reader.preamble) as writer: # doctest: +SKIP
+    ...     writer.write_raw(raw)
+    ...     writer.write_event(event)
+    """
+    def __init__(self, filename, preamble=None, buffer_size=1024*1024):
+        """
+        Arguments:
+        filename - file to write
+        preamble - text to write before the events. If None, just the
+        opening <LesHouchesEvents> tag.
+        buffer_size - number of bytes kept in memory between writes
+        """
+        if preamble is None:
+            preamble = '<LesHouchesEvents version="1.0">\n'
+        self.filename = filename
+        self.n_events = 0
+        self._f = open(filename, 'wb', buffer_size)
+        self._f.write(preamble)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def write_raw(self, raw):
+        """Write the text of an <event> block (tags included) unchanged"""
+        self._f.write(raw)
+        if not raw.endswith('\n'):
+            self._f.write('\n')
+        self.n_events += 1
+
+    def write_event(self, event):
+        """Write an LHEvent, formatting its fields"""
+        lines = ['<event>\n', ' %d %d %.10E %.10E %.10E %.10E\n' % event.fields()]
+        for p in event.particles:
+            lines.append(' %8d %4d %4d %4d %4d %4d %+.10E %+.10E %+.10E %.10E %.10E %.4E %.4E\n' %
+                         p.fields())
+        if event.comment is not None:
+            lines.append(event.comment + '\n')
+        lines.append('</event>\n')
+        self._f.write(''.join(lines))
+        self.n_events += 1
+
+    def close(self):
+        """Write the closing tag and close the file"""
+        if not self._f.closed:
+            self._f.write('</LesHouchesEvents>\n')
+            self._f.close()
+
+
+def skim(infilename, outfilename, predicate, batch_size=None):
+    """
+    Copy the events of an LHE file for which predicate is True to a new
+    file, keeping the preamble and the text of the events unchanged.
+    Returns the number of events read and written.
+
+    Arguments:
+    infilename - file to read, possibly compressed
+    outfilename - file to write
+    predicate - function of an LHEvent returning whether to keep it, or if
+    batch_size is given, function of an LHEventBatch returning a boolean
+    array with an entry per event. The second is much faster.
+    batch_size - number of events per batch
+
+    Example:
+    >>> def two_leptons(batch):
+    ...     leptons = np.in1d(np.abs(batch.particles['idup']), [11, 13])
+    ...     counts = np.add.reduceat(leptons, batch.offsets[:-1])
+    ...     return counts == 2
+    >>> skim("in.lhe", "out.lhe", two_leptons, batch_size=10000)  # doctest: +SKIP
+    """
+    reader = LHEventReader(infilename)
+    writer = None
+    n_read = 0
+    try:
+        if batch_size is None:
+            chunks = (([raw], [predicate(event)]) for raw, event in reader.raw_events())
+        else:
+            chunks = ((raw, predicate(batch)) for raw, batch in reader.raw_batches(batch_size))
+        for raw, keep in chunks:
+            if writer is None:
+                # the preamble is known once the first event has been found
+                writer = LHEventWriter(outfilename, reader.preamble)
+            for text, keep_event in zip(raw, keep):
+                if keep_event:
+                    writer.write_raw(text)
+            n_read += len(raw)
+        if writer is None:
+            writer = LHEventWriter(outfilename, reader.preamble)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_read, writer.n_events
+
+
+_MAGIC_NUMBERS = [
+    ('\x1f\x8b', 'gzip'),
+    ('BZh', 'bzip2'),
+    ('\xfd7zXZ\x00', 'xz'),
+    ]
+
+
+def _compression(filename):
+    """Return the compression format of a file from its magic number, or None"""
+    with open(filename, 'rb') as f:
+        start = f.read(6)
+    for magic, compression in _MAGIC_NUMBERS:
+        if start.startswith(magic):
+            return compression
+    return None
+
+
+def _decompressor(compression):
+    """Return a new decompressor object for a single compressed stream"""
+    if compression == 'gzip':
+        return zlib.decompressobj(16+zlib.MAX_WBITS)
+    elif compression == 'bzip2':
+        return bz2.BZ2Decompressor()
+    elif compression == 'xz':
+        if lzma is None:
+            raise ImportError("Reading xz compressed files needs the lzma module (backports.lzma on Python 2)")
+        return lzma.LZMADecompressor()
+    raise ValueError("Unknown compression format %s" % compression)
+
+
+def _stream_finished(decompressor):
+    """Whether a decompressor has reached the end of its stream"""
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    # zlib and bz2 on Python 2 don't say, but once the stream has ended,
+    # zlib keeps any further data as unused_data and bz2 refuses it
+    try:
+        decompressor.decompress('\x00')
+    except EOFError:
+        return True
+    except (IOError, zlib.error):
+        return False
+    return bool(decompressor.unused_data)
+
+
+class _DecompressingReader(object):
+    """
+    Read-only, iterate-by-line view of a compressed file. Decompression runs
+    in a background thread that hands chunks over through a bounded queue,
+    so that it overlaps with parsing (zlib, bz2 and lzma release the GIL).
+    Files made of several concatenated compressed streams, as written by
+    pigz, pbzip2 or cat, are read in full.
+    """
+    def __init__(self, f, compression, chunk_size=1024*1024, max_chunks=8):
+        self._f = f
+        self._compression = compression
+        self._chunk_size = chunk_size
+        self._queue = Queue(max_chunks)
+        self._closed = False
+        _decompressor(compression)  # fail early if the format is unsupported
+        self._thread = threading.Thread(target=self._decompress)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _put(self, item):
+        """Put an item on the queue, giving up if the reader is closed"""
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def _decompress(self):
+        try:
+            decompressor = _decompressor(self._compression)
+            while not self._closed:
+                data = self._f.read(self._chunk_size)
+                if not data:
+                    break
+                while data:
+                    try:
+                        chunk = decompressor.decompress(data)
+                    except EOFError:
+                        # the last stream ended exactly at the end of the
+                        # previous read, so this is the start of the next one
+                        if not data.strip('\x00'):
+                            break
+                        decompressor = _decompressor(self._compression)
+                        continue
+                    if chunk:
+                        self._put(chunk)
+                    # anything after the end of a stream is the start of the next one
+                    data = decompressor.unused_data
+                    if data:
+                        if not data.strip('\x00'):
+                            break
+                        decompressor = _decompressor(self._compression)
+            if not self._closed and not _stream_finished(decompressor):
+                raise IOError("%s is truncated: the last compressed stream is incomplete" %
+                              self._f.name)
+            if self._compression == 'gzip':
+                chunk = decompressor.flush()
+                if chunk:
+                    self._put(chunk)
+            # an empty chunk marks the end of the file
+            self._put('')
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        return chain.from_iterable(self._chunks())
+
+    def _chunks(self):
+        """Yield line iterators over the decompressed data, split on line ends"""
+        pending = ''
+        while True:
+            chunk = self._queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                break
+            chunk = pending + chunk
+            end = chunk.rfind('\n')+1
+            pending = chunk[end:]
+            yield BytesIO(chunk[:end])
+        if pending:
+            yield [pending]
+
+    def close(self):
+        self._closed = True
+        self._thread.join()
+        self._f.close()
+
+
+def _parse_byte_range(args):
+    """
+    Parse the events starting in the byte range [start, stop) of an LHE file.
+    Returns a list of LHEvents, or a list of LHEventBatches of batch_size
+    events if batch_size is not None.
+    """
+    filename, start, stop, batch_size = args
+    reader = LHEventReader(filename)
+    with open(filename, 'rb') as f:
+        if start > 0:
+            # a line that starts before the range belongs to the previous
+            # range, so skip to the start of the next line (unless start
+            # already is one)
+            f.seek(start-1)
+            start += len(f.readline())-1
+            if start >= stop:
+                # the only line starting in the range was skipped
+                return []
+        blocks = [block for offset, block in reader._event_blocks(f, start, stop)]
+    if batch_size is None:
+        return [_parse_event_block(block) for block in blocks]
+    return [_parse_event_blocks(blocks[i:i+batch_size])
+            for i in xrange(0, len(blocks), batch_size)]
+
+
+def _parse_byte_range_or_error(args):
+    """
+    _parse_byte_range, returning (result, None), or (None, exception) if it
+    fails, since the pool only calls back for results
+    """
+    try:
+        return _parse_byte_range(args), None
+    except Exception as e:
+        return None, e
+
+
+def _event_data_lines(block):
+    """
+    Return the non-blank lines of an event block between the <event> tag
+    and the closing tag or first child element.
+    """
+    lines = []
+    for line in block[1:]:
+        if '<' in line:
+            break
+        if not line.isspace():
+            lines.append(line)
+    return lines
+
+
+def _parse_event_block(block):
+    """Build an LHEvent from the raw lines of an <event> block"""
+    lines = _event_data_lines(block)
+    return LHEvent(lines[0], lines[1:])
+
+def _parse_event_blocks(blocks):
+    """Build an LHEventBatch from the raw lines of several <event> blocks"""
+    header_lines = []
+    particle_lines = []
+    comments = []
+    for block in blocks:
+        lines = _event_data_lines(block)
+        header_lines.append(lines[0])
+        nup = int(lines[0].split(None, 1)[0])
+        particle_lines.extend(lines[1:nup+1])
+        comment = None
+        for line in lines[nup+1:]:
+            if '#' in line:
+                comment = line.rstrip('\r\n')
+        comments.append(comment)
+
+    header_values = np.fromstring(''.join(header_lines), sep=' ')
+    assert(header_values.size == 6*len(header_lines))
+    headers = _to_records(header_values.reshape(-1, 6), HEADER_DTYPE)
+
+    particle_values = np.fromstring(''.join(particle_lines), sep=' ')
+    assert(particle_values.size == 13*headers['nup'].sum())
+    particles = _to_records(particle_values.reshape(-1, 13), PARTICLE_DTYPE)
+
+    offsets = np.zeros(len(headers)+1, dtype=np.int64)
+    np.cumsum(headers['nup'], out=offsets[1:])
+    return LHEventBatch(headers, particles, offsets, comments)
+
+
+def _slice_batch(batch, n):
+    """Return an LHEventBatch holding only the first n events of batch"""
+    offsets = batch.offsets[:n+1]
+    return LHEventBatch(batch.headers[:n], batch.particles[:offsets[-1]], offsets,
+                        batch.comments[:n])
+
+
+def _to_records(values, dtype):
+    """Convert a 2D array of floats to a structured array, one field per column"""
+    records = np.empty(len(values), dtype=dtype)
+    for i, name in enumerate(dtype.names):
+        records[name] = values[:, i]
+    return records
+
 
 __all__ = [
     'LHParticle',
     'LHEvent',
-    'LHEventReader'
+    'LHEventReader',
+    'LHEventBatch',
+    'LHEventWriter',
+    'skim',
     ]
 
 if __name__ == '__main__':
@@ -6,8 +6,15 @@ Author: Nic Eggert (nse23@cornell.edu)
 """
 
 
-from fourmomementum import *
+from fourmomentum import *
 from event import *
+from batch import *
+from candidates import *
+from matching import *
+from jets import *
 from storage import *
+from columnar import *
+from analysis import *
 from convert import *
 from particles import *
+from histogram import *
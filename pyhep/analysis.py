@@ -0,0 +1,142 @@
+import copy
+import multiprocessing
+import operator
+from itertools import islice
+
+from storage import EventCollection
+
+__all__ = ['map_reduce']
+
+
+def map_reduce(filename, func, reducer=operator.add, initial=None, processes=None,
+               batch_size=None, chunks_per_process=4, cache_size=None):
+    """
+    Run func over every event in the EventCollection stored in filename
+    and combine the results with reducer.
+
+    The range of event numbers is split into chunks, which are handed to a
+    pool of worker processes. Each worker opens its own read-only
+    connection to the file, calls func on each event (or, if batch_size is
+    given, on lists of up to batch_size events) and combines the return
+    values with reducer. The partial results of the chunks are then
+    combined, in order, with the same reducer, so the result is the same
+    as reduce(reducer, map(func, events)) as long as reducer is
+    associative.
+
+    With the default reducer, results are accumulated in place (+=) into a
+    copy of the first one, so that joining lists takes linear rather than
+    quadratic time.
+
+    func and reducer are sent to the workers, so they must be picklable:
+    use functions defined at module level rather than lambdas or nested
+    functions.
+
+    Arguments:
+    filename - file holding the EventCollection
+    func - function of an event (or of a list of events) returning a value
+    that reducer can combine, e.g. a number, a list or a histogram
+    reducer - function combining two results, operator.add by default
+    initial - returned if the collection is empty, and otherwise combined
+    with the result as reduce(reducer, results, initial) would
+    processes - number of worker processes, the number of CPUs by default.
+    With processes=1 everything runs in the calling process, which is
+    handy for debugging.
+    batch_size - if given, call func on lists of this many events
+    chunks_per_process - number of chunks to split the events into per
+    process, so that the work stays balanced if some events are slower
+    cache_size - target size of each worker's connection cache
+
+    Example:
+    >>> def n_particles(event):
+    ...     return len(event.particles_)
+    >>> total = map_reduce("events.fs", n_particles)    # doctest: +SKIP
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    collection = EventCollection(filename, read_only=True)
+    try:
+        if not collection.store:
+            return initial
+        first, last = collection.store.minKey(), collection.store.maxKey()+1
+    finally:
+        collection.close()
+
+    n_chunks = max(1, min(processes*chunks_per_process, last-first))
+    bounds = [first + (last-first)*i//n_chunks for i in range(n_chunks+1)]
+    tasks = [(filename, func, reducer, batch_size, cache_size, start, stop)
+             for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    if processes == 1:
+        partials = map(_map_range, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            partials = pool.map(_map_range, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    accumulate = _in_place(reducer)
+    result = initial
+    have_result = initial is not None
+    if have_result and accumulate is not reducer:
+        result = _copy(initial)
+    for found, partial in partials:
+        if not found:
+            continue
+        result = accumulate(result, partial) if have_result else partial
+        have_result = True
+    return result
+
+
+def _map_range(args):
+    """
+    Worker for map_reduce. Returns (found, result), where found is False
+    if there were no events in the range.
+    """
+    filename, func, reducer, batch_size, cache_size, start, stop = args
+    collection = EventCollection(filename, read_only=True, cache_size=cache_size)
+    try:
+        events = collection.events(ghost=batch_size is None, gc_interval=1000,
+                                   start=start, stop=stop)
+        if batch_size is not None:
+            events = _batches(events, batch_size, collection)
+        accumulate = _in_place(reducer)
+        found = False
+        result = None
+        for item in events:
+            value = func(item)
+            if found:
+                result = accumulate(result, value)
+            elif accumulate is not reducer:
+                # func may hold on to the value, so don't add to it in place
+                result = _copy(value)
+            else:
+                result = value
+            found = True
+        return found, result
+    finally:
+        collection.close()
+
+
+def _in_place(reducer):
+    """The in-place version of reducer, if there is one"""
+    return operator.iadd if reducer is operator.add else reducer
+
+
+def _copy(value):
+    """Copy a value before adding to it in place, using its own copy() (e.g. for histograms) if it has one"""
+    if hasattr(value, 'copy'):
+        return value.copy()
+    return copy.copy(value)
+
+
+def _batches(events, n, collection):
+    """Group events into lists of n, releasing the cache after each list"""
+    while True:
+        batch = list(islice(events, n))
+        if not batch:
+            return
+        yield batch
+        del batch
+        collection.connection.cacheGC()
@@ -0,0 +1,252 @@
+import numpy as np
+
+from fourmomentum import FourMomentum, FourMomentumArray
+from event import Event, GenEvent
+from particles import Particle, GenParticle
+
+
+class EventBatch(object):
+    """
+    A batch of events stored as flat per-particle columns, for processing
+    thousands of events at once with numpy instead of looping over Particle
+    objects.
+
+    The particles of all events are concatenated into the arrays px, py,
+    pz, m, pdgID, charge and (for generator-level events) status. The
+    particles of event i are those between offsets[i] and offsets[i+1].
+    Selections return a new EventBatch with the same number of events, so
+    they can be chained, and per-event sums are computed with one segmented
+    reduction over the whole batch.
+
+    Example:
+    >>> from particles import Electron
+    >>> ele = Electron(FourMomentum.from_x_y_z_m(10,20,30,0.000511), 1)
+    >>> nu = Particle(FourMomentum.from_x_y_z_m(-10,-20,-30,0), 12, 0)
+    >>> batch = EventBatch.from_events([Event([ele, nu]), Event([nu])])
+    >>> batch.counts
+    array([2, 1])
+    >>> batch.electrons().counts
+    array([1, 0])
+    >>> batch.met().px
+    array([-10.,  -0.])
+    """
+    def __init__(self, px, py, pz, m, pdgID, charge, offsets, status=None, metadata=None):
+        """
+        Arguments:
+        px, py, pz, m, pdgID, charge - per-particle arrays
+        offsets - array of length n_events+1 with the index of the first
+        particle of each event, followed by the total number of particles
+        status - per-particle generator status, or None if the events
+        aren't generator-level events
+        metadata - list with the metadata dict of each event
+        """
+        self.px = np.asarray(px, dtype=np.float64)
+        self.py = np.asarray(py, dtype=np.float64)
+        self.pz = np.asarray(pz, dtype=np.float64)
+        self.m = np.asarray(m, dtype=np.float64)
+        self.pdgID = np.asarray(pdgID, dtype=np.int32)
+        self.charge = np.asarray(charge, dtype=np.int32)
+        self.status = None if status is None else np.asarray(status, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if metadata is None:
+            metadata = [{} for i in range(len(self.offsets)-1)]
+        self.metadata = metadata
+
+    @classmethod
+    def from_events(cls, events):
+        """
+        Make a batch from a sequence of Event or GenEvent objects. The
+        status column is only filled if all of the events are GenEvents.
+        """
+        events = list(events)
+        particles = [p for e in events for p in e.particles_]
+        counts = [len(e.particles_) for e in events]
+        offsets = np.zeros(len(events)+1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        status = None
+        if all(isinstance(e, GenEvent) for e in events):
+            status = [p.status for p in particles]
+        return cls([p.p4.px for p in particles],
+                   [p.p4.py for p in particles],
+                   [p.p4.pz for p in particles],
+                   [p.p4.mass for p in particles],
+                   [p.pdgID for p in particles],
+                   [p.charge for p in particles],
+                   offsets, status, [e.metadata for e in events])
+
+    def to_events(self):
+        """
+        Convert the batch back to a list of events, GenEvents made of
+        GenParticles if the batch has a status column and plain Events of
+        Particles otherwise. Subclasses such as Electron are not preserved.
+        """
+        columns = [self.px.tolist(), self.py.tolist(), self.pz.tolist(), self.m.tolist(),
+                   self.pdgID.tolist(), self.charge.tolist()]
+        if self.status is not None:
+            columns.append(self.status.tolist())
+            particles = [GenParticle(FourMomentum.from_x_y_z_m(x, y, z, m), pdgID, charge, status)
+                         for x, y, z, m, pdgID, charge, status in zip(*columns)]
+            event_class = GenEvent
+        else:
+            particles = [Particle(FourMomentum.from_x_y_z_m(x, y, z, m), pdgID, charge)
+                         for x, y, z, m, pdgID, charge in zip(*columns)]
+            event_class = Event
+        offsets = self.offsets.tolist()
+        return [event_class(particles[offsets[i]:offsets[i+1]], dict(self.metadata[i]))
+                for i in range(len(self))]
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    @property
+    def n_particles(self):
+        """Total number of particles in the batch"""
+        return len(self.px)
+
+    @property
+    def counts(self):
+        """Number of particles in each event"""
+        return np.diff(self.offsets)
+
+    @property
+    def event_index(self):
+        """Index of the event each particle belongs to"""
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    @property
+    def p4(self):
+        """Four-momenta of all of the particles as a FourMomentumArray"""
+        return FourMomentumArray(self.px, self.py, self.pz, self.m)
+
+    def _all_pairs(self):
+        """
+        Indices into the particle arrays of both members of every ordered
+        pair of particles in the same event (including each particle with
+        itself), in row-major order per event, and the offsets of each
+        event's pairs
+        """
+        counts = self.counts
+        pair_offsets = np.zeros(len(self)+1, dtype=np.int64)
+        np.cumsum(counts**2, out=pair_offsets[1:])
+        event = np.repeat(np.arange(len(self)), counts**2)
+        local = np.arange(pair_offsets[-1]) - pair_offsets[event]
+        first = self.offsets[event] + local // counts[event]
+        second = self.offsets[event] + local % counts[event]
+        return first, second, pair_offsets
+
+    def _pair_matrices(self, func):
+        """Apply func to the p4s of all pairs at once, and split the result into per-event matrices"""
+        first, second, pair_offsets = self._all_pairs()
+        p4 = self.p4
+        values = func(p4[first], p4[second])
+        return [values[pair_offsets[i]:pair_offsets[i+1]].reshape(n, n)
+                for i, n in enumerate(self.counts)]
+
+    def delta_r_matrices(self):
+        """
+        Return a list with, for each event, the matrix of eta-phi distances
+        between all pairs of its particles, computed for the whole batch at
+        once
+
+        Example:
+        >>> from particles import Electron
+        >>> ele = Electron(FourMomentum.from_x_y_z_m(10,0,0,0), 1)
+        >>> ele2 = Electron(FourMomentum.from_x_y_z_m(0,10,0,0), 1)
+        >>> matrices = EventBatch.from_events([Event([ele, ele2]), Event([ele])]).delta_r_matrices()
+        >>> matrices[0].round(6)
+        array([[0.      , 1.570796],
+               [1.570796, 0.      ]])
+        >>> matrices[1]
+        array([[0.]])
+        """
+        return self._pair_matrices(lambda a, b: a.delta_r(b))
+
+    def mass_matrices(self):
+        """
+        Return a list with, for each event, the matrix of invariant masses
+        of all pairs of its particles, computed for the whole batch at once
+        """
+        return self._pair_matrices(lambda a, b: (a+b).mass)
+
+    def select(self, mask):
+        """
+        Return a batch with only the particles for which mask is True. The
+        events themselves are all kept, even if they end up empty.
+
+        Arguments:
+        mask - boolean array with an entry for each particle
+        """
+        mask = np.asarray(mask, dtype=bool)
+        counts = np.bincount(self.event_index[mask], minlength=len(self))
+        offsets = np.zeros(len(self)+1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return EventBatch(self.px[mask], self.py[mask], self.pz[mask], self.m[mask],
+                          self.pdgID[mask], self.charge[mask], offsets,
+                          None if self.status is None else self.status[mask], self.metadata)
+
+    def particles_with_pdgID(self, pdgID):
+        """Return a batch with only the particles with abs(pdgID) equal to the one given"""
+        return self.select(np.abs(self.pdgID) == pdgID)
+
+    def electrons(self):
+        """Convenience method to keep only electrons"""
+        return self.particles_with_pdgID(11)
+
+    def muons(self):
+        """Convenience method to keep only muons"""
+        return self.particles_with_pdgID(13)
+
+    def with_status(self, status):
+        """Return a batch with only the particles with the given generator status"""
+        if self.status is None:
+            raise ValueError("batch has no generator status")
+        return self.select(self.status == status)
+
+    def sum(self, mask=None):
+        """
+        Return the sum of the four-momenta of the particles in each event
+        as a FourMomentumArray, optionally only including the particles for
+        which mask is True.
+        """
+        n = len(self)
+        index = self.event_index
+        energy = np.sqrt(self.px**2 + self.py**2 + self.pz**2 + self.m**2)
+        columns = [self.px, self.py, self.pz, energy]
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            index = index[mask]
+            columns = [c[mask] for c in columns]
+        sums = [np.bincount(index, weights=c, minlength=n) for c in columns]
+        return FourMomentumArray.from_x_y_z_e(*sums)
+
+    def met(self, pdgIDs_to_ignore=[12, 14, 16]):
+        """
+        Return the missing transverse momentum of each event as a
+        FourMomentumArray: the negative sum of all the particles that
+        aren't in pdgIDs_to_ignore and, for generator-level batches, have
+        status = 1. Same as Event.met/GenEvent.met.
+
+        Example:
+        >>> p1 = GenParticle(FourMomentum.from_x_y_z_m(10,20,30,0.000511), 11, 1, 1)
+        >>> p2 = GenParticle(FourMomentum.from_x_y_z_m(-10,-20,-30,0), 12, 0, 1)
+        >>> p3 = GenParticle(FourMomentum.from_x_y_z_m(-10,-20,-30,0), 11, 0, 3)
+        >>> batch = EventBatch.from_events([GenEvent([p1, p2, p3])])
+        >>> batch.met().pt.round(6)
+        array([22.36068])
+        """
+        mask = ~np.in1d(np.abs(self.pdgID), pdgIDs_to_ignore)
+        if self.status is not None:
+            mask &= self.status == 1
+        return -self.sum(mask)
+
+
+__all__ = ['EventBatch']
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,185 @@
+from itertools import combinations as _index_combinations
+
+import numpy as np
+
+from batch import EventBatch
+
+
+class Candidates(object):
+    """
+    Combinations of particles from each event of an EventBatch, e.g. Z ->
+    ee candidates, along with their summed four-momenta.
+
+    indices holds, for each candidate, the positions of its k particles in
+    the particle arrays of the batch, and the candidates of event i are
+    those between offsets[i] and offsets[i+1]. Selections return new
+    Candidates for the same events, so they can be chained.
+
+    Example:
+    >>> from fourmomentum import FourMomentum
+    >>> from event import Event
+    >>> from particles import Electron
+    >>> electrons = [Electron(FourMomentum.from_x_y_z_m(40,0,5,0), -1),
+    ...              Electron(FourMomentum.from_x_y_z_m(-45,0,0,0), 1),
+    ...              Electron(FourMomentum.from_x_y_z_m(0,30,0,0), 1)]
+    >>> batch = EventBatch.from_events([Event(electrons), Event(electrons[:1])])
+    >>> pairs = combinations(batch, 2, total_charge=0)
+    >>> pairs.counts
+    array([2, 0])
+    >>> pairs.indices
+    array([[0, 1],
+           [0, 2]])
+    >>> best = pairs.closest_to_mass(91.19)
+    >>> best.indices, best.mass.round(3)
+    (array([[0, 1]]), array([85.018]))
+    """
+    def __init__(self, batch, indices, offsets):
+        """
+        Arguments:
+        batch - the EventBatch the particles come from
+        indices - (number of candidates, k) array of particle indices
+        offsets - array of length len(batch)+1 with the index of the first
+        candidate of each event, followed by the total number of candidates
+        """
+        self.batch = batch
+        self.indices = indices
+        self.offsets = offsets
+        self._p4 = None
+
+    def __len__(self):
+        """Number of candidates in all events"""
+        return len(self.indices)
+
+    @property
+    def counts(self):
+        """Number of candidates in each event"""
+        return np.diff(self.offsets)
+
+    @property
+    def event_index(self):
+        """Index of the event each candidate belongs to"""
+        return np.repeat(np.arange(len(self.offsets)-1), self.counts)
+
+    @property
+    def p4(self):
+        """Summed four-momenta of the candidates as a FourMomentumArray"""
+        if self._p4 is None:
+            p4 = self.batch.p4
+            self._p4 = p4[self.indices[:, 0]]
+            for i in range(1, self.indices.shape[1]):
+                self._p4 = self._p4 + p4[self.indices[:, i]]
+        return self._p4
+
+    @property
+    def mass(self):
+        """Invariant masses of the candidates"""
+        return self.p4.mass
+
+    @property
+    def charge(self):
+        """Summed charges of the candidates"""
+        return self.batch.charge[self.indices].sum(axis=1)
+
+    def select(self, mask):
+        """Return only the candidates for which mask is True"""
+        mask = np.asarray(mask, dtype=bool)
+        result = Candidates(self.batch, self.indices[mask],
+                            _offsets(np.bincount(self.event_index[mask], minlength=len(self.offsets)-1)))
+        if self._p4 is not None:
+            result._p4 = self._p4[mask]
+        return result
+
+    def best(self, key):
+        """
+        Return at most one candidate per event, the one with the smallest
+        key. The first candidate wins ties.
+
+        Arguments:
+        key - array with a value for each candidate, e.g. abs(mass-91.19)
+        """
+        key = np.asarray(key)
+        event = self.event_index
+        order = np.lexsort((key, event))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = event[order][1:] != event[order][:-1]
+        mask = np.zeros(len(order), dtype=bool)
+        mask[order[first]] = True
+        return self.select(mask)
+
+    def closest_to_mass(self, mass):
+        """Return the candidate in each event with the invariant mass closest to mass"""
+        return self.best(np.abs(self.mass-mass))
+
+
+def combinations(events, k, total_charge=None, same_flavour=False, pdgIDs=None):
+    """
+    Build all combinations of k distinct particles within each event.
+
+    Events with the same number of particles share one table of index
+    combinations, so the work is done with a few numpy operations per
+    distinct multiplicity rather than per event.
+
+    Arguments:
+    events - an EventBatch, or an Event or list of Events to make one from
+    k - number of particles per candidate
+    total_charge - if given, only keep candidates whose charges add up to
+    this, e.g. 0 for opposite-sign pairs
+    same_flavour - only keep candidates whose particles all have the same
+    abs(pdgID)
+    pdgIDs - if given, only use particles with abs(pdgID) in this sequence
+    """
+    if not isinstance(events, EventBatch):
+        if hasattr(events, 'particles_'):
+            events = [events]
+        events = EventBatch.from_events(events)
+    batch = events
+    if pdgIDs is not None:
+        batch = batch.select(np.in1d(np.abs(batch.pdgID), pdgIDs))
+
+    counts = batch.counts
+    n_combinations = _n_choose_k(counts, k)
+    offsets = _offsets(n_combinations)
+    indices = np.empty((offsets[-1], k), dtype=np.int64)
+    for n in np.unique(counts[n_combinations > 0]):
+        table = np.array(list(_index_combinations(range(n), k)), dtype=np.int64)
+        group = np.nonzero(counts == n)[0]
+        # position of each combination of each event in the output
+        rows = offsets[group][:, np.newaxis] + np.arange(len(table))
+        indices[rows] = batch.offsets[group][:, np.newaxis, np.newaxis] + table
+    candidates = Candidates(batch, indices, offsets)
+
+    mask = np.ones(len(indices), dtype=bool)
+    if total_charge is not None:
+        mask &= candidates.charge == total_charge
+    if same_flavour and k > 1:
+        flavour = np.abs(batch.pdgID[indices])
+        mask &= np.all(flavour == flavour[:, :1], axis=1)
+    if not mask.all():
+        candidates = candidates.select(mask)
+    return candidates
+
+
+def _n_choose_k(n, k):
+    """Binomial coefficients for an array of n"""
+    result = np.ones(len(n), dtype=np.int64)
+    for i in range(k):
+        result = result * np.maximum(n-i, 0) // (i+1)
+    return result
+
+
+def _offsets(counts):
+    offsets = np.zeros(len(counts)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+__all__ = ['Candidates', 'combinations']
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,547 @@
+import json
+import numbers
+import os
+from collections import OrderedDict
+from itertools import chain
+
+import numpy as np
+
+from batch import EventBatch
+
+# per-particle columns and their on-disk types; status is only stored for
+# generator-level events
+PARTICLE_COLUMNS = [
+    ('px', '<f8'),
+    ('py', '<f8'),
+    ('pz', '<f8'),
+    ('m', '<f8'),
+    ('pdgID', '<i4'),
+    ('charge', '<i4'),
+    ('status', '<i4'),
+]
+
+_META_FILE = 'meta.json'
+_FORMAT_VERSION = 1
+
+
+class ColumnarEventCollection(object):
+    """
+    Alternative to EventCollection that stores events as columns of binary
+    numbers in a directory, one file per column, instead of as pickled
+    objects.
+
+    Each particle quantity (px, py, pz, m, pdgID, charge and, for
+    GenEvents, status) is a flat array over the particles of all events,
+    and an offsets array gives the first particle of each event. Event
+    metadata is stored as one column per key. Numbers are stored as 64-bit
+    ints or floats; strings are stored as UTF-8 bytes and read back as
+    byte strings. Events without a key (or with None for it) get 0, NaN or
+    '' in its column.
+
+    Reading goes through numpy.memmap, so only the columns (and the parts
+    of them) that are actually used are read from disk, without copying.
+    column(), event_column() and batches() give direct access to the
+    arrays; events() still returns Event objects so that code written for
+    EventCollection keeps working.
+
+    Events added with add_event or add_batch are kept in memory until
+    save() (or until commit_every events have been added) and then
+    appended to the files. Events that haven't been saved are lost when the
+    collection is closed.
+
+    Example:
+    >>> import tempfile, shutil
+    >>> from fourmomentum import FourMomentum
+    >>> from event import GenEvent
+    >>> from particles import GenParticle
+    >>> dirname = tempfile.mkdtemp()
+    >>> p = GenParticle(FourMomentum.from_x_y_z_m(10,20,30,0.000511), 11, -1, 1)
+    >>> ec = ColumnarEventCollection(dirname)
+    >>> ec.add_event(GenEvent([p, p], {'idprup': 3, 'comment': 'first'}))
+    >>> ec.add_event(GenEvent([p], {'idprup': 4}))
+    >>> ec.save()
+    >>> ec.column('px')
+    memmap([10., 10., 10.])
+    >>> ec.event_column('comment')[0]
+    'first'
+    >>> [e.metadata['idprup'] for e in ec.events()]
+    [3, 4]
+    >>> ec.close()
+    >>> shutil.rmtree(dirname)
+    """
+
+    def __init__(self, dirname, commit_every=10000, read_only=False):
+        """
+        Open the collection in directory dirname, creating it if needed.
+
+        Arguments:
+        dirname - directory holding the column files
+        commit_every - save automatically after this many events have been
+        added (None to only save when save() is called)
+        read_only - open an existing collection for reading only
+        """
+        self.dirname = dirname
+        self.commit_every = commit_every
+        self.read_only = read_only
+        self._pending = []
+        self._pending_events = 0
+        # types of the metadata columns that only pending events have
+        self._pending_dtypes = {}
+        self._maps = {}
+        meta_path = os.path.join(dirname, _META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+            if self.meta['version'] > _FORMAT_VERSION:
+                raise ValueError("%s was written by a newer version of pyhep" % dirname)
+            if not read_only:
+                self._truncate()
+        elif read_only:
+            raise ValueError("%s is not a columnar event collection" % dirname)
+        else:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self.meta = {'version': _FORMAT_VERSION, 'n_events': 0, 'n_particles': 0,
+                         'generator': None, 'event_columns': []}
+            self._write_file('offsets', np.zeros(1, dtype='<i8'), 'wb')
+            self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.meta['n_events'] + self._pending_events
+
+    def close(self):
+        self._pending = []
+        self._pending_events = 0
+        self._pending_dtypes = {}
+        self._maps = {}
+
+    def add_event(self, event):
+        self.add_batch(EventBatch.from_events([event]))
+
+    def add_events(self, events):
+        """Add all of the events from an iterable"""
+        events = iter(events)
+        while True:
+            chunk = []
+            for event in events:
+                chunk.append(event)
+                if len(chunk) == 1000:
+                    break
+            if not chunk:
+                return
+            self.add_batch(EventBatch.from_events(chunk))
+
+    def add_batch(self, batch, event_columns=None):
+        """
+        Add all of the events in an EventBatch.
+
+        Arguments:
+        batch - the EventBatch
+        event_columns - if given, a dict mapping metadata names to arrays
+        (or lists) with a value for each event, which is used instead of
+        the metadata dicts of the batch. This avoids making a dict for
+        every event when the metadata is already in columns.
+
+        A batch that can't be stored with the events already added (e.g.
+        metadata of the wrong type) raises a ValueError here, rather than
+        when the events are saved, and is not added.
+        """
+        if self.read_only:
+            raise ValueError("collection was opened read-only")
+        if event_columns is None:
+            event_columns = _metadata_columns(batch.metadata)
+        else:
+            event_columns = OrderedDict(sorted(event_columns.items()))
+            for name, values in event_columns.iteritems():
+                if len(values) != len(batch):
+                    raise ValueError("metadata %r has %d values for %d events" %
+                                     (name, len(values), len(batch)))
+        self._check_batch(batch, event_columns)
+        self._pending.append((batch, event_columns))
+        self._pending_events += len(batch)
+        if self.commit_every is not None and self._pending_events >= self.commit_every:
+            self.save()
+
+    def save(self):
+        """Append the events added since the last save to the files"""
+        if not self._pending:
+            return
+        batches, self._pending, self._pending_events = self._pending, [], 0
+        self._pending_dtypes = {}
+        generator = self.meta['generator']
+        for batch, event_columns in batches:
+            if generator is None:
+                generator = batch.status is not None
+            elif generator != (batch.status is not None):
+                raise ValueError("can't mix events with and without generator status")
+        self.meta['generator'] = generator
+
+        n_particles = self.meta['n_particles']
+        n_events = self.meta['n_events']
+        # work out everything that will be appended before writing any of
+        # it, so that bad metadata doesn't leave the files half-written
+        writes = [(name, np.concatenate([getattr(b, name) for b, c in batches]).astype(dtype))
+                  for name, dtype in self._particle_columns()]
+        starts = np.cumsum([n_particles]+[b.n_particles for b, c in batches])
+        offsets = np.concatenate([b.offsets[1:]+start for (b, c), start in zip(batches, starts)])
+        writes.append(('offsets', offsets.astype('<i8')))
+
+        new_columns = self._new_event_columns([c for b, c in batches])
+        for column in self.meta['event_columns'] + new_columns:
+            name, dtype = column['name'], column['dtype']
+            pieces = [c[name] if name in c else _missing_piece(dtype, len(b)) for b, c in batches]
+            if column in new_columns:
+                # fill in the events that were saved before the key showed up
+                pieces.insert(0, _missing_piece(dtype, n_events))
+            writes += self._event_column_data(column, pieces, new=column in new_columns)
+
+        try:
+            for column in new_columns:
+                # left over from a save that failed part-way through
+                for name in (column['file'], column['file']+'.offsets'):
+                    if os.path.exists(self._path(name)):
+                        os.remove(self._path(name))
+            for name, data in writes:
+                self._write_file(name, data)
+        except:
+            self._truncate()
+            raise
+        self.meta['event_columns'] += new_columns
+        self.meta['n_events'] += sum(len(b) for b, c in batches)
+        self.meta['n_particles'] = int(starts[-1])
+        self._write_meta()
+        self._maps = {}
+
+    def column(self, name):
+        """
+        Return a read-only memory-mapped array of a per-particle column
+        (px, py, pz, m, pdgID, charge or status) for all saved events.
+        """
+        if name not in dict(self._particle_columns()):
+            raise KeyError(name)
+        return self._map(name, dict(PARTICLE_COLUMNS)[name], self.meta['n_particles'])
+
+    @property
+    def offsets(self):
+        """Memory-mapped array of the index of the first particle of each event, plus the total"""
+        return self._map('offsets', '<i8', self.meta['n_events']+1)
+
+    @property
+    def event_columns(self):
+        """Names of the metadata columns"""
+        return [column['name'] for column in self.meta['event_columns']]
+
+    def event_column(self, name):
+        """
+        Return the metadata column with the given name, for all saved
+        events, as a memory-mapped array. String columns are returned as a
+        sequence of byte strings that is read lazily.
+        """
+        for column in self.meta['event_columns']:
+            if column['name'] == name:
+                break
+        else:
+            raise KeyError(name)
+        n = self.meta['n_events']
+        if column['dtype'] == 'str':
+            return StringColumn(self._map(column['file'], 'u1', None),
+                                self._map(column['file']+'.offsets', '<i8', n+1))
+        return self._map(column['file'], column['dtype'], n)
+
+    def batches(self, n=10000, metadata=True, start=0, stop=None):
+        """
+        Iterate through the saved events as EventBatches of up to n events.
+        The particle columns of the batches are views of the memory-mapped
+        files, so they're read-only.
+
+        Arguments:
+        n - number of events per batch
+        metadata - if False, don't build the metadata dicts of the events
+        start, stop - range of event numbers to iterate over
+        """
+        n_events = self.meta['n_events']
+        stop = n_events if stop is None else min(stop, n_events)
+        offsets = self.offsets
+        names = [name for name, dtype in self._particle_columns()]
+        columns = dict((name, self.column(name)) for name in names)
+        event_columns = [(name, self.event_column(name)) for name in self.event_columns]
+        for first in range(start, stop, n):
+            last = min(first+n, stop)
+            lo, hi = offsets[first], offsets[last]
+            sliced = dict((name, columns[name][lo:hi]) for name in names)
+            batch_metadata = None
+            if metadata:
+                values = [column[first:last] for name, column in event_columns]
+                batch_metadata = [dict((name, _to_python(v[i])) for (name, c), v in
+                                       zip(event_columns, values))
+                                  for i in range(last-first)]
+            yield EventBatch(sliced['px'], sliced['py'], sliced['pz'], sliced['m'],
+                             sliced['pdgID'], sliced['charge'],
+                             np.asarray(offsets[first:last+1]) - lo,
+                             sliced.get('status'), batch_metadata)
+
+    def events(self, batch_size=1000, start=None, stop=None):
+        """
+        Iterate through the saved events as Event (or GenEvent) objects, made
+        from batches of batch_size events at a time.
+        """
+        for batch in self.batches(batch_size, start=start or 0, stop=stop):
+            for event in batch.to_events():
+                yield event
+
+    def _particle_columns(self):
+        if self.meta['generator'] is False:
+            return [(name, dtype) for name, dtype in PARTICLE_COLUMNS if name != 'status']
+        return PARTICLE_COLUMNS
+
+    def _path(self, name):
+        return os.path.join(self.dirname, name + '.bin')
+
+    def _map(self, name, dtype, length):
+        """Memory-map the first length values of a column file (all of it if length is None)"""
+        key = (name, length)
+        if key not in self._maps:
+            path = self._path(name)
+            if length is None:
+                length = (os.path.getsize(path) if os.path.exists(path) else 0) // np.dtype(dtype).itemsize
+            if length == 0:
+                # numpy can't map an empty file
+                array = np.zeros(0, dtype=dtype)
+            else:
+                array = np.memmap(path, dtype=dtype, mode='r', shape=(length,))
+            self._maps[key] = array
+        return self._maps[key]
+
+    def _write_file(self, name, data, mode='ab'):
+        with open(self._path(name), mode) as f:
+            f.write(np.ascontiguousarray(data).tobytes())
+
+    def _write_meta(self):
+        """Write the metadata file. This is what makes newly appended data visible."""
+        path = os.path.join(self.dirname, _META_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.meta, f, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def _truncate(self):
+        """Drop anything written after the last complete save, e.g. by a crash during save()"""
+        n_events, n_particles = self.meta['n_events'], self.meta['n_particles']
+        sizes = [('offsets', (n_events+1)*8)]
+        sizes += [(name, n_particles*np.dtype(dtype).itemsize)
+                  for name, dtype in self._particle_columns() if self.meta['generator'] is not None]
+        for column in self.meta['event_columns']:
+            if column['dtype'] == 'str':
+                sizes += [(column['file']+'.offsets', (n_events+1)*8),
+                          (column['file'], self._string_end(column))]
+            else:
+                sizes.append((column['file'], n_events*np.dtype(column['dtype']).itemsize))
+        for name, size in sizes:
+            path = self._path(name)
+            if os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+    def _check_batch(self, batch, event_columns):
+        """
+        Raise ValueError if a batch can't be saved along with the saved and
+        pending events, and note the types of its new metadata columns
+        """
+        generator = self.meta['generator']
+        if generator is None and self._pending:
+            generator = self._pending[0][0].status is not None
+        if generator is not None and generator != (batch.status is not None):
+            raise ValueError("can't mix events with and without generator status")
+        dtypes = dict((column['name'], column['dtype']) for column in self.meta['event_columns'])
+        dtypes.update(self._pending_dtypes)
+        new_dtypes = {}
+        for name, values in event_columns.iteritems():
+            dtype = dtypes.get(name)
+            if dtype is None:
+                dtype = new_dtypes[name] = _values_dtype(name, values)
+            _check_values(name, dtype, values)
+        self._pending_dtypes.update(new_dtypes)
+
+    def _string_end(self, column):
+        """
+        Offset of the end of the saved strings of a string column. Only this
+        one value of the offsets file is read, since the file grows with
+        every save.
+        """
+        with open(self._path(column['file']+'.offsets'), 'rb') as f:
+            f.seek(self.meta['n_events']*8)
+            return int(np.fromfile(f, '<i8', 1)[0])
+
+    def _new_event_columns(self, batch_columns):
+        """Make columns for metadata keys that haven't been seen before"""
+        known = set(self.event_columns)
+        columns = []
+        for event_columns in batch_columns:
+            for name, values in event_columns.iteritems():
+                if name in known:
+                    continue
+                columns.append({'name': name, 'dtype': _values_dtype(name, values),
+                                'file': 'event.%d' % (len(self.meta['event_columns'])+len(columns))})
+                known.add(name)
+        return columns
+
+    def _event_column_data(self, column, pieces, new=False):
+        """
+        Convert metadata values, given as a list of arrays or lists, to what
+        has to be appended to the files of a column, as a list of (file
+        name, array) pairs. A new column's files are started from scratch.
+        The values have already been checked by _check_values.
+        """
+        name, dtype = column['name'], column['dtype']
+        if dtype == 'str':
+            strings = []
+            for value in chain.from_iterable(pieces):
+                if value is _MISSING:
+                    value = ''
+                elif isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                strings.append(value)
+            offsets = np.cumsum([len(s) for s in strings], dtype='<i8')
+            if new:
+                offsets = np.concatenate([np.zeros(1, dtype='<i8'), offsets])
+            else:
+                offsets += self._string_end(column)
+            return [(column['file'], np.frombuffer(''.join(strings), dtype='u1')),
+                    (column['file']+'.offsets', offsets)]
+        missing = _missing_values(dtype, 1)[0]
+        arrays = []
+        for values in pieces:
+            if isinstance(values, np.ndarray) and values.dtype.kind in 'biuf':
+                arrays.append(values.astype(dtype))
+                continue
+            arrays.append(np.array([missing if value is _MISSING else value for value in values],
+                                   dtype=dtype))
+        return [(column['file'], np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype))]
+
+
+class StringColumn(object):
+    """
+    Column of byte strings stored as one block of bytes plus offsets.
+    Strings are only read when they are accessed.
+    """
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.data[self.offsets[index]:self.offsets[index+1]].tostring()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class _Missing(object):
+    """Marker for a metadata key an event doesn't have"""
+    def __repr__(self):
+        return 'MISSING'
+
+_MISSING = _Missing()
+
+
+def _column_dtype(name, value):
+    """Column type for a metadata value"""
+    if isinstance(value, basestring):
+        return 'str'
+    if isinstance(value, numbers.Integral):
+        return '<i8'
+    if isinstance(value, numbers.Real):
+        return '<f8'
+    raise ValueError("can only store numbers and strings as metadata, got %r for %r" % (value, name))
+
+
+def _values_dtype(name, values):
+    """Column type for an array or list of metadata values"""
+    if isinstance(values, np.ndarray) and values.dtype.kind in 'biuf':
+        return '<f8' if values.dtype.kind == 'f' else '<i8'
+    for value in values:
+        if value is not _MISSING:
+            return _column_dtype(name, value)
+    raise ValueError("metadata %r has no values" % name)
+
+
+def _check_values(name, dtype, values):
+    """Raise ValueError if metadata values can't be stored in a column of type dtype"""
+    if isinstance(values, np.ndarray) and values.dtype.kind in 'biuf':
+        if dtype == 'str':
+            raise ValueError("metadata %r must be a string, got %s values" % (name, values.dtype))
+        if dtype == '<i8' and values.dtype.kind == 'f':
+            raise ValueError("metadata %r must be an integer, got %s values" % (name, values.dtype))
+        return
+    for value in values:
+        if value is _MISSING:
+            continue
+        if dtype == 'str':
+            if not isinstance(value, basestring):
+                raise ValueError("metadata %r must be a string, got %r" % (name, value))
+        elif (not isinstance(value, numbers.Number) or
+                (dtype == '<i8' and not isinstance(value, numbers.Integral))):
+            raise ValueError("metadata %r must be %s, got %r" %
+                             (name, 'an integer' if dtype == '<i8' else 'a number', value))
+
+
+def _metadata_columns(metadata):
+    """
+    Turn a list of metadata dicts into a dict of lists with a value for each
+    event, _MISSING where an event doesn't have the key or has None
+    """
+    columns = OrderedDict()
+    for i, md in enumerate(metadata):
+        for name, value in md.iteritems():
+            if value is None:
+                continue
+            if name not in columns:
+                columns[name] = [_MISSING]*len(metadata)
+            columns[name][i] = value
+    return columns
+
+
+def _missing_piece(dtype, n):
+    """Values for n events that don't have a metadata key"""
+    if dtype == 'str':
+        return [_MISSING]*n
+    return _missing_values(dtype, n)
+
+
+def _missing_values(dtype, n):
+    if dtype == '<f8':
+        return np.full(n, np.nan, dtype=dtype)
+    return np.zeros(n, dtype=dtype)
+
+
+def _to_python(value):
+    """Convert a numpy scalar read from a column into the matching python type"""
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+__all__ = ['ColumnarEventCollection', 'StringColumn']
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
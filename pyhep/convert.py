@@ -1,28 +1,322 @@
+import multiprocessing
+import time
+from collections import namedtuple
+from Queue import Empty
+
+import numpy as np
+import transaction
+
 import LesHouchesEvents as LHE
-from pyhep import *
+from batch import EventBatch
+from columnar import ColumnarEventCollection
+from event import GenEvent
+from fourmomentum import FourMomentum
 from particles import GenParticle
 from storage import EventCollection
 
-def convert_from_LHE( infilename, outfilename) :
-    """Import events from LHE files. Return a list of Events"""
-    lhe = LHE.LHEventReader(infilename)
-    ec =  EventCollection(outfilename)
-    for lhe_event in lhe.events() :
-        particles = map(LHE_particle_to_pyhep, lhe_event.particles)
-        event = GenEvent(particles)
-        event.metadata['comment'] = lhe_event.comment
-        event.metadata['idprup'] = lhe_event.idprup()
-        ec.add_event(event)
+# electric charge of the particle (not the antiparticle) with each abs(pdgID)
+PDG_CHARGES = {
+    1: -1./3, 2: 2./3, 3: -1./3, 4: 2./3, 5: -1./3, 6: 2./3,
+    11: -1, 12: 0, 13: -1, 14: 0, 15: -1, 16: 0,
+    21: 0, 22: 0, 23: 0, 24: 1, 25: 0,
+    111: 0, 211: 1, 130: 0, 310: 0, 311: 0, 321: 1,
+    2112: 0, 2212: 1,
+    }
+
+# how long convert_from_LHE waits for a chunk before checking that the
+# other processes are still alive
+_WORKER_CHECK_SECONDS = 1.
+
+
+class ConversionStats(namedtuple('ConversionStats', ['events', 'seconds', 'events_per_second',
+                                                     'peak_input_queue', 'peak_output_queue'])):
+    """
+    Progress of convert_from_LHE.
+
+    events - number of events written so far
+    seconds - time since the conversion started
+    events_per_second - events/seconds
+    peak_input_queue, peak_output_queue - largest number of chunks seen
+    waiting for the converters and for the writer. If the input queue is
+    mostly empty, reading the file is the bottleneck; if the output queue
+    is mostly full, writing is. None where the platform can't tell.
+    """
+    __slots__ = ()
+
+
+def pdg_charge(pdgID):
+    """
+    Electric charge of the particle with the given pdgID, from PDG_CHARGES.
+    Negative pdgIDs are antiparticles. Particles missing from the table
+    get 0.
+
+    Example:
+    >>> pdg_charge(11), pdg_charge(-11), pdg_charge(-24)
+    (-1, 1, -1)
+    """
+    charge = PDG_CHARGES.get(abs(pdgID), 0)
+    return -charge if pdgID < 0 else charge
+
+
+def convert_from_LHE(infilename, outfilename, processes=None, chunk_size=500, queue_size=None,
+                     on_progress=None, progress_seconds=10., inline_particles=False):
+    """
+    Import the events of an LHE file into an EventCollection, which is saved
+    and returned.
 
+    The work is split into a pipeline: a reader process scans the file and
+    sends chunks of chunk_size raw events to a number of converter
+    processes, which parse them into arrays (see LHEventReader.batches),
+    and the calling process turns the arrays into GenEvents and writes them
+    to the collection. Arrays are much cheaper to send between processes
+    than GenEvents, which would take longer to unpickle than to build. The
+    stages are connected by queues of at most queue_size chunks, so memory
+    use stays bounded whichever stage is the slowest. Chunks are numbered
+    by the reader and written in that order, so the collection is the same
+    however many converters are used.
+
+    Storing the events usually takes longest, so the writer is the stage
+    to watch (see ConversionStats). Storing the particles inline (see
+    EventCollection) makes it roughly twice as fast.
+
+    Arguments:
+    infilename - LHE file, possibly compressed
+    outfilename - file for the EventCollection
+    processes - number of converter processes, the number of CPUs by default
+    chunk_size - number of events handed to a converter at a time
+    queue_size - maximum number of chunks waiting in each queue, twice the
+    number of converters by default
+    on_progress - if given, called with a ConversionStats every
+    progress_seconds seconds while converting, and once at the end
+    inline_particles - passed on to the EventCollection
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if queue_size is None:
+        queue_size = 2*processes
+    raw_chunks = multiprocessing.Queue(queue_size)
+    converted_chunks = multiprocessing.Queue(queue_size)
+    workers = [multiprocessing.Process(target=_read_chunks,
+                                       args=(infilename, chunk_size, raw_chunks, processes))]
+    workers += [multiprocessing.Process(target=_convert_chunks, args=(raw_chunks, converted_chunks))
+                for i in range(processes)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    ec = EventCollection(outfilename, inline_particles=inline_particles)
+    start = last_report = time.time()
+    n_events = 0
+    peaks = [0, 0]
+    pending = {}
+    next_chunk = 0
+    running = processes
+    finished = False
+    try:
+        while running:
+            for i, queue in enumerate([raw_chunks, converted_chunks]):
+                peaks[i] = _max_depth(peaks[i], queue)
+            try:
+                item = converted_chunks.get(timeout=_WORKER_CHECK_SECONDS)
+            except Empty:
+                # a process that was killed won't send its end marker
+                _check_workers(workers)
+                continue
+            if item is None:
+                running -= 1
+                continue
+            number, batch = item
+            if isinstance(batch, Exception):
+                raise batch
+            # converters finish out of order, so hold on to chunks until
+            # all of the ones before them have been written
+            pending[number] = batch
+            while next_chunk in pending:
+                events = _batch_to_events(pending.pop(next_chunk))
+                ec.add_events(events)
+                n_events += len(events)
+                next_chunk += 1
+            if on_progress is not None and time.time()-last_report >= progress_seconds:
+                last_report = time.time()
+                on_progress(_stats(n_events, start, peaks))
+        if pending:
+            raise RuntimeError("chunks %s were converted but not written" % sorted(pending))
+        ec.save()
+        finished = True
+    finally:
+        if not finished:
+            # the other processes may be blocked on full queues
+            for worker in workers:
+                worker.terminate()
+            # drop the events that weren't committed, so that the
+            # collection can be closed
+            transaction.abort()
+            ec.close()
+        for worker in workers:
+            worker.join()
+    if on_progress is not None:
+        on_progress(_stats(n_events, start, peaks))
+    return ec
+
+
+def convert_LHE_to_columnar(infilename, dirname, batch_size=10000, processes=None):
+    """
+    Import the events of an LHE file into a ColumnarEventCollection in
+    directory dirname (appending if it already exists), which is saved and
+    returned.
+
+    The file is read with LHEventReader.batches (or parallel_batches, for
+    uncompressed files when processes isn't 1), and the particle and header
+    arrays are written straight to the column files, so no Python objects
+    are made for the particles. Besides the particle columns, the header
+    fields idprup, xwgtup, scalup, aqedup and aqcdup and the comment line
+    ('' if there is none) are stored as metadata columns.
+
+    The charge column holds integers, so quarks get 0, as they do when
+    GenEvents from convert_from_LHE are added to a ColumnarEventCollection.
+
+    Arguments:
+    infilename - LHE file, possibly compressed
+    dirname - directory for the ColumnarEventCollection
+    batch_size - number of events parsed and written at a time
+    processes - number of processes parsing the file, the number of CPUs
+    by default
+    """
+    reader = LHE.LHEventReader(infilename)
+    if processes == 1 or reader.compression is not None:
+        batches = reader.batches(batch_size)
+    else:
+        batches = reader.parallel_batches(batch_size, processes)
+    ec = ColumnarEventCollection(dirname, commit_every=batch_size)
+    for batch in batches:
+        particles = batch.particles
+        headers = batch.headers
+        columns = dict((name, headers[name]) for name in ['idprup', 'xwgtup', 'scalup', 'aqedup', 'aqcdup'])
+        columns['comment'] = [comment or '' for comment in batch.comments]
+        ec.add_batch(EventBatch(particles['pup1'], particles['pup2'], particles['pup3'], particles['pup5'],
+                                particles['idup'], _pdg_charges(particles['idup']), batch.offsets,
+                                particles['istup']),
+                     columns)
     ec.save()
     return ec
 
-def LHE_particle_to_pyhep(p) :
+
+def LHE_event_to_pyhep(lhe_event):
+    """Convert an LHEvent to a GenEvent"""
+    event = GenEvent(map(LHE_particle_to_pyhep, lhe_event.particles))
+    event.metadata['comment'] = lhe_event.comment
+    event.metadata['idprup'] = lhe_event.idprup()
+    return event
+
+
+def LHE_particle_to_pyhep(p):
     """Convert an LHE particle to a pyhep particle"""
-    p4 = FourVector(p.px(), p.py(), p.pz(), p.energy())
+    # the mass is given separately, so there's no need to compute it from
+    # the energy, which can fail from rounding for massless particles
+    p4 = FourMomentum.from_x_y_z_m(p.px(), p.py(), p.pz(), p.mass())
     pdgID = p.idup()
-    status = p.istup()
+    return GenParticle(p4, pdgID, pdg_charge(pdgID), p.istup())
+
+
+def _batch_to_events(batch):
+    """Build GenEvents from an LHEventBatch, like LHE_event_to_pyhep"""
+    particles = batch.particles
+    pdgIDs = particles['idup'].tolist()
+    charges = dict((pdgID, pdg_charge(pdgID)) for pdgID in set(pdgIDs))
+    columns = zip(particles['pup1'].tolist(), particles['pup2'].tolist(), particles['pup3'].tolist(),
+                  particles['pup5'].tolist(), pdgIDs, particles['istup'].tolist())
+    particles = [GenParticle(FourMomentum.from_x_y_z_m(x, y, z, m), pdgID, charges[pdgID], status)
+                 for x, y, z, m, pdgID, status in columns]
+    offsets = batch.offsets.tolist()
+    idprups = batch.headers['idprup'].tolist()
+    return [GenEvent(particles[offsets[i]:offsets[i+1]],
+                     {'comment': batch.comments[i], 'idprup': idprups[i]})
+            for i in range(len(idprups))]
+
+
+def _pdg_charges(pdgIDs):
+    """pdg_charge for an array of pdgIDs"""
+    unique, inverse = np.unique(pdgIDs, return_inverse=True)
+    return np.array([pdg_charge(pdgID) for pdgID in unique.tolist()], dtype=np.float64)[inverse]
+
+
+def _read_chunks(filename, chunk_size, raw_chunks, n_converters):
+    """
+    Reader stage of convert_from_LHE: put numbered chunks of raw event
+    blocks on raw_chunks, followed by an end marker for each converter
+    """
+    try:
+        reader = LHE.LHEventReader(filename)
+        number = 0
+        chunk = []
+        with reader._open() as f:
+            for offset, block in reader._event_blocks(f):
+                chunk.append(block)
+                if len(chunk) == chunk_size:
+                    raw_chunks.put((number, chunk))
+                    number += 1
+                    chunk = []
+        if chunk:
+            raw_chunks.put((number, chunk))
+    except Exception as e:
+        raw_chunks.put((None, e))
+    for i in range(n_converters):
+        raw_chunks.put(None)
+
+
+def _convert_chunks(raw_chunks, converted_chunks):
+    """
+    Converter stage of convert_from_LHE: parse raw chunks into
+    LHEventBatches until the end marker comes
+    """
+    while True:
+        item = raw_chunks.get()
+        if item is None:
+            break
+        number, blocks = item
+        if isinstance(blocks, Exception):
+            converted_chunks.put(item)
+            continue
+        try:
+            batch = LHE._parse_event_blocks(blocks)
+        except Exception as e:
+            batch = e
+        converted_chunks.put((number, batch))
+    converted_chunks.put(None)
+
+
+def _check_workers(workers):
+    """Raise if a process of the pipeline has died instead of finishing its work"""
+    for worker in workers:
+        if not worker.is_alive() and worker.exitcode != 0:
+            raise RuntimeError("%s exited with code %s before finishing" % (worker.name, worker.exitcode))
+
+
+def _max_depth(peak, queue):
+    """Update the peak depth of a queue, or return None if it can't be measured"""
+    if peak is None:
+        return None
+    try:
+        return max(peak, queue.qsize())
+    except NotImplementedError:
+        # qsize doesn't work on Mac OS X
+        return None
+
+
+def _stats(n_events, start, peaks):
+    seconds = time.time()-start
+    return ConversionStats(n_events, seconds, n_events/seconds if seconds > 0 else 0.,
+                           peaks[0], peaks[1])
+
+
+__all__ = ['convert_from_LHE', 'convert_LHE_to_columnar', 'LHE_event_to_pyhep', 'LHE_particle_to_pyhep', 'ConversionStats',
+           'pdg_charge', 'PDG_CHARGES']
+
+
+def _test():
+    import doctest
+    doctest.testmod()
 
-    p_out = GenParticle(p4, pdgID=pdgID, status=status)
 
-    return p_out
+if __name__ == '__main__':
+    _test()
@@ -7,7 +7,16 @@ class Event(persistent.Persistent):
     """
     Class representing an event. Just a list of particles and a dict for metadata.
     Intended to be a base class.
+
+    By default each particle and four-vector is stored as its own record when
+    the event is saved in an EventCollection. If inline_particles is set to
+    True, they are instead pickled as plain values inside the event's own
+    record, so the whole event is loaded with a single read. The price is
+    that changes to the particles of an inline event are not noticed
+    automatically; set event._p_changed = True after modifying them.
     """
+    inline_particles = False
+
     def __init__(self, particles=None, metadata=None):
         """Initilialize empty or with a list of particles"""
         if particles is None:
@@ -19,6 +28,19 @@ class Event(persistent.Persistent):
         else:
             self.metadata = metadata
 
+    def __getstate__(self):
+        state = super(Event, self).__getstate__()
+        if state.get('inline_particles'):
+            state = dict(state)
+            state['particles_'] = [_pack(p) for p in state['particles_']]
+        return state
+
+    def __setstate__(self, state):
+        if state.get('inline_particles'):
+            state = dict(state)
+            state['particles_'] = [_unpack(p) for p in state['particles_']]
+        super(Event, self).__setstate__(state)
+
     def particles(self, selection_func=None):
         """
         Return particles in an event, optionally passed through a filter
@@ -54,13 +76,13 @@ class Event(persistent.Persistent):
         """
         Convience method to return only electrons
         """
-        return self.particles_with_pdgId(11)
+        return self.particles_with_pdgID(11)
 
     def muons(self):
         """
         Convenience method to return only muons
         """
-        return self.particles_with_pdgId(13)
+        return self.particles_with_pdgID(13)
 
     def met(self, pdgIDs_to_ignore=[12, 14, 16]):
         """
@@ -78,9 +100,11 @@ class Event(persistent.Persistent):
         >>> e = Event([ele, nu])
         >>> round(e.met().pt, 6)
         22.36068
+        >>> e.met().px
+        -10.0
         """
-        return sum([p.p4 for p in self.particles() if p.pdgID not in pdgIDs_to_ignore],
-                   FourMomentum())
+        return -FourMomentum.sum(p.p4 for p in self.particles_
+                                 if abs(p.pdgID) not in pdgIDs_to_ignore)
 
     def add_particle(self, particle):
         """
@@ -124,8 +148,38 @@ class GenEvent(Event):
         22.36068
         """
         status_filter = functools.partial(_filter_by_status, status=1)
-        return sum([p.p4 for p in self.particles(status_filter) if p.pdgID not in pdgIDs_to_ignore],
-                   FourMomentum())
+        return -FourMomentum.sum(p.p4 for p in self.particles(status_filter)
+                                 if abs(p.pdgID) not in pdgIDs_to_ignore)
+
+
+def _pack(obj):
+    """
+    Convert a persistent object to a (class, state, packed_names) tuple that
+    is pickled inline. Persistent attributes (e.g. a particle's p4) are
+    packed too, and their names listed in packed_names.
+    """
+    state = obj.__getstate__()
+    packed_names = ()
+    if isinstance(state, dict):
+        packed_names = tuple(name for name, value in state.iteritems()
+                             if isinstance(value, persistent.Persistent))
+        if packed_names:
+            state = dict(state)
+            for name in packed_names:
+                state[name] = _pack(state[name])
+    return obj.__class__, state, packed_names
+
+
+def _unpack(packed):
+    """Rebuild an object packed by _pack"""
+    cls, state, packed_names = packed
+    if packed_names:
+        state = dict(state)
+        for name in packed_names:
+            state[name] = _unpack(state[name])
+    obj = cls.__new__(cls)
+    obj.__setstate__(state)
+    return obj
 
 
 def _filter_by_pdgId(particle, pdgId):
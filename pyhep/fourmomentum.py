@@ -1,5 +1,6 @@
 from math import sqrt, sin, cos, tan, atan, atan2, acos, log, exp, pi
 
+import numpy as np
 import persistent
 
 
@@ -43,14 +44,66 @@ class FourMomentum(persistent.Persistent):
 
     Note that under the hood, this class keeps track of the x,y,z, and s
     components, where s is the measure or invariant mass, and is immutable.
-    Everything else is calculated on the fly.
+    Everything else is calculated when it is first asked for and cached
+    until x, y or z change. The cache lives in _v_ slots, which aren't
+    saved to disk and don't mark the object as changed.
     """
+    __slots__ = ('_x', '_y', '_z', '_m',
+                 '_v_p', '_v_pt', '_v_energy', '_v_phi', '_v_theta', '_v_eta')
+
     def __init__(self):
         """Initialize using cartesian coordinates or nothing"""
-        self.x = 0.
-        self.y = 0.
-        self.z = 0.
+        self._x = 0.
+        self._y = 0.
+        self._z = 0.
         self._m = 0.
+        self._invalidate()
+
+    def __getstate__(self):
+        # same layout as before the class had __slots__, so that files stay
+        # readable by older versions
+        return {'x': self._x, 'y': self._y, 'z': self._z, '_m': self._m}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = dict(state[0] or {}, **state[1])
+        self._x = state['x']
+        self._y = state['y']
+        self._z = state['z']
+        self._m = state['_m']
+        self._invalidate()
+
+    def _invalidate(self):
+        """Forget the cached derived quantities"""
+        self._v_p = self._v_pt = self._v_energy = None
+        self._v_phi = self._v_theta = self._v_eta = None
+
+    @property
+    def x(self):
+        return self._x
+
+    @x.setter
+    def x(self, value):
+        self._x = value
+        self._invalidate()
+
+    @property
+    def y(self):
+        return self._y
+
+    @y.setter
+    def y(self, value):
+        self._y = value
+        self._invalidate()
+
+    @property
+    def z(self):
+        return self._z
+
+    @z.setter
+    def z(self, value):
+        self._z = value
+        self._invalidate()
 
     @classmethod
     def from_x_y_z_m(cls, x, y, z, m):
@@ -63,9 +116,9 @@ class FourMomentum(persistent.Persistent):
         40.926764
         """
         p4 = cls()
-        p4.x = x
-        p4.y = y
-        p4.z = z
+        p4._x = x
+        p4._y = y
+        p4._z = z
         p4._m = m
         return p4
 
@@ -79,8 +132,7 @@ class FourMomentum(persistent.Persistent):
         >>> round(p4.mass, 6)
         39.051248
         """
-        m = sqrt(e**2-x**2-y**2-z**2)
-        return cls.from_x_y_z_m(x, y, z, m)
+        return cls.from_x_y_z_m(x, y, z, _mass(x, y, z, e))
 
     @classmethod
     def from_pt_theta_phi_m(cls, pt, theta, phi, m):
@@ -212,7 +264,10 @@ class FourMomentum(persistent.Persistent):
         >>> round(p4.pt, 6)
         24.494897
         """
-        return sqrt(self.x**2+self.y**2+self.z**2)
+        p = self._v_p
+        if p is None:
+            p = self._v_p = sqrt(self._x**2+self._y**2+self._z**2)
+        return p
 
     @p.setter
     def p(self, value):
@@ -224,7 +279,10 @@ class FourMomentum(persistent.Persistent):
     @property
     def energy(self):
         """The energy of the four-vector."""
-        return sqrt(self.mass**2+self.p**2)
+        energy = self._v_energy
+        if energy is None:
+            energy = self._v_energy = sqrt(self._m**2+self.p**2)
+        return energy
 
     @energy.setter
     def energy(self, value):
@@ -273,7 +331,10 @@ class FourMomentum(persistent.Persistent):
         >>> round(p4.phi, 6)
         0.785398
         """
-        return sqrt(self.x**2+self.y**2)
+        pt = self._v_pt
+        if pt is None:
+            pt = self._v_pt = sqrt(self._x**2+self._y**2)
+        return pt
 
     @pt.setter
     def pt(self, value):
@@ -306,7 +367,10 @@ class FourMomentum(persistent.Persistent):
         >>> p4.mass
         40
         """
-        return atan2(self.py, self.px)
+        phi = self._v_phi
+        if phi is None:
+            phi = self._v_phi = atan2(self._y, self._x)
+        return phi
 
     @phi.setter
     def phi(self, value):
@@ -331,7 +395,10 @@ class FourMomentum(persistent.Persistent):
         >>> round(p4.phi, 6)
         0.785398
         """
-        return acos(self.z/self.p)
+        theta = self._v_theta
+        if theta is None:
+            theta = self._v_theta = acos(self._z/self.p)
+        return theta
 
     @theta.setter
     def theta(self, value):
@@ -350,7 +417,10 @@ class FourMomentum(persistent.Persistent):
         >>> p4.eta
         0.6584789484624084
         """
-        return -log(tan(self.theta/2))
+        eta = self._v_eta
+        if eta is None:
+            eta = self._v_eta = -log(tan(self.theta/2))
+        return eta
 
     @eta.setter
     def eta(self, value):
@@ -377,16 +447,54 @@ class FourMomentum(persistent.Persistent):
 
     def __iadd__(self, other):
         """
-        In place add to another FourMomentum
+        In place add to another FourMomentum. This changes the object
+        itself, so any other references to it (e.g. a particle's p4) see
+        the new value; use pa = pa + pb to get a new object instead.
 
         Example:
         >>> pa = FourMomentum.from_x_y_z_e(10,20,30,40)
         >>> pb = FourMomentum.from_x_y_z_e(20,30,40,70)
+        >>> same = pa
         >>> pa += pb
         >>> pa.energy
         110.0
+        >>> same is pa
+        True
+        """
+        self._set_x_y_z_e(self._x+other.x, self._y+other.y, self._z+other.z,
+                          self.energy+other.energy)
+        return self
+
+    def _set_x_y_z_e(self, x, y, z, e):
+        """Change the components in place, given the energy rather than the mass"""
+        self._x = x
+        self._y = y
+        self._z = z
+        self._m = _mass(x, y, z, e)
+        self._invalidate()
+        # so that a chain of += doesn't take a sqrt for the energy each time
+        self._v_energy = e
+
+    @classmethod
+    def sum(cls, p4s):
+        """
+        Sum an iterable of FourMomenta in a single pass, creating only the
+        FourMomentum that is returned. An empty iterable gives a zero
+        four-vector.
+
+        Example:
+        >>> p4s = [FourMomentum.from_x_y_z_e(10,20,30,40), FourMomentum.from_x_y_z_e(20,30,40,70)]
+        >>> total = FourMomentum.sum(p4s)
+        >>> total.px, total.energy
+        (30.0, 110.0)
         """
-        return self + other
+        x = y = z = e = 0.
+        for p4 in p4s:
+            x += p4.x
+            y += p4.y
+            z += p4.z
+            e += p4.energy
+        return cls.from_x_y_z_e(x, y, z, e)
 
     def __neg__(self):
         """
@@ -430,7 +538,10 @@ class FourMomentum(persistent.Persistent):
         >>> pa.px
         -10
         """
-        return self - other
+        # -other keeps the energy of other, see __neg__
+        self._set_x_y_z_e(self._x-other.x, self._y-other.y, self._z-other.z,
+                          self.energy+other.energy)
+        return self
 
     def __mul__(self, scalar):
         """
@@ -460,8 +571,21 @@ class FourMomentum(persistent.Persistent):
         return self*scalar
 
     def __imul__(self, scalar):
-        """Multiply all components by a scalar in place"""
-        return self*scalar
+        """
+        Multiply all components by a scalar in place
+
+        Example:
+        >>> pa = FourMomentum.from_x_y_z_e(10,20,30,40)
+        >>> pa *= 2
+        >>> pa.px, pa.energy
+        (20, 80.0)
+        """
+        self._x *= scalar
+        self._y *= scalar
+        self._z *= scalar
+        self._m *= abs(scalar)
+        self._invalidate()
+        return self
 
     def dot(self, other):
         """
@@ -475,6 +599,134 @@ class FourMomentum(persistent.Persistent):
         """
         return self.energy*other.energy-self.x*other.x-self.y*other.y-self.z*other.z
 
+    @property
+    def mt(self):
+        """
+        The transverse mass of the four-vector, sqrt(E^2-pz^2), which is
+        also sqrt(m^2+pt^2)
+
+        Example:
+        >>> FourMomentum.from_x_y_z_m(3,4,12,10).mt
+        11.180339887498949
+        """
+        return sqrt(self._m**2+self.pt**2)
+
+    def transverse_mass(self, other):
+        """
+        Transverse mass of the system of this and another four-vector,
+        treating both as massless, sqrt(2*pt1*pt2*(1-cos(delta_phi))), as
+        used for W -> l nu with the lepton and the MET.
+
+        Example:
+        >>> lep = FourMomentum.from_x_y_z_m(40,0,10,0)
+        >>> met = FourMomentum.from_x_y_z_m(-40,0,0,0)
+        >>> lep.transverse_mass(met)
+        80.0
+        """
+        return sqrt(2*self.pt*other.pt*(1-cos(self.delta_phi(other))))
+
+    def delta_phi(self, other):
+        """
+        Difference in azimuthal angle to another four-vector, in [-pi, pi)
+
+        Example:
+        >>> pa = FourMomentum.from_x_y_z_m(-10,1,0,0)
+        >>> pb = FourMomentum.from_x_y_z_m(-10,-1,0,0)
+        >>> round(pa.delta_phi(pb), 6)
+        -0.199337
+        """
+        return (self.phi-other.phi+pi) % (2*pi) - pi
+
+    def delta_r(self, other):
+        """
+        Distance to another four-vector in eta-phi space, sqrt(deta^2+dphi^2)
+
+        Example:
+        >>> pa = FourMomentum.from_x_y_z_m(10,0,0,0)
+        >>> pb = FourMomentum.from_x_y_z_m(0,10,0,0)
+        >>> round(pa.delta_r(pb), 6)
+        1.570796
+        """
+        deta = self.eta-other.eta
+        dphi = self.delta_phi(other)
+        return sqrt(deta**2+dphi**2)
+
+    @property
+    def boost_vector(self):
+        """The velocity (px/E, py/E, pz/E) of the four-vector, as a tuple"""
+        energy = self.energy
+        return self._x/energy, self._y/energy, self._z/energy
+
+    def boost(self, bx, by, bz):
+        """
+        Return the four-vector Lorentz-boosted by the velocity (bx, by, bz),
+        in units of c. The mass is unchanged.
+
+        Example:
+        >>> p4 = FourMomentum.from_x_y_z_m(0,0,0,10)
+        >>> moving = p4.boost(0,0,0.6)
+        >>> round(moving.pz, 6), round(moving.energy, 6)
+        (7.5, 12.5)
+        """
+        b2 = bx**2+by**2+bz**2
+        if b2 >= 1:
+            raise ValueError("boost velocity must be less than 1")
+        if b2 == 0:
+            return self.from_x_y_z_m(self._x, self._y, self._z, self._m)
+        gamma = 1/sqrt(1-b2)
+        bp = bx*self._x+by*self._y+bz*self._z
+        scale = (gamma-1)*bp/b2 + gamma*self.energy
+        return self.from_x_y_z_m(self._x+scale*bx, self._y+scale*by, self._z+scale*bz, self._m)
+
+    def boost_to_rest_frame(self, other):
+        """
+        Return the four-vector boosted into the rest frame of another
+        four-vector
+
+        Example:
+        >>> parent = FourMomentum.from_x_y_z_m(0,0,7.5,10)
+        >>> parent.boost_to_rest_frame(parent).pz
+        0.0
+        """
+        bx, by, bz = other.boost_vector
+        return self.boost(-bx, -by, -bz)
+
+    def rotate_x(self, angle):
+        """
+        Return the four-vector rotated by angle about the x axis
+
+        Example:
+        >>> p4 = FourMomentum.from_x_y_z_m(1,2,3,4).rotate_x(pi/2)
+        >>> round(p4.px, 6), round(p4.py, 6), round(p4.pz, 6)
+        (1.0, -3.0, 2.0)
+        """
+        c, s = cos(angle), sin(angle)
+        return self.from_x_y_z_m(self._x, c*self._y-s*self._z, s*self._y+c*self._z, self._m)
+
+    def rotate_y(self, angle):
+        """
+        Return the four-vector rotated by angle about the y axis
+
+        Example:
+        >>> p4 = FourMomentum.from_x_y_z_m(1,2,3,4).rotate_y(pi/2)
+        >>> round(p4.px, 6), round(p4.py, 6), round(p4.pz, 6)
+        (3.0, 2.0, -1.0)
+        """
+        c, s = cos(angle), sin(angle)
+        return self.from_x_y_z_m(c*self._x+s*self._z, self._y, -s*self._x+c*self._z, self._m)
+
+    def rotate_z(self, angle):
+        """
+        Return the four-vector rotated by angle about the z axis
+
+        Example:
+        >>> p4 = FourMomentum.from_x_y_z_m(1,2,3,4).rotate_z(pi/2)
+        >>> round(p4.px, 6), round(p4.py, 6), round(p4.pz, 6)
+        (-2.0, 1.0, 3.0)
+        """
+        c, s = cos(angle), sin(angle)
+        return self.from_x_y_z_m(c*self._x-s*self._y, s*self._x+c*self._y, self._z, self._m)
+
     def __eq__(self, other):
         """
         Compare to another FourMomentum
@@ -500,6 +752,451 @@ class FourMomentum(persistent.Persistent):
         return (round(self.x, 6) == round(other.x, 6)) and (round(self.y, 6) == round(other.y, 6))\
                 and (round(self.z, 6) == round(other.z, 6)) and (round(self._m, 6) == round(other._m, 6))
 
+
+class FourMomentumArray(object):
+    """
+    A column-oriented array of four-vectors. The x, y, z and mass components
+    are each stored in a numpy array, and all of the FourMomentum properties
+    are available, returning arrays instead of numbers. This is much faster
+    than looping over a list of FourMomentum objects when working with large
+    numbers of particles.
+
+    >>> p4s = FourMomentumArray.from_x_y_z_m([50, 30], [60, 20], [70, 10], [10, 40])
+    >>> len(p4s)
+    2
+    >>> p4s.energy.round(6)
+    array([105.356538,  54.772256])
+    >>> (p4s + p4s).pt.round(6)
+    array([156.204994,  72.111026])
+
+    Indexing with an integer returns a FourMomentum, while slices and masks
+    return a new FourMomentumArray.
+
+    >>> p4s[0].px
+    50.0
+    >>> len(p4s[p4s.pt > 50])
+    1
+
+    Unlike FourMomentum, the components are not settable. Build a new array
+    instead.
+    """
+    def __init__(self, x=(), y=(), z=(), m=()):
+        """Initialize from arrays of the cartesian components and the mass"""
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.z = np.asarray(z, dtype=np.float64)
+        self._m = np.asarray(m, dtype=np.float64)
+
+    @classmethod
+    def from_x_y_z_m(cls, x, y, z, m):
+        """
+        Initialize from arrays of three-momentum components and the mass
+
+        Example:
+        >>> p4s = FourMomentumArray.from_x_y_z_m([5], [5], [5], [40])
+        >>> p4s.energy.round(6)
+        array([40.926764])
+        """
+        return cls(x, y, z, m)
+
+    @classmethod
+    def from_x_y_z_e(cls, x, y, z, e):
+        """
+        Initialize from arrays of three-momentum components and the energy.
+        Slightly negative values of the mass squared, which come from rounding
+        errors for massless particles, are clipped to zero.
+
+        Example:
+        >>> p4s = FourMomentumArray.from_x_y_z_e([5], [5], [5], [40])
+        >>> p4s.mass.round(6)
+        array([39.051248])
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        z = np.asarray(z, dtype=np.float64)
+        e = np.asarray(e, dtype=np.float64)
+        m = np.sqrt(np.maximum(e**2-x**2-y**2-z**2, 0.))
+        return cls(x, y, z, m)
+
+    @classmethod
+    def from_pt_theta_phi_m(cls, pt, theta, phi, m):
+        """
+        Initialize from arrays of transverse momentum, angles, and the mass
+
+        Example:
+        >>> p4s = FourMomentumArray.from_pt_theta_phi_m([30], [1], [3], [40])
+        >>> p4s.theta.round(6)
+        array([1.])
+        """
+        pt = np.asarray(pt, dtype=np.float64)
+        phi = np.asarray(phi, dtype=np.float64)
+        return cls(pt*np.cos(phi), pt*np.sin(phi), pt/np.tan(theta), m)
+
+    @classmethod
+    def from_pt_theta_phi_e(cls, pt, theta, phi, e):
+        """
+        Initialize from arrays of transverse momentum, angles, and the energy
+
+        Example:
+        >>> p4s = FourMomentumArray.from_pt_theta_phi_e([30], [1], [3], [60])
+        >>> p4s.energy.round(6)
+        array([60.])
+        """
+        pt = np.asarray(pt, dtype=np.float64)
+        phi = np.asarray(phi, dtype=np.float64)
+        return cls.from_x_y_z_e(pt*np.cos(phi), pt*np.sin(phi), pt/np.tan(theta), e)
+
+    @classmethod
+    def from_pt_eta_phi_m(cls, pt, eta, phi, m):
+        """
+        Initialize from arrays of transverse momentum, pseudo-rapidity,
+        azimuthal angle and the mass
+
+        Example:
+        >>> p4s = FourMomentumArray.from_pt_eta_phi_m([30], [1], [0.5], [40])
+        >>> p4s.eta.round(6)
+        array([1.])
+        >>> p4s.phi.round(6)
+        array([0.5])
+        """
+        pt = np.asarray(pt, dtype=np.float64)
+        phi = np.asarray(phi, dtype=np.float64)
+        return cls(pt*np.cos(phi), pt*np.sin(phi), pt*np.sinh(eta), m)
+
+    @classmethod
+    def from_pt_eta_phi_e(cls, pt, eta, phi, e):
+        """
+        Initialize from arrays of transverse momentum, pseudo-rapidity,
+        azimuthal angle and the energy
+
+        Example:
+        >>> p4s = FourMomentumArray.from_pt_eta_phi_e([30], [1], [0.5], [60])
+        >>> p4s.mass.round(6)
+        array([38.170826])
+        """
+        pt = np.asarray(pt, dtype=np.float64)
+        phi = np.asarray(phi, dtype=np.float64)
+        return cls.from_x_y_z_e(pt*np.cos(phi), pt*np.sin(phi), pt*np.sinh(eta), e)
+
+    @classmethod
+    def from_list(cls, p4s):
+        """
+        Initialize from a list of FourMomentum objects
+
+        Example:
+        >>> p4s = FourMomentumArray.from_list([FourMomentum.from_x_y_z_m(5,5,5,40)])
+        >>> p4s.px
+        array([5.])
+        """
+        n = len(p4s)
+        x = np.fromiter((p.x for p in p4s), np.float64, n)
+        y = np.fromiter((p.y for p in p4s), np.float64, n)
+        z = np.fromiter((p.z for p in p4s), np.float64, n)
+        m = np.fromiter((p._m for p in p4s), np.float64, n)
+        return cls(x, y, z, m)
+
+    def to_list(self):
+        """
+        Return a list of FourMomentum objects
+
+        Example:
+        >>> p4s = FourMomentumArray.from_x_y_z_m([5], [5], [5], [40])
+        >>> p4s.to_list()[0] == FourMomentum.from_x_y_z_m(5,5,5,40)
+        True
+        """
+        return [FourMomentum.from_x_y_z_m(x, y, z, m) for x, y, z, m in
+                zip(self.x.tolist(), self.y.tolist(), self.z.tolist(), self._m.tolist())]
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        """
+        Return a FourMomentum for an integer index, or a FourMomentumArray
+        for a slice, index array or boolean mask.
+        """
+        if isinstance(index, (int, long, np.integer)):
+            return FourMomentum.from_x_y_z_m(float(self.x[index]), float(self.y[index]),
+                                             float(self.z[index]), float(self._m[index]))
+        return FourMomentumArray(self.x[index], self.y[index], self.z[index], self._m[index])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    @property
+    def px(self):
+        """The x components of the momenta"""
+        return self.x
+
+    @property
+    def py(self):
+        """The y components of the momenta"""
+        return self.y
+
+    @property
+    def pz(self):
+        """The z components of the momenta"""
+        return self.z
+
+    @property
+    def mass(self):
+        """The invariant masses"""
+        return self._m
+
+    @property
+    def p(self):
+        """The magnitudes of the three-momenta"""
+        return np.sqrt(self.x**2+self.y**2+self.z**2)
+
+    @property
+    def energy(self):
+        """The energies"""
+        return np.sqrt(self._m**2+self.x**2+self.y**2+self.z**2)
+
+    @property
+    def pt(self):
+        """The transverse momenta"""
+        return np.hypot(self.x, self.y)
+
+    @property
+    def phi(self):
+        """The azimuthal angles in the x-y plane"""
+        return np.arctan2(self.y, self.x)
+
+    @property
+    def theta(self):
+        """The polar angles"""
+        return np.arctan2(self.pt, self.z)
+
+    @property
+    def eta(self):
+        """
+        The pseudo-rapidities
+
+        Example:
+        >>> p4s = FourMomentumArray.from_x_y_z_m([5], [5], [5], [40])
+        >>> p4s.eta.round(6)
+        array([0.658479])
+        """
+        return np.arcsinh(self.z/self.pt)
+
+    def __add__(self, other):
+        """
+        Elementwise addition with another FourMomentumArray (or a FourMomentum)
+
+        Example:
+        >>> pa = FourMomentumArray.from_x_y_z_e([10], [20], [30], [40])
+        >>> pb = FourMomentumArray.from_x_y_z_e([20], [30], [40], [70])
+        >>> (pa+pb).px
+        array([30.])
+        >>> (pa+pb).energy
+        array([110.])
+        """
+        return self.from_x_y_z_e(self.x+other.x, self.y+other.y, self.z+other.z,
+                                 self.energy+other.energy)
+
+    def __neg__(self):
+        """Negative of all space-like components"""
+        return FourMomentumArray(-self.x, -self.y, -self.z, self._m)
+
+    def __sub__(self, other):
+        """
+        Elementwise subtraction of another FourMomentumArray (or a FourMomentum)
+
+        Example:
+        >>> pa = FourMomentumArray.from_x_y_z_e([10], [20], [30], [40])
+        >>> pb = FourMomentumArray.from_x_y_z_e([20], [30], [40], [70])
+        >>> (pa-pb).px
+        array([-10.])
+        """
+        return self + -other
+
+    def __mul__(self, scalar):
+        """
+        Multiply all components by a scalar or an array of scalars
+
+        Example:
+        >>> pa = FourMomentumArray.from_x_y_z_e([10, 10], [20, 20], [30, 30], [40, 40])
+        >>> (pa*[1, 2]).energy
+        array([40., 80.])
+        """
+        scalar = np.asarray(scalar, dtype=np.float64)
+        return self.from_x_y_z_e(self.x*scalar, self.y*scalar, self.z*scalar, self.energy*scalar)
+
+    def __rmul__(self, scalar):
+        """Multiply all components by a scalar or an array of scalars"""
+        return self*scalar
+
+    def sum(self):
+        """
+        Sum of all of the four-vectors, as a FourMomentum
+
+        Example:
+        >>> pa = FourMomentumArray.from_x_y_z_e([10, 20], [20, 30], [30, 40], [40, 70])
+        >>> pa.sum().energy
+        110.0
+        """
+        return FourMomentum.from_x_y_z_e(float(self.x.sum()), float(self.y.sum()),
+                                         float(self.z.sum()), float(self.energy.sum()))
+
+    def dot(self, other):
+        """
+        Elementwise scalar product with another FourMomentumArray (or a FourMomentum)
+
+        Example:
+        >>> pa = FourMomentumArray.from_x_y_z_e([10], [20], [30], [40])
+        >>> pb = FourMomentumArray.from_x_y_z_e([20], [30], [40], [70])
+        >>> pa.dot(pb)
+        array([800.])
+        """
+        return self.energy*other.energy-self.x*other.x-self.y*other.y-self.z*other.z
+
+    @property
+    def mt(self):
+        """The transverse masses, sqrt(E^2-pz^2)"""
+        return np.sqrt(self._m**2+self.x**2+self.y**2)
+
+    def transverse_mass(self, other):
+        """
+        Elementwise transverse mass of the systems of these four-vectors and
+        another FourMomentumArray (or a FourMomentum), treating both as
+        massless. See FourMomentum.transverse_mass.
+
+        Example:
+        >>> lep = FourMomentumArray.from_x_y_z_m([40, 30], [0, 0], [10, 10], [0, 0])
+        >>> lep.transverse_mass(FourMomentum.from_x_y_z_m(-40,0,0,0))
+        array([80.       , 69.2820323])
+        """
+        return np.sqrt(2*self.pt*other.pt*(1-np.cos(self.delta_phi(other))))
+
+    def delta_phi(self, other):
+        """
+        Elementwise difference in azimuthal angle to another
+        FourMomentumArray (or a FourMomentum), in [-pi, pi)
+        """
+        return np.mod(self.phi-other.phi+np.pi, 2*np.pi) - np.pi
+
+    def delta_r(self, other):
+        """
+        Elementwise distance in eta-phi space to another FourMomentumArray
+        (or a FourMomentum)
+
+        Example:
+        >>> pa = FourMomentumArray.from_x_y_z_m([10, 10], [0, 0], [0, 0], [0, 0])
+        >>> pb = FourMomentumArray.from_x_y_z_m([0, -10], [10, 0], [0, 0], [0, 0])
+        >>> pa.delta_r(pb).round(6)
+        array([1.570796, 3.141593])
+        """
+        return np.hypot(self.eta-other.eta, self.delta_phi(other))
+
+    def delta_r_matrix(self, other=None):
+        """
+        Matrix of the distances in eta-phi space between every four-vector
+        in this array (rows) and every one in other (columns), or between
+        all pairs in this array if other isn't given
+
+        Example:
+        >>> p4s = FourMomentumArray.from_x_y_z_m([10, 0], [0, 10], [0, 0], [0, 0])
+        >>> p4s.delta_r_matrix().round(6)
+        array([[0.      , 1.570796],
+               [1.570796, 0.      ]])
+        """
+        if other is None:
+            other = self
+        deta = self.eta[:, np.newaxis] - other.eta[np.newaxis, :]
+        dphi = np.mod(self.phi[:, np.newaxis] - other.phi[np.newaxis, :] + np.pi, 2*np.pi) - np.pi
+        return np.hypot(deta, dphi)
+
+    def mass_matrix(self, other=None):
+        """
+        Matrix of the invariant masses of every four-vector in this array
+        (rows) added to every one in other (columns), or of all pairs in
+        this array if other isn't given
+
+        Example:
+        >>> p4s = FourMomentumArray.from_x_y_z_m([10, -10], [0, 0], [0, 0], [0, 0])
+        >>> p4s.mass_matrix()
+        array([[ 0., 20.],
+               [20.,  0.]])
+        """
+        if other is None:
+            other = self
+        e = self.energy[:, np.newaxis] + other.energy[np.newaxis, :]
+        x = self.x[:, np.newaxis] + other.x[np.newaxis, :]
+        y = self.y[:, np.newaxis] + other.y[np.newaxis, :]
+        z = self.z[:, np.newaxis] + other.z[np.newaxis, :]
+        return np.sqrt(np.maximum(e**2-x**2-y**2-z**2, 0))
+
+    @property
+    def boost_vector(self):
+        """The velocities (px/E, py/E, pz/E), as a tuple of arrays"""
+        energy = self.energy
+        return self.x/energy, self.y/energy, self.z/energy
+
+    def boost(self, bx, by, bz):
+        """
+        Return the four-vectors Lorentz-boosted by the velocity (bx, by, bz),
+        which can be numbers or arrays with a velocity for each four-vector
+
+        Example:
+        >>> p4s = FourMomentumArray.from_x_y_z_m([0, 0], [0, 0], [0, 0], [10, 20])
+        >>> p4s.boost(0, 0, [0.6, 0]).pz
+        array([7.5, 0. ])
+        """
+        bx, by, bz = [np.asarray(b, dtype=np.float64) for b in (bx, by, bz)]
+        b2 = bx**2+by**2+bz**2
+        if np.any(b2 >= 1):
+            raise ValueError("boost velocity must be less than 1")
+        gamma = 1/np.sqrt(1-b2)
+        bp = bx*self.x+by*self.y+bz*self.z
+        # (gamma-1)/b2 goes to 1/2 as b2 goes to 0
+        safe_b2 = np.where(b2 > 0, b2, 1)
+        gamma2 = np.where(b2 > 0, (gamma-1)/safe_b2, 0.5)
+        scale = gamma2*bp + gamma*self.energy
+        return FourMomentumArray(self.x+scale*bx, self.y+scale*by, self.z+scale*bz, self._m)
+
+    def boost_to_rest_frame(self, other):
+        """
+        Return the four-vectors boosted into the rest frame(s) of another
+        FourMomentumArray (elementwise) or of a FourMomentum
+        """
+        bx, by, bz = other.boost_vector
+        return self.boost(-np.asarray(bx), -np.asarray(by), -np.asarray(bz))
+
+    def rotate_x(self, angle):
+        """Return the four-vectors rotated by angle (a number or an array) about the x axis"""
+        c, s = np.cos(angle), np.sin(angle)
+        return FourMomentumArray(self.x, c*self.y-s*self.z, s*self.y+c*self.z, self._m)
+
+    def rotate_y(self, angle):
+        """Return the four-vectors rotated by angle (a number or an array) about the y axis"""
+        c, s = np.cos(angle), np.sin(angle)
+        return FourMomentumArray(c*self.x+s*self.z, self.y, -s*self.x+c*self.z, self._m)
+
+    def rotate_z(self, angle):
+        """Return the four-vectors rotated by angle (a number or an array) about the z axis"""
+        c, s = np.cos(angle), np.sin(angle)
+        return FourMomentumArray(c*self.x-s*self.y, s*self.x+c*self.y, self.z, self._m)
+
+
+# how much e**2 may fall short of p**2, relative to e**2, and still be
+# taken as rounding of a massless four-vector
+_MASS2_TOLERANCE = 1e-9
+
+
+def _mass(x, y, z, e):
+    """
+    Mass from the three-momentum and energy. Slightly negative squared
+    masses, from rounding, give 0; an energy clearly smaller than the
+    momentum is an error.
+    """
+    m2 = e**2-x**2-y**2-z**2
+    if m2 < 0:
+        if m2 < -_MASS2_TOLERANCE*e**2:
+            raise ValueError("energy %g is smaller than the momentum %g" % (e, sqrt(x**2+y**2+z**2)))
+        return 0.
+    return sqrt(m2)
 def _test():
     import doctest
     doctest.testmod()
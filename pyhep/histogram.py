@@ -0,0 +1,336 @@
+import numpy as np
+
+
+class Axis(object):
+    """
+    Binning along one axis of a histogram: either nbins equal bins between
+    low and high, or arbitrary bin edges.
+
+    Example:
+    >>> Axis(4, 0, 2).edges
+    array([0. , 0.5, 1. , 1.5, 2. ])
+    >>> Axis([0, 1, 10]).nbins
+    2
+    """
+    def __init__(self, bins, low=None, high=None):
+        """
+        Arguments:
+        bins - number of bins if low and high are given, otherwise a
+        sequence of increasing bin edges
+        low, high - range of the axis for equal-width bins
+        """
+        if low is not None or high is not None:
+            if low is None or high is None or not high > low:
+                raise ValueError("need both low < high for equal-width bins")
+            self.fixed = (int(bins), float(low), float(high))
+            self.edges = np.linspace(low, high, int(bins)+1)
+        else:
+            self.fixed = None
+            self.edges = np.asarray(bins, dtype=np.float64)
+            if self.edges.ndim != 1 or len(self.edges) < 2 or np.any(np.diff(self.edges) <= 0):
+                raise ValueError("bin edges must be an increasing sequence of at least two values")
+
+    def __eq__(self, other):
+        return isinstance(other, Axis) and np.array_equal(self.edges, other.edges)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        # equal-width axes only need their three numbers
+        return self.fixed if self.fixed is not None else self.edges
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            self.__init__(*state)
+        else:
+            self.__init__(state)
+
+    @property
+    def nbins(self):
+        """Number of bins, not counting underflow and overflow"""
+        return len(self.edges)-1
+
+    @property
+    def centers(self):
+        """Bin centers"""
+        return 0.5*(self.edges[1:]+self.edges[:-1])
+
+    @property
+    def widths(self):
+        """Bin widths"""
+        return np.diff(self.edges)
+
+    def index(self, x):
+        """
+        Bin number of each value in x, with 0 for underflow and nbins+1 for
+        overflow. Bins include their lower edge, and the upper edge of the
+        last bin counts as overflow. NaN goes to overflow.
+
+        Example:
+        >>> Axis(4, 0, 2).index([-1, 0, 0.7, 2])
+        array([0, 1, 2, 5])
+        """
+        return np.searchsorted(self.edges, x, side='right')
+
+
+class _Histogram(object):
+    """
+    Common code for histograms. Subclasses set up _sumw (the sum of weights
+    in each bin, including under- and overflow bins), _sumw2 and entries,
+    and list their axes in _axes.
+    """
+    def _fill(self, index, weight, n):
+        """Add weights to the bins with the given flat indices"""
+        size = self._sumw.size
+        shape = self._sumw.shape
+        if weight is None:
+            counts = np.bincount(index, minlength=size).reshape(shape)
+            self._sumw += counts
+            if self._sumw2 is not None:
+                self._sumw2 += counts
+        else:
+            weight = np.broadcast_to(np.asarray(weight, dtype=np.float64), (n,))
+            if self._sumw2 is None:
+                if np.all(weight == 1):
+                    self._fill(index, None, n)
+                    return
+                self._sumw2 = self._sumw.copy()
+            self._sumw += np.bincount(index, weights=weight, minlength=size).reshape(shape)
+            self._sumw2 += np.bincount(index, weights=weight*weight, minlength=size).reshape(shape)
+        self.entries += n
+
+    def _axes(self):
+        raise NotImplementedError
+
+    def __iadd__(self, other):
+        if type(other) is not type(self) or self._axes() != other._axes():
+            raise ValueError("can only add histograms with the same binning")
+        if self._sumw2 is not None or other._sumw2 is not None:
+            self._sumw2 = self.sumw2_with_flow + other.sumw2_with_flow
+        self._sumw = self._sumw + other._sumw
+        self.entries += other.entries
+        return self
+
+    def __add__(self, other):
+        result = self.copy()
+        result += other
+        return result
+
+    def __radd__(self, other):
+        # lets sum() start from 0
+        if isinstance(other, int) and other == 0:
+            return self.copy()
+        return NotImplemented
+
+    def copy(self):
+        """Return an independent copy of the histogram"""
+        result = object.__new__(type(self))
+        result.__setstate__(self.__getstate__())
+        result._sumw = self._sumw.copy()
+        if self._sumw2 is not None:
+            result._sumw2 = self._sumw2.copy()
+        return result
+
+    @property
+    def sumw_with_flow(self):
+        """Sum of weights in each bin, including underflow and overflow"""
+        return self._sumw
+
+    @property
+    def sumw2_with_flow(self):
+        """Sum of squared weights in each bin, including underflow and overflow"""
+        return self._sumw if self._sumw2 is None else self._sumw2
+
+    @property
+    def errors(self):
+        """Statistical uncertainty of each bin, sqrt(sum of squared weights)"""
+        return np.sqrt(self.sumw2)
+
+    def integral(self, flow=False):
+        """Sum of weights in all bins, optionally including under- and overflow"""
+        return self._sumw.sum() if flow else self.values.sum()
+
+
+class Hist1D(_Histogram):
+    """
+    One-dimensional histogram of (optionally weighted) values.
+
+    The histogram only stores the sum of weights and the sum of squared
+    weights of each bin, so filling it takes constant memory however many
+    values go in. Values can be filled one at a time or as arrays, and
+    histograms with the same binning can be added together, e.g. to merge
+    results from map_reduce.
+
+    Example:
+    >>> h = Hist1D(4, 0, 2)
+    >>> h.fill(0.2)
+    >>> h.fill([0.7, 0.8, 1.9, 5.])
+    >>> h.values
+    array([1., 2., 0., 1.])
+    >>> h.overflow
+    1.0
+    >>> (h+h).values
+    array([2., 4., 0., 2.])
+    >>> h.fill(1.2, weight=3)
+    >>> h.errors
+    array([1.        , 1.41421356, 3.        , 1.        ])
+    """
+    def __init__(self, bins, low=None, high=None):
+        """
+        Arguments:
+        bins - number of bins if low and high are given, otherwise a
+        sequence of bin edges
+        low, high - range of the histogram for equal-width bins
+        """
+        self.axis = Axis(bins, low, high)
+        self._sumw = np.zeros(self.axis.nbins+2)
+        # only kept once a weight other than 1 has been filled
+        self._sumw2 = None
+        self.entries = 0
+
+    def __getstate__(self):
+        return (self.axis, self._sumw, self._sumw2, self.entries)
+
+    def __setstate__(self, state):
+        self.axis, self._sumw, self._sumw2, self.entries = state
+
+    def _axes(self):
+        return [self.axis]
+
+    def fill(self, x, weight=None):
+        """
+        Fill the histogram with a value or an array of values.
+
+        Arguments:
+        x - value or array of values
+        weight - weight, or array of weights the same length as x. Each
+        value counts once if not given.
+        """
+        x = np.asarray(x, dtype=np.float64).ravel()
+        self._fill(self.axis.index(x), weight, len(x))
+
+    @property
+    def edges(self):
+        return self.axis.edges
+
+    @property
+    def centers(self):
+        return self.axis.centers
+
+    @property
+    def values(self):
+        """Sum of weights in each bin"""
+        return self._sumw[1:-1]
+
+    @property
+    def sumw2(self):
+        """Sum of squared weights in each bin"""
+        return self.sumw2_with_flow[1:-1]
+
+    @property
+    def underflow(self):
+        return self._sumw[0]
+
+    @property
+    def overflow(self):
+        return self._sumw[-1]
+
+    def plot(self, ax=None, **kwargs):
+        """
+        Draw the histogram with matplotlib. Keyword arguments are passed to
+        matplotlib's hist.
+        """
+        if ax is None:
+            import matplotlib.pyplot as plt
+            ax = plt.gca()
+        kwargs.setdefault('histtype', 'step')
+        return ax.hist(self.centers, bins=self.edges, weights=self.values, **kwargs)
+
+
+class Hist2D(_Histogram):
+    """
+    Two-dimensional histogram of (optionally weighted) pairs of values.
+    Works like Hist1D, with the bin contents indexed as [x bin, y bin].
+
+    Example:
+    >>> h = Hist2D(2, 2, xlow=0, xhigh=2, ylow=0, yhigh=1)
+    >>> h.fill([0.5, 1.5, 1.5], [0.2, 0.7, 0.8])
+    >>> h.values
+    array([[1., 0.],
+           [0., 2.]])
+    """
+    def __init__(self, xbins, ybins, xlow=None, xhigh=None, ylow=None, yhigh=None):
+        """
+        Arguments:
+        xbins, ybins - number of bins along each axis if the corresponding
+        low and high are given, otherwise sequences of bin edges
+        xlow, xhigh, ylow, yhigh - ranges of the axes for equal-width bins
+        """
+        self.xaxis = Axis(xbins, xlow, xhigh)
+        self.yaxis = Axis(ybins, ylow, yhigh)
+        self._sumw = np.zeros((self.xaxis.nbins+2, self.yaxis.nbins+2))
+        self._sumw2 = None
+        self.entries = 0
+
+    def __getstate__(self):
+        return (self.xaxis, self.yaxis, self._sumw, self._sumw2, self.entries)
+
+    def __setstate__(self, state):
+        self.xaxis, self.yaxis, self._sumw, self._sumw2, self.entries = state
+
+    def _axes(self):
+        return [self.xaxis, self.yaxis]
+
+    def fill(self, x, y, weight=None):
+        """
+        Fill the histogram with a pair of values or arrays of values.
+
+        Arguments:
+        x, y - values or arrays of values of the same length
+        weight - weight, or array of weights the same length as x. Each
+        pair counts once if not given.
+        """
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64).ravel()
+        if len(x) != len(y):
+            raise ValueError("x and y must have the same length")
+        index = self.xaxis.index(x)*(self.yaxis.nbins+2) + self.yaxis.index(y)
+        self._fill(index, weight, len(x))
+
+    @property
+    def edges(self):
+        return self.xaxis.edges, self.yaxis.edges
+
+    @property
+    def centers(self):
+        return self.xaxis.centers, self.yaxis.centers
+
+    @property
+    def values(self):
+        return self._sumw[1:-1, 1:-1]
+
+    @property
+    def sumw2(self):
+        return self.sumw2_with_flow[1:-1, 1:-1]
+
+    def plot(self, ax=None, **kwargs):
+        """
+        Draw the histogram with matplotlib. Keyword arguments are passed to
+        matplotlib's pcolormesh.
+        """
+        if ax is None:
+            import matplotlib.pyplot as plt
+            ax = plt.gca()
+        return ax.pcolormesh(self.xaxis.edges, self.yaxis.edges, self.values.T, **kwargs)
+
+
+__all__ = ['Axis', 'Hist1D', 'Hist2D']
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
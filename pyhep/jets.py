@@ -0,0 +1,235 @@
+from math import atan2, floor, log, pi
+
+import numpy as np
+
+from fourmomentum import FourMomentum, FourMomentumArray
+from particles import Particle
+
+# exponent of kt in the distance measure of each algorithm
+ALGORITHMS = {'kt': 1, 'cambridge_aachen': 0, 'ca': 0, 'antikt': -1}
+
+# rapidity given to particles along the beam (pt = 0), which would
+# otherwise have an infinite rapidity
+MAX_RAPIDITY = 1e5
+
+_KT2P_MIN = np.finfo(np.float64).tiny
+_KT2P_MAX = np.finfo(np.float64).max
+
+
+class Jet(Particle):
+    """
+    Jet from clustering a list of particles. A Particle with pdgID 0, the
+    summed charge of its constituents, and the indices of the constituents
+    in the list that was clustered.
+
+    Example:
+    >>> jet = Jet(FourMomentum.from_x_y_z_m(10,20,30,5), 1, [0, 3])
+    >>> jet.constituents
+    [0, 3]
+    """
+    def __init__(self, p4, charge, constituents):
+        """
+        Arguments:
+        p4 - the jet's 4-momentum
+        charge - summed charge of the constituents
+        constituents - list of the indices of the clustered particles
+        """
+        super(Jet, self).__init__(p4, 0, charge)
+        self.constituents = constituents
+
+
+def cluster(particles, R=0.4, algorithm='antikt', ptmin=0.):
+    """
+    Cluster particles into jets with a sequential recombination algorithm,
+    adding four-momenta when two pseudojets are merged (E scheme), and
+    return the jets with pt > ptmin ordered by decreasing pt.
+
+    Rather than comparing all pairs of pseudojets at every step, the
+    pseudojets are kept in tiles of the rapidity-phi plane at least R wide,
+    and each one keeps track of its nearest neighbour within R, which can
+    only be in the same or one of the 8 surrounding tiles. The pair with
+    the smallest distance is always a pseudojet and its nearest neighbour
+    (a pair further apart than R never beats the beam distance of both of
+    its members), so after a merge only a few neighbours near the merged
+    pseudojets need to be looked at again.
+
+    Arguments:
+    particles - list of Particles (e.g. from Event.particles), list of
+    FourMomenta or a FourMomentumArray
+    R - jet radius
+    algorithm - 'antikt', 'kt' or 'cambridge_aachen' (or 'ca')
+    ptmin - minimum transverse momentum of the jets returned
+
+    Example:
+    >>> from particles import GenParticle
+    >>> from event import GenEvent
+    >>> def particle(x, y, z, status=1):
+    ...     return GenParticle(FourMomentum.from_x_y_z_m(x, y, z, 0), 211, 1, status)
+    >>> event = GenEvent([particle(50, 0, 0), particle(4, 1, 0),
+    ...                   particle(0, 30, 20), particle(100, 0, 0, status=3)])
+    >>> jets = cluster(event.particles(lambda p: p.status == 1), R=0.4)
+    >>> [round(jet.p4.pt, 3) for jet in jets]
+    [54.009, 30.0]
+    >>> [jet.constituents for jet in jets]
+    [[0, 1], [2]]
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError("unknown algorithm %r, expected one of %s" % (algorithm, sorted(ALGORITHMS)))
+    p = ALGORITHMS[algorithm]
+    charges = None
+    if isinstance(particles, FourMomentumArray):
+        p4s = particles
+    else:
+        particles = list(particles)
+        if particles and hasattr(particles[0], 'p4'):
+            charges = [particle.charge for particle in particles]
+            particles = [particle.p4 for particle in particles]
+        p4s = FourMomentumArray.from_list(particles)
+
+    n = len(p4s)
+    rapidity, phi, kt2p = [x.tolist() for x in _geometry(p4s.px, p4s.py, p4s.pz, p4s.energy, p)]
+    px, py, pz, e = p4s.px.tolist(), p4s.py.tolist(), p4s.pz.tolist(), p4s.energy.tolist()
+    constituents = [[i] for i in range(n)]
+    R2 = R*R
+    two_pi = 2*pi
+
+    n_phi = max(1, int(two_pi / R))
+    # with fewer than three phi tiles, neighbours would repeat
+    phi_steps = sorted(set([-1 % n_phi, 0, 1 % n_phi]))
+    tiles = {}
+    tile_of = [None]*n
+
+    def add_to_tile(i):
+        tile = (int(floor(rapidity[i] / R)), int((phi[i]+pi) * n_phi / two_pi) % n_phi)
+        tile_of[i] = tile
+        tiles.setdefault(tile, []).append(i)
+
+    def near(tile):
+        """The pseudojets in a tile and the tiles around it"""
+        iy, iphi = tile
+        result = []
+        for dy in (-1, 0, 1):
+            for dphi in phi_steps:
+                result.extend(tiles.get((iy+dy, (iphi+dphi) % n_phi), ()))
+        return result
+
+    # nearest neighbour of each pseudojet within R, or -1, and the squared
+    # distance to it
+    nn = [-1]*n
+    nn_dist = [R2]*n
+    # the smaller of the beam distance and the distance to the nearest
+    # neighbour of each pseudojet, inf once it is gone
+    d = np.full(n, np.inf)
+
+    def find_neighbour(i):
+        best, best_dist = -1, R2
+        y, f = rapidity[i], phi[i]
+        for k in near(tile_of[i]):
+            dphi = abs(f - phi[k])
+            if dphi > pi:
+                dphi = two_pi - dphi
+            dist = (y - rapidity[k])**2 + dphi*dphi
+            if dist < best_dist and k != i:
+                best, best_dist = k, dist
+        nn[i] = best
+        nn_dist[i] = best_dist
+        update_distance(i)
+
+    def update_distance(i):
+        j = nn[i]
+        if j < 0:
+            d[i] = kt2p[i]
+        else:
+            d[i] = min(kt2p[i], min(kt2p[i], kt2p[j])*nn_dist[i]/R2)
+
+    for i in range(n):
+        add_to_tile(i)
+    for i in range(n):
+        find_neighbour(i)
+
+    jets = []
+    for step in range(n):
+        i = int(d.argmin())
+        j = nn[i]
+        old_tile = tile_of[i]
+        tiles[old_tile].remove(i)
+        d[i] = np.inf
+        if j < 0 or kt2p[i] <= min(kt2p[i], kt2p[j])*nn_dist[i]/R2:
+            # i doesn't merge with anything any more, it's a jet
+            jets.append((px[i], py[i], pz[i], e[i], constituents[i]))
+            stale = [k for k in near(old_tile) if nn[k] == i]
+        else:
+            # merge j into i
+            tiles[tile_of[j]].remove(j)
+            d[j] = np.inf
+            px[i] += px[j]
+            py[i] += py[j]
+            pz[i] += pz[j]
+            e[i] += e[j]
+            constituents[i].extend(constituents[j])
+            rapidity[i], phi[i], kt2p[i] = _scalar_geometry(px[i], py[i], pz[i], e[i], p)
+            stale = set(k for k in near(old_tile) + near(tile_of[j]) if nn[k] == i or nn[k] == j)
+            stale.add(i)
+            add_to_tile(i)
+            # the merged pseudojet may be the new nearest neighbour of others
+            y, f = rapidity[i], phi[i]
+            for k in near(tile_of[i]):
+                dphi = abs(f - phi[k])
+                if dphi > pi:
+                    dphi = two_pi - dphi
+                dist = (y - rapidity[k])**2 + dphi*dphi
+                if dist < nn_dist[k] and k not in stale:
+                    nn[k] = i
+                    nn_dist[k] = dist
+                    update_distance(k)
+        for k in stale:
+            find_neighbour(k)
+
+    result = []
+    for x, y, z, energy, indices in jets:
+        if x*x+y*y <= ptmin*ptmin:
+            continue
+        charge = 0 if charges is None else sum(charges[k] for k in indices)
+        # rounding can make e**2 slightly smaller than p**2 for massless jets
+        mass = np.sqrt(max(energy*energy - x*x - y*y - z*z, 0.))
+        result.append(Jet(FourMomentum.from_x_y_z_m(float(x), float(y), float(z), float(mass)),
+                          charge, sorted(indices)))
+    result.sort(key=lambda jet: -jet.p4.pt)
+    return result
+
+
+def _geometry(px, py, pz, e, p):
+    """Rapidity, phi and kt**(2p) of arrays of four-momenta"""
+    pt2 = px*px + py*py
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rapidity = 0.5*np.log((e+pz)/(e-pz))
+        kt2p = pt2**p
+    rapidity = np.where(np.isfinite(rapidity), rapidity, np.sign(pz)*MAX_RAPIDITY)
+    rapidity = np.clip(rapidity, -MAX_RAPIDITY, MAX_RAPIDITY)
+    # keep kt**(2p) finite and non-zero for pt = 0: inf is used for
+    # pseudojets that are gone, and 0 times an infinite distance is nan
+    kt2p = np.clip(kt2p, _KT2P_MIN, _KT2P_MAX)
+    return rapidity, np.arctan2(py, px), kt2p
+
+
+def _scalar_geometry(px, py, pz, e, p):
+    """_geometry for a single four-momentum, without the numpy overhead"""
+    pt2 = px*px + py*py
+    if e > abs(pz):
+        rapidity = max(-MAX_RAPIDITY, min(MAX_RAPIDITY, 0.5*log((e+pz)/(e-pz))))
+    else:
+        rapidity = MAX_RAPIDITY if pz > 0 else -MAX_RAPIDITY
+    kt2p = pt2**p if pt2 > 0 or p == 0 else (_KT2P_MAX if p < 0 else _KT2P_MIN)
+    return rapidity, atan2(py, px), min(max(kt2p, _KT2P_MIN), _KT2P_MAX)
+
+
+__all__ = ['Jet', 'cluster']
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
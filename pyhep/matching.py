@@ -0,0 +1,200 @@
+import numpy as np
+
+from batch import EventBatch
+
+# |eta| is clipped to this before matching, so that particles along the
+# beam (pt = 0, eta = +-inf) still land in a grid cell
+MAX_ETA = 20.
+
+
+def match_all(a, b, max_dr):
+    """
+    Find all pairs of particles from a and b that are within max_dr of each
+    other in eta-phi space.
+
+    a and b are either FourMomentumArrays, for the particles of a single
+    event, or EventBatches with the same number of events, in which case
+    only particles from the same event are paired and indices refer to the
+    particle arrays of the batches.
+
+    Instead of comparing every particle of a with every particle of b, the
+    particles of b are put into a grid of cells at least max_dr wide in eta
+    and phi (wrapping around in phi), and each particle of a is only
+    compared with the particles in its own and the neighbouring cells.
+
+    Returns arrays (index_a, index_b, dr), sorted by index_a and then dr.
+
+    Example:
+    >>> from fourmomentum import FourMomentumArray
+    >>> reco = FourMomentumArray.from_pt_eta_phi_m([20, 30], [0.5, -1.0], [3.1, 0.0], [0, 0])
+    >>> gen = FourMomentumArray.from_pt_eta_phi_m([21, 50], [0.52, 2.0], [-3.13, 0.0], [0, 0])
+    >>> ia, ib, dr = match_all(reco, gen, 0.4)
+    >>> ia, ib, dr.round(4)
+    (array([0]), array([0]), array([0.0568]))
+    """
+    eta_a, phi_a, event_a = _positions(a)
+    eta_b, phi_b, event_b = _positions(b)
+    if len(eta_a) == 0 or len(eta_b) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+
+    n_eta = int(np.ceil(2*MAX_ETA/max_dr)) + 1
+    n_phi = max(1, int(2*np.pi // max_dr))
+
+    def cells(eta, phi):
+        ieta = ((eta+MAX_ETA) // max_dr).astype(np.int64)
+        iphi = ((phi+np.pi) * n_phi // (2*np.pi)).astype(np.int64) % n_phi
+        return ieta, iphi
+
+    ieta_a, iphi_a = cells(eta_a, phi_a)
+    ieta_b, iphi_b = cells(eta_b, phi_b)
+    cell_b = (event_b*n_eta + ieta_b)*n_phi + iphi_b
+    order_b = np.argsort(cell_b, kind='mergesort')
+    sorted_cells = cell_b[order_b]
+
+    index_a, position_b = [], []
+    # with fewer than three phi cells, neighbours would repeat
+    phi_steps = sorted(set([-1 % n_phi, 0, 1 % n_phi]))
+    for deta in (-1, 0, 1):
+        ieta = ieta_a + deta
+        valid = (ieta >= 0) & (ieta < n_eta)
+        for dphi in phi_steps:
+            cell = (event_a*n_eta + ieta)*n_phi + (iphi_a+dphi) % n_phi
+            lo = np.searchsorted(sorted_cells, cell, side='left')
+            hi = np.searchsorted(sorted_cells, cell, side='right')
+            hi = np.where(valid, hi, lo)
+            owner, position = _expand_ranges(lo, hi)
+            index_a.append(owner)
+            position_b.append(position)
+    index_a = np.concatenate(index_a)
+    index_b = order_b[np.concatenate(position_b)]
+
+    deta = eta_a[index_a] - eta_b[index_b]
+    dphi = np.mod(phi_a[index_a] - phi_b[index_b] + np.pi, 2*np.pi) - np.pi
+    dr = np.hypot(deta, dphi)
+    keep = dr <= max_dr
+    index_a, index_b, dr = index_a[keep], index_b[keep], dr[keep]
+    order = np.lexsort((index_b, dr, index_a))
+    return index_a[order], index_b[order], dr[order]
+
+
+def match_nearest(a, b, max_dr):
+    """
+    For each particle of a, find the nearest particle of b within max_dr.
+    Several particles of a can match the same particle of b; see
+    match_unique for one-to-one matching.
+
+    Returns arrays (index, dr) with an entry for each particle of a: the
+    index of the matched particle of b and the distance, or -1 and inf if
+    there is none.
+    """
+    index_a, index_b, dr = match_all(a, b, max_dr)
+    # match_all sorts by index_a and then dr, so the first of each is nearest
+    first = np.ones(len(index_a), dtype=bool)
+    first[1:] = index_a[1:] != index_a[:-1]
+    return _scatter(_size(a), index_a[first], index_b[first], dr[first])
+
+
+def match_unique(a, b, max_dr):
+    """
+    Match particles of a to particles of b one-to-one, greedily taking the
+    closest remaining pair each time, as is usual for gen-to-reco matching.
+
+    Returns arrays (index, dr) like match_nearest.
+
+    Example:
+    >>> from fourmomentum import FourMomentumArray
+    >>> reco = FourMomentumArray.from_pt_eta_phi_m([20, 30], [0.0, 0.1], [0, 0], [0, 0])
+    >>> gen = FourMomentumArray.from_pt_eta_phi_m([20], [0.08], [0], [0])
+    >>> match_nearest(reco, gen, 0.4)[0]
+    array([0, 0])
+    >>> match_unique(reco, gen, 0.4)[0]
+    array([-1,  0])
+    """
+    index_a, index_b, dr = match_all(a, b, max_dr)
+    # rank every pair so that ties are broken the same way everywhere
+    rank = np.empty(len(dr), dtype=np.int64)
+    rank[np.lexsort((index_b, index_a, dr))] = np.arange(len(dr))
+    matched_a, matched_b, matched_dr = [], [], []
+    n_a, n_b = _size(a), _size(b)
+    # A pair that is the best remaining one for both of its particles is
+    # chosen by the greedy algorithm, so take all of those at once, drop
+    # the pairs they rule out, and repeat.
+    while len(rank):
+        best_a = np.full(n_a, len(rank)+len(dr), dtype=np.int64)
+        best_b = np.full(n_b, len(rank)+len(dr), dtype=np.int64)
+        np.minimum.at(best_a, index_a, rank)
+        np.minimum.at(best_b, index_b, rank)
+        mutual = (best_a[index_a] == rank) & (best_b[index_b] == rank)
+        matched_a.append(index_a[mutual])
+        matched_b.append(index_b[mutual])
+        matched_dr.append(dr[mutual])
+        used_a = np.zeros(n_a, dtype=bool)
+        used_b = np.zeros(n_b, dtype=bool)
+        used_a[index_a[mutual]] = True
+        used_b[index_b[mutual]] = True
+        keep = ~used_a[index_a] & ~used_b[index_b]
+        index_a, index_b, dr, rank = index_a[keep], index_b[keep], dr[keep], rank[keep]
+    if not matched_a:
+        return _scatter(n_a, [], [], [])
+    return _scatter(n_a, np.concatenate(matched_a), np.concatenate(matched_b),
+                    np.concatenate(matched_dr))
+
+
+def remove_overlaps(batch, other, max_dr):
+    """
+    Return batch without the particles that are within max_dr of any
+    particle of other (an EventBatch with the same events), e.g. to remove
+    jets that overlap with electrons.
+    """
+    index_a, index_b, dr = match_all(batch, other, max_dr)
+    keep = np.ones(batch.n_particles, dtype=bool)
+    keep[index_a] = False
+    return batch.select(keep)
+
+
+def _positions(x):
+    """eta, phi and event number of each particle of an EventBatch or FourMomentumArray"""
+    if isinstance(x, EventBatch):
+        p4, event = x.p4, x.event_index
+    else:
+        p4, event = x, np.zeros(len(x), dtype=np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eta = p4.eta
+    eta = np.clip(np.nan_to_num(eta), -MAX_ETA, MAX_ETA)
+    return eta, p4.phi, event
+
+
+def _size(x):
+    return x.n_particles if isinstance(x, EventBatch) else len(x)
+
+
+def _expand_ranges(lo, hi):
+    """
+    For ranges [lo[i], hi[i]), return the owner i and the value of every
+    element of every range
+    """
+    lengths = hi - lo
+    owner = np.repeat(np.arange(len(lo)), lengths)
+    starts = np.cumsum(lengths) - lengths
+    return owner, np.arange(lengths.sum()) - np.repeat(starts - lo, lengths)
+
+
+def _scatter(n, index_a, index_b, dr):
+    index = np.full(n, -1, dtype=np.int64)
+    distance = np.full(n, np.inf)
+    index[index_a] = index_b
+    distance[index_a] = dr
+    return index, distance
+
+
+__all__ = ['match_all', 'match_nearest', 'match_unique', 'remove_overlaps']
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == '__main__':
+    _test()
@@ -1,24 +1,122 @@
+import cPickle
+import threading
+import time
+from array import array
+from Queue import Queue
+
+import numpy as np
+import persistent
 from ZODB.FileStorage import FileStorage
 from ZODB.DB import DB
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
+from persistent.interfaces import GHOST
 import transaction
 
 
+def _met(event):
+    return event.met().pt
+
+
+def _n_electrons(event):
+    return len(event.electrons())
+
+
+def _n_muons(event):
+    return len(event.muons())
+
+
+def _idprup(event):
+    return event.metadata.get('idprup', float('nan'))
+
+
+# summary columns kept for each event unless EventCollection is given others
+DEFAULT_SUMMARIES = {
+    'met': _met,
+    'n_electrons': _n_electrons,
+    'n_muons': _n_muons,
+    'idprup': _idprup,
+}
+
+# number of events per summary record
+SUMMARY_BLOCK_SIZE = 1000
+
+
 class EventCollection(object):
     """
     Structure to store an ensemble of events to disk and utilities to
     iterate through the events.
+
+    Events are kept in a BTree keyed by event number, so adding an event
+    costs the same whether the collection holds a thousand events or a
+    hundred million, and each commit only rewrites the buckets that changed.
+    The next free event number is kept in a persistent counter.
+
+    If inline_particles is True, the particles of each added event are
+    stored inside the event's record rather than as separate records (see
+    Event), so that loading an event takes a single read.
+
+    Loaded objects are kept in the connection cache. Its target size can
+    be set in objects (cache_size) and in bytes (cache_size_bytes), either
+    when the collection is created or later through the properties of the
+    same names. ZODB only shrinks the cache back to its target at commits
+    or when asked to, so see events() for iterating over large collections
+    in constant memory.
+
+    Events added with add_event are committed to disk in batches. A commit
+    happens once commit_every events, commit_bytes bytes (estimated from the
+    pickled size of the events) or commit_seconds seconds have accumulated,
+    whichever comes first; any of these can be None to disable it. After
+    each commit, on_commit(n_events, seconds) is called with the number of
+    events written and the time the commit took.
+
+    With background=True, add_event just puts the event on a queue of at
+    most queue_size events, and a writer thread with its own connection
+    stores and commits them, so that the caller can keep producing events
+    while a batch is being written. save() waits for the queue to drain.
+    Only add events through add_event/add_events in this mode.
+
+    With read_only=True the file is opened read-only, so that several
+    processes can read the same collection at once.
+
+    A few cheap per-event quantities are computed as events are added and
+    kept in a compact summary index, so that select() can apply cuts on
+    them without loading the events that fail. summaries maps column names
+    to functions of an event returning a number; DEFAULT_SUMMARIES (MET,
+    numbers of electrons and muons, and idprup) is used if it isn't given,
+    and summaries={} turns the index off. The functions are not stored in
+    the file, so pass the same ones each time the collection is opened for
+    writing, and call build_summary() after changing them.
     """
 
     events_since_save = 0
+    bytes_since_save = 0
     storage = None
     db = None
     connection = None
+    root = None
     store = None
-    events_since_save = 0
+    next_key = None
 
-    def __init__(self, filename):
+    def __init__(self, filename, inline_particles=False, cache_size=None,
+                 cache_size_bytes=None, commit_every=10000, commit_bytes=None,
+                 commit_seconds=None, on_commit=None, background=False, queue_size=1000,
+                 read_only=False, summaries=None):
         self.filename = filename
+        self.summaries = DEFAULT_SUMMARIES if summaries is None else summaries
+        self.read_only = read_only
+        self.inline_particles = inline_particles
+        self.commit_every = commit_every
+        self.commit_bytes = commit_bytes
+        self.commit_seconds = commit_seconds
+        self.on_commit = on_commit
+        self.background = background
+        self.queue_size = queue_size
         self.open()
+        if cache_size is not None:
+            self.cache_size = cache_size
+        if cache_size_bytes is not None:
+            self.cache_size_bytes = cache_size_bytes
 
     def __enter__(self):
         pass
@@ -26,33 +124,379 @@ class EventCollection(object):
     def __exit__(self, type, value, traceback):
         self.close()
 
+    def __len__(self):
+        return self.next_key()
+
+    @property
+    def cache_size(self):
+        """Target number of objects in the connection cache"""
+        return self.db.getCacheSize()
+
+    @cache_size.setter
+    def cache_size(self, value):
+        self.db.setCacheSize(value)
+
+    @property
+    def cache_size_bytes(self):
+        """Target size of the connection cache in bytes (0 for no limit)"""
+        return self.db.getCacheSizeBytes()
+
+    @cache_size_bytes.setter
+    def cache_size_bytes(self, value):
+        self.db.setCacheSizeBytes(value)
+
     def open(self):
-        self.storage = FileStorage(self.filename)
+        self.storage = FileStorage(self.filename, read_only=self.read_only)
         self.db = DB(self.storage)
         self.connection = self.db.open()
-        self.store = self.connection.root()
+        self.root = self.connection.root()
+        if 'events' not in self.root:
+            if self.read_only:
+                raise ValueError("%s was written by an older version of pyhep. Open it once "
+                                 "without read_only to upgrade it." % self.filename)
+            self._create_store()
+        if 'summary' not in self.root and not self.read_only:
+            # collections from before the summary index was added
+            self.root['summary'] = IOBTree()
+            transaction.commit()
+        self.store = self.root['events']
+        self.next_key = self.root['next_key']
         self.events_since_save = 0
+        self.bytes_since_save = 0
+        self.last_save = time.time()
+        self._writer = None
+        if self.background:
+            self._queue = Queue(self.queue_size)
+            self._writer_error = None
+            self._writer = threading.Thread(target=self._write_events)
+            self._writer.daemon = True
+            self._writer.start()
         return self
 
+    def _create_store(self):
+        """
+        Create the event BTree and counter. Collections written by older
+        versions of pyhep kept their events directly in the root mapping, so
+        move any of those into the BTree.
+        """
+        events = IOBTree()
+        old_keys = sorted(key for key in self.root.keys() if isinstance(key, int))
+        for key in old_keys:
+            events[key] = self.root.pop(key)
+        self.root['events'] = events
+        self.root['next_key'] = Length(old_keys[-1]+1 if old_keys else 0)
+        self.root['summary'] = IOBTree()
+        transaction.commit()
+
     def close(self):
+        if self._writer is not None:
+            self._flush(stop=True)
+            self._writer = None
         self.connection.close()
         self.storage.close()
 
     def new_key(self):
-        return max(self.store.keys())+1 if self.store.keys() else 0
+        """Reserve and return the next free event number"""
+        key = self.next_key()
+        self.next_key.change(1)
+        return key
 
     def save(self):
-        transaction.commit()
+        if self._writer is not None:
+            self._flush()
+            # start a new transaction to see the writer's commits
+            transaction.abort()
+        else:
+            self._commit(transaction.commit)
 
-    def events(self):
-        for key in self.store.keys():
-            yield self.store[key]
+    def events(self, ghost=False, gc_interval=None, start=None, stop=None):
+        """
+        Iterate through the events in the collection, optionally only those
+        with event numbers in the range [start, stop).
+
+        Every event that is loaded stays in the connection cache, so on a
+        large collection memory use grows until the end of the loop unless
+        one of the options below is used.
+
+        Arguments:
+        ghost - if True, unload each event (and its particles) once the
+        loop moves on to the next one. Events that have been modified are
+        left alone. Don't keep references to the events if using this.
+        gc_interval - if given, shrink the connection cache back to
+        cache_size/cache_size_bytes every gc_interval events.
+        start, stop - range of event numbers to iterate over
+        """
+        events = self.store.values(min=start, max=stop, excludemax=stop is not None)
+        for i, event in enumerate(events):
+            yield event
+            if ghost:
+                _deactivate(event)
+            if gc_interval and (i+1) % gc_interval == 0:
+                self.connection.cacheGC()
 
     def add_event(self, event):
-        self.store[self.new_key()] = event
+        if self.inline_particles:
+            event.inline_particles = True
+        if self._writer is not None:
+            self._check_writer()
+            self._queue.put(event)
+            return
+        self._insert(self.root, event)
+        self._event_added(event, transaction.commit)
+
+    def add_events(self, events):
+        """Add all of the events from an iterable"""
+        for event in events:
+            self.add_event(event)
+
+    def _insert(self, root, event):
+        """
+        Store an event under the next free event number and add it to the
+        summary index. The summary is computed (and converted to floats)
+        first, so that nothing is stored if one of the functions fails or
+        returns something that isn't a number. If the index doesn't cover the
+        events before this one (e.g. it was turned off when they were
+        added), it is left alone until build_summary() is called.
+        """
+        key = root['next_key']()
+        values = None
+        if self.summaries:
+            values = _summary_values(self.summaries, event)
+        root['events'][key] = event
+        root['next_key'].change(1)
+        if values is not None and _summary_covered(root['summary']) == key:
+            block_key = key // SUMMARY_BLOCK_SIZE
+            block = root['summary'].get(block_key)
+            if block is None:
+                block = root['summary'][block_key] = SummaryBlock(block_key*SUMMARY_BLOCK_SIZE)
+            block.append(key, values)
+
+    def summary(self, start=None, stop=None):
+        """
+        Return the summary index as a dict of numpy arrays, one per summary
+        column plus 'key' with the event numbers, for the events in blocks
+        overlapping [start, stop). Quantities that weren't computed for an
+        event are NaN.
+        """
+        return self._merge_summary(self._summary_blocks(start, stop))
+
+    def _summary_blocks(self, start=None, stop=None):
+        """Summary blocks overlapping [start, stop), after checking that the index is complete"""
+        summary = self.root.get('summary')
+        if _summary_covered(summary) != self.next_key():
+            raise ValueError("the summary index doesn't cover all of the events; "
+                             "call build_summary() to rebuild it")
+        if summary is None:
+            return []
+        min_block = None if start is None else start // SUMMARY_BLOCK_SIZE
+        max_block = None if stop is None else (stop-1) // SUMMARY_BLOCK_SIZE
+        return summary.values(min=min_block, max=max_block)
+
+    def _merge_summary(self, blocks):
+        """Concatenate the columns of summary blocks"""
+        blocks = list(blocks)
+        names = set(self.summaries)
+        for block in blocks:
+            names.update(block.columns)
+        result = dict((name, np.concatenate([block.column(name) for block in blocks] or [[]]))
+                      for name in names)
+        result['key'] = np.concatenate([block.keys() for block in blocks] or [[]]).astype(int)
+        return result
+
+    def select(self, where=None, start=None, stop=None, ghost=False, gc_interval=None):
+        """
+        Iterate through the events that pass a cut on the summary index,
+        loading only those.
+
+        Arguments:
+        where - function taking a dict of numpy arrays (see summary()) for
+        a block of events and returning an array of booleans saying which
+        of them to keep. All events are kept if it's None.
+        start, stop - range of event numbers to consider
+        ghost, gc_interval - as for events()
+
+        Example:
+        >>> for event in collection.select(lambda s: (s['met'] > 20) & (s['n_electrons'] >= 2)):
+        ...     pass    # doctest: +SKIP
+        """
+        i = 0
+        for block in self._summary_blocks(start, stop):
+            summary = self._merge_summary([block])
+            keys = summary['key']
+            mask = np.ones(len(keys), dtype=bool)
+            if where is not None:
+                mask &= np.asarray(where(summary), dtype=bool)
+            if start is not None:
+                mask &= keys >= start
+            if stop is not None:
+                mask &= keys < stop
+            for key in keys[mask]:
+                event = self.store[int(key)]
+                yield event
+                if ghost:
+                    _deactivate(event)
+                i += 1
+                if gc_interval and i % gc_interval == 0:
+                    self.connection.cacheGC()
+
+    def build_summary(self):
+        """
+        Recompute the summary index of all of the events with the current
+        summaries, e.g. after changing them or for collections written
+        before the index existed.
+        """
+        if self._writer is not None:
+            self._flush()
+        summary = self.root['summary']
+        summary.clear()
+        for i, (key, event) in enumerate(self.store.iteritems()):
+            block_key = key // SUMMARY_BLOCK_SIZE
+            block = summary.get(block_key)
+            if block is None:
+                block = summary[block_key] = SummaryBlock(block_key*SUMMARY_BLOCK_SIZE)
+            block.append(key, _summary_values(self.summaries, event))
+            _deactivate(event)
+            if self.commit_every and (i+1) % self.commit_every == 0:
+                transaction.commit()
+        transaction.commit()
+
+    def _event_added(self, event, commit):
+        """Keep track of what has been added since the last commit, and commit if it's time"""
         self.events_since_save += 1
-        if self.events_since_save > 10000:
-            print "Saving..."
-            self.events_since_save = 0
-            self.save()
+        if self.commit_bytes is not None:
+            self.bytes_since_save += len(cPickle.dumps(event, cPickle.HIGHEST_PROTOCOL))
+        if ((self.commit_every is not None and self.events_since_save >= self.commit_every) or
+                (self.commit_bytes is not None and self.bytes_since_save >= self.commit_bytes) or
+                (self.commit_seconds is not None and
+                 time.time()-self.last_save >= self.commit_seconds)):
+            self._commit(commit)
+
+    def _commit(self, commit):
+        """Commit the current transaction and report it to on_commit"""
+        start = time.time()
+        commit()
+        self.last_save = time.time()
+        n_events = self.events_since_save
+        self.events_since_save = 0
+        self.bytes_since_save = 0
+        if self.on_commit is not None:
+            self.on_commit(n_events, self.last_save-start)
+
+    def _flush(self, stop=False):
+        """Wait for the writer thread to store and commit everything queued so far"""
+        request = _FlushRequest(stop)
+        self._queue.put(request)
+        request.done.wait()
+        if stop:
+            self._writer.join()
+        self._check_writer()
+
+    def _check_writer(self):
+        """Re-raise an error from the writer thread in the caller's thread"""
+        if self._writer_error is not None:
+            error, self._writer_error = self._writer_error, None
+            raise error
+
+    def _write_events(self):
+        """Body of the background writer thread"""
+        tm = transaction.TransactionManager()
+        connection = self.db.open(tm)
+        root = connection.root()
+        while True:
+            item = self._queue.get()
+            try:
+                if isinstance(item, _FlushRequest):
+                    if self._writer_error is None:
+                        self._commit(tm.commit)
+                elif self._writer_error is None:
+                    self._insert(root, item)
+                    self._event_added(item, tm.commit)
+            except Exception as e:
+                # keep draining the queue so that add_event doesn't block;
+                # the error is raised by the next add_event or save
+                self._writer_error = e
+                tm.abort()
+            if isinstance(item, _FlushRequest):
+                item.done.set()
+                if item.stop:
+                    break
+        tm.abort()
+        connection.close()
+
+
+class SummaryBlock(persistent.Persistent):
+    """
+    Summary quantities of a block of consecutive events, starting at event
+    number start, stored as compact arrays of doubles.
+    """
+    def __init__(self, start):
+        self.start = start
+        self.n = 0
+        self.columns = {}
+
+    def __len__(self):
+        return self.n
+
+    def append(self, key, values):
+        """Add the summary values of event number key, which must be the next one in the block"""
+        if key != self.start + self.n:
+            raise ValueError("summary of event %d added out of order" % key)
+        # convert everything before changing any column, so that a bad
+        # value can't leave the columns with different lengths
+        values = dict((name, float(value)) for name, value in values.iteritems())
+        new_columns = dict((name, array('d', [float('nan')]*self.n + [value]))
+                           for name, value in values.iteritems() if name not in self.columns)
+        for name, column in self.columns.iteritems():
+            column.append(values.get(name, float('nan')))
+        self.columns.update(new_columns)
+        self.n += 1
+        self._p_changed = True
+
+    def keys(self):
+        return np.arange(self.start, self.start+self.n)
+
+    def column(self, name):
+        """Values of a column as a numpy array (NaN if the column isn't in this block)"""
+        if name not in self.columns:
+            return np.full(self.n, np.nan)
+        # copy, since the array's buffer moves when it grows
+        return np.frombuffer(self.columns[name], dtype=np.float64).copy()
+
+
+class _FlushRequest(object):
+    """Marker put on the writer queue to ask for a commit"""
+    def __init__(self, stop=False):
+        self.stop = stop
+        self.done = threading.Event()
+
+
+def _summary_values(summaries, event):
+    """Compute the summary values of an event as floats"""
+    values = {}
+    for name, func in summaries.iteritems():
+        value = func(event)
+        try:
+            values[name] = float(value)
+        except (TypeError, ValueError):
+            raise ValueError("summary %r must be a number, got %r" % (name, value))
+    return values
+
+
+def _summary_covered(summary):
+    """Number of events, from event 0 on, that a summary index covers"""
+    if summary is None or not summary:
+        return 0
+    last = summary[summary.maxKey()]
+    return last.start + len(last)
+
 
+def _deactivate(event):
+    """Turn an event, and any particles stored as separate records, into ghosts"""
+    if event._p_state == GHOST:
+        return
+    if not event.inline_particles:
+        for particle in event.particles_:
+            if particle._p_state != GHOST:
+                particle.p4._p_deactivate()
+                particle._p_deactivate()
+    event._p_deactivate()
@@ -1,6 +1,71 @@
+import bz2
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import zlib
 import unittest
+from math import sqrt
+
+import numpy as np
 
 from pyhep import *
+import pyhep.LesHouchesEvents as LHE
+
+
+LHE_SAMPLE = """<LesHouchesEvents version="1.0">
+<header>
+<!-- <event> inside a comment is not an event -->
+</header>
+<init>
+   2212   2212  0.40000000000E+04  0.40000000000E+04 0 0 10042 10042 3  1
+  0.12345E+03  0.1E+01  0.12345E+03   1
+</init>
+<event>
+ 4   1  5.0000000000E-04  9.11800000E+01  7.80000000E-03  1.18000000E-01
+       21 -1    0    0  501  502 +0.0000000000e+00 +0.0000000000e+00 +4.5590000000e+01 4.5590000000e+01 0.0000000000e+00 0.0000e+00 9.0000e+00
+       21 -1    0    0  502  501 -0.0000000000e+00 -0.0000000000e+00 -4.5590000000e+01 4.5590000000e+01 0.0000000000e+00 0.0000e+00 9.0000e+00
+       11  1    1    2    0    0 +3.0000000000e+01 +2.0000000000e+01 +1.0000000000e+01 3.7416573868e+01 0.0000000000e+00 0.0000e+00 9.0000e+00
+      -11  1    1    2    0    0 -3.0000000000e+01 -2.0000000000e+01 -1.0000000000e+01 3.7416573868e+01 0.0000000000e+00 0.0000e+00 9.0000e+00
+#comment 1
+<rwgt>
+<wgt id="1"> 0.1 </wgt>
+</rwgt>
+</event>
+<event npLO=" -1 ">
+ 3   2  6.0000000000E-04  9.11800000E+01  7.80000000E-03  1.18000000E-01
+        2 -1    0    0  501    0 +0.0000000000e+00 +0.0000000000e+00 +4.0000000000e+01 4.0000000000e+01 0.0000000000e+00 0.0000e+00 9.0000e+00
+       -2 -1    0    0    0  501 -0.0000000000e+00 -0.0000000000e+00 -4.0000000000e+01 4.0000000000e+01 0.0000000000e+00 0.0000e+00 9.0000e+00
+       23  1    1    2    0    0 +0.0000000000e+00 +0.0000000000e+00 +0.0000000000e+00 8.0000000000e+01 8.0000000000e+01 0.0000e+00 9.0000e+00
+#comment 2
+</event>
+<event>
+ 2   1  7.0000000000E-04  9.11800000E+01  7.80000000E-03  1.18000000E-01
+       13  1    0    0    0    0 +5.0000000000e+00 +0.0000000000e+00 +0.0000000000e+00 5.0011164751e+00 1.0570000000e-01 0.0000e+00 9.0000e+00
+      -13  1    0    0    0    0 -5.0000000000e+00 +0.0000000000e+00 +0.0000000000e+00 5.0011164751e+00 1.0570000000e-01 0.0000e+00 9.0000e+00
+</event>
+</LesHouchesEvents>
+"""
+
+
+def deep_size(obj):
+    """Size in bytes of an object, what its slots hold and the items of lists and tuples"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item) for item in obj)
+    for slot in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, slot):
+            size += deep_size(getattr(obj, slot))
+    return size
+
+
+def write_temp_file(contents, suffix='.lhe'):
+    """Write contents to a temporary file and return its name"""
+    fd, filename = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(contents)
+    return filename
 
 
 class TestFourMomentum(unittest.TestCase):
@@ -43,3 +108,1097 @@ class TestFourMomentum(unittest.TestCase):
         p = FourMomentum.from_pt_eta_phi_e(50, 0.1, 1.0, 300)
         p2 = FourMomentum.from_x_y_z_m(p.px, p.py, p.pz, p.mass)
         self.almost_equal(p, p2)
+
+    def test_cache_invalidation(self):
+        p = FourMomentum.from_x_y_z_m(3, 4, 0, 0)
+        self.assertEqual((p.pt, p.p, p.energy), (5, 5, 5))
+        p.px = 0
+        self.assertEqual((p.pt, p.p, p.energy), (4, 4, 4))
+        p.pz = 3
+        self.assertEqual((p.pt, p.p), (4, 5))
+        p.pt = 8
+        self.assertAlmostEqual(p.pt, 8)
+        self.assertAlmostEqual(p.p, sqrt(8**2+3**2))
+        p.energy = 20
+        self.assertAlmostEqual(p.p, 20)
+        self.assertAlmostEqual(p.energy, 20)
+
+    def test_in_place_arithmetic(self):
+        p = FourMomentum.from_x_y_z_m(10, 20, 30, 40)
+        alias = p
+        p += self.p2
+        self.assertTrue(p is alias)
+        self.almost_equal(p, self.p1+self.p2)
+        p -= self.p2
+        self.almost_equal(p, self.p1+self.p2-self.p2)
+        p = FourMomentum.from_x_y_z_m(10, 20, 30, 40)
+        p *= -2
+        self.assertTrue(p is not self.p1)
+        self.almost_equal(p, self.p1*-2)
+
+    def test_sum(self):
+        self.almost_equal(FourMomentum.sum([self.p1, self.p2]), self.p1+self.p2)
+        self.almost_equal(FourMomentum.sum(iter([self.p1])), self.p1)
+        self.assertEqual(FourMomentum.sum([]), FourMomentum())
+        array = FourMomentumArray.from_list([self.p1, self.p2])
+        self.almost_equal(array.sum(), self.p1+self.p2)
+
+    def test_sum_massless(self):
+        # rounding must not make the mass of a massless sum an error
+        for i in range(100):
+            p = FourMomentum.from_x_y_z_m(0.37*i-11, 1.3*i, 7.1-0.9*i, 0)
+            self.assertAlmostEqual(FourMomentum.sum([p]).mass, 0, 5)
+            total = FourMomentum.from_x_y_z_m(0, 0, 0, 0)
+            total += p
+            self.assertAlmostEqual(total.mass, 0, 5)
+        photon = GenParticle(FourMomentum.from_x_y_z_m(3.3, 1.1, 7.7, 0), 22, 0, 1)
+        self.assertAlmostEqual(GenEvent([photon]).met().pt, np.hypot(3.3, 1.1))
+
+    def test_unphysical_energy(self):
+        # only rounding is forgiven, not an energy smaller than the momentum
+        self.assertRaises(ValueError, FourMomentum.from_x_y_z_e, 30, 40, 0, 10)
+        self.assertRaises(ValueError, FourMomentum.from_x_y_z_e, 30, 40, 0, 50*(1-1e-6))
+        self.assertEqual(FourMomentum.from_x_y_z_e(30, 40, 0, 50*(1-1e-12)).mass, 0)
+
+    def test_persistence(self):
+        import cPickle
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        p = cPickle.loads(cPickle.dumps(self.p1, 2))
+        self.assertEqual(p, self.p1)
+        # state written before FourMomentum had __slots__
+        old = FourMomentum.__new__(FourMomentum)
+        old.__setstate__({'x': 10, 'y': 20, 'z': 30, '_m': 40})
+        self.assertEqual(old, self.p1)
+        self.assertFalse(hasattr(old, '__dict__'))
+
+        db = DB(MappingStorage())
+        connection = db.open()
+        connection.root()['p4'] = FourMomentum.from_x_y_z_m(3, 4, 0, 0)
+        transaction.commit()
+        p = connection.root()['p4']
+        self.assertEqual(p.pt, 5)
+        self.assertFalse(p._p_changed)
+        p._p_deactivate()
+        p.px = 0
+        self.assertTrue(p._p_changed)
+        self.assertEqual(p.pt, 4)
+        transaction.abort()
+        self.assertEqual(p.pt, 5)
+        connection.close()
+        db.close()
+
+
+class TestFourMomentumArray(unittest.TestCase):
+    """Tests for FourMomentumArray class"""
+
+    def setUp(self):
+        self.p4s = [FourMomentum.from_x_y_z_m(10, 20, 30, 40),
+                    FourMomentum.from_x_y_z_m(-20, 30, -40, 0)]
+        self.array = FourMomentumArray.from_list(self.p4s)
+
+    def test_properties_match_scalar(self):
+        for name in ['px', 'py', 'pz', 'mass', 'p', 'energy', 'pt', 'phi', 'theta', 'eta']:
+            values = getattr(self.array, name)
+            for p, value in zip(self.p4s, values):
+                self.assertAlmostEqual(getattr(p, name), value)
+
+    def test_round_trip(self):
+        for p, q in zip(self.p4s, self.array.to_list()):
+            self.assertEqual(p, q)
+
+    def test_arithmetic_matches_scalar(self):
+        total = self.array + self.array[::-1]
+        self.assertAlmostEqual(total.energy[0], (self.p4s[0]+self.p4s[1]).energy)
+        self.assertAlmostEqual((self.array*2).mass[0], (self.p4s[0]*2).mass)
+        self.assertAlmostEqual(self.array.dot(self.array[::-1])[0], self.p4s[0].dot(self.p4s[1]))
+
+    def test_kinematics_match_scalar(self):
+        other = self.array[::-1]
+        for a, b, i in zip(self.p4s, self.p4s[::-1], range(2)):
+            self.assertAlmostEqual(self.array.mt[i], a.mt)
+            self.assertAlmostEqual(self.array.delta_phi(other)[i], a.delta_phi(b))
+            self.assertAlmostEqual(self.array.delta_r(other)[i], a.delta_r(b))
+            self.assertAlmostEqual(self.array.transverse_mass(other)[i], a.transverse_mass(b))
+            self.assertAlmostEqual(self.array.delta_r_matrix()[i, 1-i], a.delta_r(b))
+            self.assertAlmostEqual(self.array.mass_matrix()[i, 1-i], (a+b).mass)
+            for name in ['rotate_x', 'rotate_y', 'rotate_z']:
+                rotated = getattr(self.array, name)(0.7)[i]
+                self.assertTrue(rotated.almost_equal(getattr(a, name)(0.7)))
+            boosted = self.array.boost(0.1, -0.2, 0.3)[i]
+            self.assertTrue(boosted.almost_equal(a.boost(0.1, -0.2, 0.3)))
+            rest = self.array.boost_to_rest_frame(self.p4s[0])[i]
+            self.assertTrue(rest.almost_equal(a.boost_to_rest_frame(self.p4s[0])))
+
+    def test_boost(self):
+        parent = self.p4s[0]
+        rest = parent.boost_to_rest_frame(parent)
+        self.assertAlmostEqual(rest.p, 0)
+        self.assertAlmostEqual(rest.energy, parent.mass)
+        back = rest.boost(*parent.boost_vector)
+        self.assertTrue(back.almost_equal(parent))
+        self.assertRaises(ValueError, parent.boost, 0.8, 0.8, 0)
+        # zero velocities are allowed in the array version
+        boosted = self.array.boost([0, 0.5], 0, 0)
+        self.assertTrue(boosted[0].almost_equal(self.p4s[0]))
+        self.assertTrue(boosted[1].almost_equal(self.p4s[1].boost(0.5, 0, 0)))
+
+    def test_pt_eta_phi_round_trip(self):
+        p4s = FourMomentumArray.from_pt_eta_phi_m(self.array.pt, self.array.eta,
+                                                  self.array.phi, self.array.mass)
+        for name in ['px', 'py', 'pz', 'mass']:
+            for a, b in zip(getattr(p4s, name), getattr(self.array, name)):
+                self.assertAlmostEqual(a, b)
+
+
+class TestLHEventReader(unittest.TestCase):
+    """Tests for LHEventReader class"""
+
+    def setUp(self):
+        self.filename = write_temp_file(LHE_SAMPLE)
+
+    def tearDown(self):
+        os.remove(self.filename)
+        if os.path.exists(self.filename + '.idx.npz'):
+            os.remove(self.filename + '.idx.npz')
+
+    def test_events(self):
+        reader = LHE.LHEventReader(self.filename)
+        events = list(reader.events())
+        self.assertEqual([e.nup() for e in events], [4, 3, 2])
+        self.assertEqual([e.idprup() for e in events], [1, 2, 1])
+        self.assertEqual(events[0].comment, '#comment 1')
+        self.assertEqual(events[2].particles[0].idup(), 13)
+        self.assertAlmostEqual(events[2].particles[1].mass(), 0.1057)
+        self.assertTrue(reader.init.split()[0] == '2212')
+
+    def test_particle_size(self):
+        # the fields are stored compactly, not as strings
+        particle = next(LHE.LHEventReader(self.filename).events()).particles[0]
+        self.assertTrue(deep_size(particle) < 300, deep_size(particle))
+        event = LHE.LHEvent(' 1 1 1 1 1 1\n', ['  11 1 0 0 0 0 1 2 3 4 5 0 9\n'])
+        self.assertEqual(event.particles[0].fields(), (11, 1, 0, 0, 0, 0, 1., 2., 3., 4., 5., 0., 9.))
+        self.assertTrue(isinstance(event.particles[0].idup(), int))
+
+    def test_max_events(self):
+        reader = LHE.LHEventReader(self.filename, max_events=2)
+        self.assertEqual(len(list(reader.events())), 2)
+
+    def test_batches(self):
+        reader = LHE.LHEventReader(self.filename)
+        batches = list(reader.batches(2))
+        self.assertEqual([len(b.headers) for b in batches], [2, 1])
+        headers, particles, offsets, comments = batches[0]
+        self.assertEqual(list(headers['nup']), [4, 3])
+        self.assertEqual(list(offsets), [0, 4, 7])
+        self.assertEqual(comments, ['#comment 1', '#comment 2'])
+        events = list(LHE.LHEventReader(self.filename).events())
+        for i, p in enumerate(events[1].particles):
+            record = particles[offsets[1]+i]
+            self.assertEqual(record['idup'], p.idup())
+            self.assertEqual(record['istup'], p.istup())
+            self.assertAlmostEqual(record['pup4'], p.energy())
+        self.assertAlmostEqual(batches[1].headers['xwgtup'][0], events[2].xwgtup())
+
+    def test_batches_max_events(self):
+        reader = LHE.LHEventReader(self.filename, max_events=2)
+        batches = list(reader.batches(5))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0].headers), 2)
+
+    def test_parallel_events(self):
+        events = list(LHE.LHEventReader(self.filename).events())
+        reader = LHE.LHEventReader(self.filename)
+        ordered = list(reader.parallel_events(processes=2, chunk_bytes=100))
+        self.assertEqual([e.fields() for e in ordered], [e.fields() for e in events])
+        self.assertTrue(reader.init.split()[0] == '2212')
+        reader = LHE.LHEventReader(self.filename)
+        unordered = list(reader.parallel_events(processes=2, ordered=False, chunk_bytes=100))
+        self.assertEqual(sorted(e.fields() for e in unordered), sorted(e.fields() for e in events))
+        reader = LHE.LHEventReader(self.filename, max_events=2)
+        self.assertEqual(len(list(reader.parallel_events(processes=2, chunk_bytes=100))), 2)
+
+    def test_parallel_batches(self):
+        reader = LHE.LHEventReader(self.filename, max_events=2)
+        batches = list(reader.parallel_batches(5, processes=2, chunk_bytes=100))
+        self.assertEqual(sum(len(b.headers) for b in batches), 2)
+        particles = np.concatenate([b.particles for b in batches])
+        self.assertEqual(list(particles['idup']), [21, 21, 11, -11, 2, -2, 23])
+
+    def test_truncated_file(self):
+        inside_event = LHE_SAMPLE[:LHE_SAMPLE.rindex('</event>')]
+        no_closing_tag = LHE_SAMPLE[:LHE_SAMPLE.index('</LesHouchesEvents>')]
+        for contents in [inside_event, no_closing_tag]:
+            filename = write_temp_file(contents)
+            try:
+                reader = LHE.LHEventReader(filename)
+                self.assertRaises(ValueError, list, reader.events())
+                self.assertRaises(ValueError, list, reader.batches(10))
+                self.assertRaises(ValueError, list, reader.parallel_events(processes=2, chunk_bytes=500))
+                self.assertRaises(ValueError, list, reader.parallel_events(processes=2, ordered=False,
+                                                                           chunk_bytes=500))
+            finally:
+                os.remove(filename)
+
+    def test_parallel_indented_tags(self):
+        # ranges starting in the indentation of a tag must not both parse the event
+        filename = write_temp_file(LHE_SAMPLE.replace('\n<event', '\n   <event'))
+        try:
+            expected = [e.fields() for e in LHE.LHEventReader(filename).events()]
+            self.assertEqual(len(expected), 3)
+            for chunk_bytes in [1, 2, 3, 7, 20]:
+                events = LHE.LHEventReader(filename).parallel_events(processes=2, chunk_bytes=chunk_bytes)
+                self.assertEqual([e.fields() for e in events], expected)
+        finally:
+            os.remove(filename)
+
+    def test_random_access(self):
+        events = list(LHE.LHEventReader(self.filename).events())
+        reader = LHE.LHEventReader(self.filename)
+        self.assertEqual(len(reader), 3)
+        self.assertEqual(reader[1].fields(), events[1].fields())
+        self.assertEqual(reader[-1].fields(), events[2].fields())
+        self.assertEqual([e.fields() for e in reader[1:]], [e.fields() for e in events[1:]])
+        self.assertEqual([e.fields() for e in reader[::2]], [e.fields() for e in events[::2]])
+        self.assertRaises(IndexError, reader.__getitem__, 3)
+        reader.seek(1)
+        self.assertEqual([e.fields() for e in reader.events()], [e.fields() for e in events[1:]])
+        self.assertTrue(reader.init.split()[0] == '2212')
+
+    def test_saved_index(self):
+        reader = LHE.LHEventReader(self.filename)
+        offsets = reader.index()
+        self.assertTrue(os.path.exists(self.filename + '.idx.npz'))
+        reader = LHE.LHEventReader(self.filename)
+        self.assertEqual(list(reader._load_index()), list(offsets))
+        # an index for a file that has since changed is not used
+        stat = os.stat(self.filename)
+        os.utime(self.filename, (stat.st_atime, stat.st_mtime+10))
+        self.assertTrue(reader._load_index() is None)
+
+
+class TestCompressedLHEventReader(unittest.TestCase):
+    """Tests for reading compressed LHE files"""
+
+    def setUp(self):
+        self.filenames = []
+        self.expected = self.read_events(LHE_SAMPLE)
+
+    def tearDown(self):
+        for filename in self.filenames:
+            os.remove(filename)
+
+    def read_events(self, contents, suffix='.lhe'):
+        filename = write_temp_file(contents, suffix)
+        self.filenames.append(filename)
+        return [(e.fields(), [p.fields() for p in e.particles]) for e in LHE.LHEventReader(filename).events()]
+
+    def gzip(self, data):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def test_gzip(self):
+        self.assertEqual(self.read_events(self.gzip(LHE_SAMPLE), '.lhe.gz'), self.expected)
+
+    def test_multi_member_gzip(self):
+        half = len(LHE_SAMPLE)//2
+        contents = self.gzip(LHE_SAMPLE[:half]) + self.gzip(LHE_SAMPLE[half:])
+        self.assertEqual(self.read_events(contents, '.lhe.gz'), self.expected)
+
+    def test_bzip2(self):
+        half = len(LHE_SAMPLE)//2
+        contents = bz2.compress(LHE_SAMPLE[:half]) + bz2.compress(LHE_SAMPLE[half:])
+        self.assertEqual(self.read_events(contents, '.lhe.bz2'), self.expected)
+
+    def test_truncated(self):
+        for contents, suffix in [(self.gzip(LHE_SAMPLE), '.lhe.gz'), (bz2.compress(LHE_SAMPLE), '.lhe.bz2')]:
+            # cut at most of the stream trailer, so that all of the text
+            # might still come out
+            for cut in [len(contents)//2, len(contents)-4]:
+                filename = write_temp_file(contents[:cut], suffix)
+                self.filenames.append(filename)
+                self.assertRaises(IOError, list, LHE.LHEventReader(filename).events())
+
+    def test_stream_ending_at_read_boundary(self):
+        first = bz2.compress(LHE_SAMPLE[:100])
+        filename = write_temp_file(first + bz2.compress(LHE_SAMPLE[100:]), '.lhe.bz2')
+        self.filenames.append(filename)
+        with LHE._DecompressingReader(open(filename, 'rb'), 'bzip2', chunk_size=len(first)) as f:
+            self.assertEqual(''.join(f), LHE_SAMPLE)
+
+    def test_random_access_not_supported(self):
+        filename = write_temp_file(self.gzip(LHE_SAMPLE), '.lhe.gz')
+        self.filenames.append(filename)
+        reader = LHE.LHEventReader(filename)
+        self.assertEqual(reader.compression, 'gzip')
+        self.assertRaises(ValueError, reader.index)
+
+
+class TestLHEventWriter(unittest.TestCase):
+    """Tests for LHEventWriter and skim"""
+
+    def setUp(self):
+        self.filename = write_temp_file(LHE_SAMPLE)
+        fd, self.outfilename = tempfile.mkstemp(suffix='.lhe')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+        os.remove(self.outfilename)
+
+    def read_output(self):
+        with open(self.outfilename, 'rb') as f:
+            return f.read()
+
+    def test_skim_everything(self):
+        self.assertEqual(LHE.skim(self.filename, self.outfilename, lambda event: True), (3, 3))
+        self.assertEqual(self.read_output(), LHE_SAMPLE)
+
+    def test_skim(self):
+        self.assertEqual(LHE.skim(self.filename, self.outfilename, lambda event: event.idprup() == 1), (3, 2))
+        reader = LHE.LHEventReader(self.outfilename)
+        self.assertEqual([e.nup() for e in reader.events()], [4, 2])
+        output = self.read_output()
+        self.assertTrue(output.startswith(reader.preamble))
+        self.assertTrue(reader.preamble.endswith('</init>\n'))
+        # everything in the event block is kept, not just the particles
+        self.assertTrue('<wgt id="1"> 0.1 </wgt>' in output)
+        self.assertFalse('#comment 2' in output)
+
+    def test_skim_batches(self):
+        def muons(batch):
+            counts = np.add.reduceat(np.abs(batch.particles['idup']) == 13, batch.offsets[:-1])
+            return counts > 0
+        self.assertEqual(LHE.skim(self.filename, self.outfilename, muons, batch_size=2), (3, 1))
+        events = list(LHE.LHEventReader(self.outfilename).events())
+        self.assertEqual([e.particles[0].idup() for e in events], [13])
+
+    def test_skim_nothing(self):
+        self.assertEqual(LHE.skim(self.filename, self.outfilename, lambda event: False), (3, 0))
+        self.assertEqual(self.read_output(), LHE_SAMPLE[:LHE_SAMPLE.index('\n<event>')+1] + '</LesHouchesEvents>\n')
+
+    def test_write_event(self):
+        reader = LHE.LHEventReader(self.filename)
+        events = list(reader.events())
+        with LHE.LHEventWriter(self.outfilename, reader.preamble) as writer:
+            for event in events:
+                writer.write_event(event)
+        self.assertEqual(writer.n_events, 3)
+        written = list(LHE.LHEventReader(self.outfilename).events())
+        self.assertEqual([(e.fields(), [p.fields() for p in e.particles], e.comment) for e in written],
+                         [(e.fields(), [p.fields() for p in e.particles], e.comment) for e in events])
+
+
+def make_event(i):
+    p4 = FourMomentum.from_x_y_z_m(i, 20, 30, 0.000511)
+    return GenEvent([GenParticle(p4, 11, -1, 1)], {'idprup': i})
+
+
+def event_px_hist(event):
+    h = Hist1D(5, 0, 25)
+    h.fill(event.particles()[0].p4.px)
+    return h
+
+
+def event_px(event):
+    return event.particles()[0].p4.px
+
+
+def event_idprup(event):
+    return [event.metadata['idprup']]
+
+
+def batch_px_sum(events):
+    return sum(e.particles()[0].p4.px for e in events)
+
+
+SHARED_LIST = [0]
+
+
+def shared_list(event):
+    return SHARED_LIST
+
+
+class TestConvert(unittest.TestCase):
+    """Tests for converting LHE files"""
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.lhe_filename = os.path.join(self.dirname, 'events.lhe')
+        with open(self.lhe_filename, 'wb') as f:
+            f.write(LHE_SAMPLE)
+        self.filename = os.path.join(self.dirname, 'events.fs')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def summarize(self, event):
+        return ([(p.p4.px, p.p4.py, p.p4.pz, p.p4.mass, p.pdgID, p.charge, p.status)
+                 for p in event.particles_], event.metadata)
+
+    def test_pdg_charge(self):
+        self.assertEqual(pdg_charge(13), -1)
+        self.assertEqual(pdg_charge(-24), -1)
+        self.assertAlmostEqual(pdg_charge(-2), -2./3)
+        self.assertEqual(pdg_charge(1000022), 0)
+
+    def test_convert(self):
+        expected = [self.summarize(LHE_event_to_pyhep(e))
+                    for e in LHE.LHEventReader(self.lhe_filename).events()]
+        self.assertEqual(expected[0][0][2][4:], (11, -1, 1))
+        self.assertEqual(expected[0][1], {'comment': '#comment 1', 'idprup': 1})
+        progress = []
+        ec = convert_from_LHE(self.lhe_filename, self.filename, processes=2, chunk_size=1,
+                              on_progress=progress.append, progress_seconds=0.)
+        self.assertEqual([self.summarize(e) for e in ec.events()], expected)
+        ec.close()
+        self.assertEqual(progress[-1].events, 3)
+        self.assertTrue(progress[-1].peak_output_queue <= 4)
+
+    def test_convert_to_columnar(self):
+        dirname = os.path.join(self.dirname, 'columns')
+        ec = convert_LHE_to_columnar(self.lhe_filename, dirname, batch_size=2, processes=1)
+        # same as going through GenEvents
+        expected = ColumnarEventCollection(os.path.join(self.dirname, 'expected'))
+        expected.add_events(LHE_event_to_pyhep(e) for e in LHE.LHEventReader(self.lhe_filename).events())
+        expected.save()
+        for name in ['px', 'py', 'pz', 'm', 'pdgID', 'charge', 'status']:
+            self.assertEqual(list(ec.column(name)), list(expected.column(name)))
+        self.assertEqual(list(ec.offsets), [0, 4, 7, 9])
+        self.assertEqual(list(ec.event_column('idprup')), [1, 2, 1])
+        self.assertEqual(list(ec.event_column('xwgtup')), [5e-4, 6e-4, 7e-4])
+        self.assertEqual(list(ec.event_column('comment')), ['#comment 1', '#comment 2', ''])
+        ec.close()
+        expected.close()
+        # compressed files are parsed in this process
+        with open(self.lhe_filename + '.gz', 'wb') as f:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+            f.write(compressor.compress(LHE_SAMPLE) + compressor.flush())
+        ec = convert_LHE_to_columnar(self.lhe_filename + '.gz', dirname, processes=2)
+        self.assertEqual(len(ec), 6)
+        self.assertEqual(list(ec.event_column('idprup')), [1, 2, 1]*2)
+        ec.close()
+
+    def test_worker_killed(self):
+        start = LHE_SAMPLE.index('\n<event>')+1
+        end = LHE_SAMPLE.index('</LesHouchesEvents')
+        with open(self.lhe_filename, 'wb') as f:
+            f.write(LHE_SAMPLE[:start] + LHE_SAMPLE[start:end]*1000 + LHE_SAMPLE[end:])
+
+        def kill_workers(stats):
+            for process in multiprocessing.active_children():
+                process.terminate()
+        # without the end markers of the killed processes, this used to hang
+        self.assertRaises(RuntimeError, convert_from_LHE, self.lhe_filename, self.filename,
+                          processes=2, chunk_size=1, queue_size=1, on_progress=kill_workers,
+                          progress_seconds=0.)
+
+    def test_error(self):
+        with open(self.lhe_filename, 'wb') as f:
+            f.write(LHE_SAMPLE.replace('+3.0000000000e+01', 'thirty'))
+        self.assertRaises(Exception, convert_from_LHE, self.lhe_filename, self.filename,
+                          processes=2, chunk_size=1)
+
+
+class TestEventCollection(unittest.TestCase):
+    """Tests for EventCollection class"""
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, 'events.fs')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def make_event(self, i):
+        return make_event(i)
+
+    def test_add_events(self):
+        ec = EventCollection(self.filename)
+        ec.add_event(self.make_event(0))
+        ec.add_events(self.make_event(i) for i in range(1, 5))
+        self.assertEqual(len(ec), 5)
+        ec.save()
+        ec.close()
+        ec = EventCollection(self.filename)
+        self.assertEqual(len(ec), 5)
+        self.assertEqual([e.metadata['idprup'] for e in ec.events()], range(5))
+        ec.add_event(self.make_event(5))
+        self.assertEqual(list(ec.store.keys()), range(6))
+        ec.save()
+        ec.close()
+
+    def test_inline_particles(self):
+        ec = EventCollection(self.filename, inline_particles=True)
+        ec.add_events(self.make_event(i) for i in range(5))
+        ec.save()
+        # one record per event, plus the root, BTree, counter, and the
+        # summary index and its one block
+        self.assertEqual(len(ec.storage), 5+5)
+        ec.close()
+        ec = EventCollection(self.filename)
+        events = list(ec.events())
+        self.assertEqual([e.particles()[0].p4.px for e in events], range(5))
+        self.assertTrue(isinstance(events[0].particles()[0], GenParticle))
+        self.assertEqual(events[0].particles()[0].status, 1)
+        ec.close()
+
+    def test_bounded_memory_iteration(self):
+        ec = EventCollection(self.filename)
+        ec.add_events(self.make_event(i) for i in range(50))
+        ec.save()
+        ec.close()
+        ec = EventCollection(self.filename, cache_size=10)
+        self.assertEqual(ec.cache_size, 10)
+        previous = None
+        for event in ec.events(ghost=True):
+            event.particles()[0].p4.px
+            if previous is not None:
+                self.assertEqual(previous._p_state, -1)
+            previous = event
+        ec.close()
+        ec = EventCollection(self.filename, cache_size=10)
+        for i, event in enumerate(ec.events(gc_interval=10)):
+            event.particles()[0].p4.px
+            # the cache is shrunk to 10 objects every 10 events (3 objects each)
+            self.assertTrue(ec.connection._cache.cache_non_ghost_count <= 10+3*10)
+        ec.close()
+
+    def test_commit_batching(self):
+        commits = []
+        ec = EventCollection(self.filename, commit_every=3,
+                             on_commit=lambda n, seconds: commits.append(n))
+        ec.add_events(self.make_event(i) for i in range(7))
+        self.assertEqual(commits, [3, 3])
+        ec.save()
+        self.assertEqual(commits, [3, 3, 1])
+        ec.close()
+
+    def test_background_writer(self):
+        commits = []
+        ec = EventCollection(self.filename, commit_every=3, background=True, queue_size=2,
+                             on_commit=lambda n, seconds: commits.append(n))
+        ec.add_events(self.make_event(i) for i in range(7))
+        ec.save()
+        self.assertEqual(commits, [3, 3, 1])
+        self.assertEqual(len(ec), 7)
+        ec.close()
+        ec = EventCollection(self.filename)
+        self.assertEqual([e.metadata['idprup'] for e in ec.events()], range(7))
+        self.assertEqual(list(ec.summary()['idprup']), range(7))
+        ec.close()
+
+    def test_select(self):
+        ec = EventCollection(self.filename)
+        ec.add_events(self.make_event(i) for i in range(2500))
+        ec.add_event(GenEvent([], {'idprup': -1}))
+        ec.save()
+        summary = ec.summary()
+        self.assertEqual(list(summary['key']), range(2501))
+        self.assertEqual(list(summary['n_electrons'][-2:]), [1, 0])
+        self.assertAlmostEqual(summary['met'][3], np.hypot(3, 20))
+        selected = [e.metadata['idprup'] for e in
+                    ec.select(lambda s: (s['idprup'] % 500 == 7) & (s['n_electrons'] == 1))]
+        self.assertEqual(selected, [7, 507, 1007, 1507, 2007])
+        self.assertEqual([e.metadata['idprup'] for e in ec.select(start=998, stop=1002)],
+                         range(998, 1002))
+        ec.close()
+
+    def test_custom_summaries(self):
+        ec = EventCollection(self.filename, summaries={})
+        ec.add_events(self.make_event(i) for i in range(3))
+        ec.save()
+        self.assertRaises(ValueError, ec.summary)
+        ec.close()
+        ec = EventCollection(self.filename, summaries={'px': event_px})
+        ec.build_summary()
+        self.assertEqual(list(ec.summary()['px']), [0, 1, 2])
+        self.assertEqual(len(list(ec.select(lambda s: s['px'] > 0))), 2)
+        ec.close()
+
+    def test_failing_summary(self):
+        def px_summary(event):
+            if event_px(event) == 1:
+                raise ValueError("no summary for this one")
+            return event_px(event)
+        ec = EventCollection(self.filename, summaries={'px': px_summary})
+        ec.add_event(self.make_event(0))
+        self.assertRaises(ValueError, ec.add_event, self.make_event(1))
+        ec.add_events(self.make_event(i) for i in range(2, 4))
+        ec.save()
+        self.assertEqual(len(ec), 3)
+        self.assertEqual(list(ec.summary()['px']), [0, 2, 3])
+        self.assertEqual([e.metadata['idprup'] for e in ec.select(lambda s: s['px'] > 0)], [2, 3])
+        ec.close()
+
+    def test_summary_not_a_number(self):
+        ec = EventCollection(self.filename, summaries={'a': lambda event: None, 'b': event_px})
+        self.assertRaises(ValueError, ec.add_event, self.make_event(0))
+        self.assertEqual(len(ec), 0)
+        ec.summaries = {'a': event_px, 'b': event_px}
+        ec.add_event(self.make_event(1))
+        summary = ec.summary()
+        self.assertEqual(list(summary['a']), [1])
+        self.assertEqual(list(summary['b']), [1])
+        ec.save()
+        ec.close()
+        block = SummaryBlock(0)
+        self.assertRaises(TypeError, block.append, 0, {'a': 1., 'b': None})
+        self.assertEqual((len(block), block.columns), (0, {}))
+
+    def test_old_layout_is_migrated(self):
+        from ZODB.FileStorage import FileStorage
+        from ZODB.DB import DB
+        import transaction
+        storage = FileStorage(self.filename)
+        connection = DB(storage).open()
+        root = connection.root()
+        for i in range(3):
+            root[i] = self.make_event(i)
+        transaction.commit()
+        connection.close()
+        storage.close()
+        ec = EventCollection(self.filename)
+        self.assertEqual(len(ec), 3)
+        self.assertEqual([e.metadata['idprup'] for e in ec.events()], range(3))
+        # the migrated collection has no summary index yet, which doesn't
+        # stop events from being added
+        ec.add_event(self.make_event(3))
+        self.assertEqual(len(ec), 4)
+        self.assertRaises(ValueError, list, ec.select())
+        ec.build_summary()
+        self.assertEqual([e.metadata['idprup'] for e in ec.select()], range(4))
+        ec.close()
+
+    def test_read_only(self):
+        ec = EventCollection(self.filename)
+        ec.add_events(self.make_event(i) for i in range(5))
+        ec.save()
+        ec.close()
+        ec = EventCollection(self.filename, read_only=True)
+        self.assertEqual([e.metadata['idprup'] for e in ec.events(start=1, stop=3)], [1, 2])
+        ec.close()
+
+
+class TestColumnarEventCollection(unittest.TestCase):
+    """Tests for ColumnarEventCollection class"""
+
+    def setUp(self):
+        self.dirname = os.path.join(tempfile.mkdtemp(), 'events')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.dirname))
+
+    def test_round_trip(self):
+        ec = ColumnarEventCollection(self.dirname, commit_every=3)
+        ec.add_events(make_event(i) for i in range(5))
+        ec.add_event(GenEvent([], {'idprup': 5}))
+        self.assertEqual(len(ec), 6)
+        ec.save()
+        ec.close()
+        ec = ColumnarEventCollection(self.dirname, read_only=True)
+        self.assertEqual(len(ec), 6)
+        self.assertEqual(list(ec.column('px')), range(5))
+        self.assertEqual(list(ec.offsets), [0, 1, 2, 3, 4, 5, 5])
+        events = list(ec.events(batch_size=4))
+        self.assertEqual([e.metadata['idprup'] for e in events], range(6))
+        self.assertTrue(isinstance(events[0].particles()[0], GenParticle))
+        self.assertEqual([len(e.particles()) for e in events], [1, 1, 1, 1, 1, 0])
+        self.assertTrue(events[2].particles()[0].p4.almost_equal(make_event(2).particles()[0].p4))
+        self.assertRaises(ValueError, ec.add_event, make_event(6))
+        ec.close()
+
+    def test_batches(self):
+        ec = ColumnarEventCollection(self.dirname)
+        ec.add_events(make_event(i) for i in range(5))
+        ec.save()
+        batches = list(ec.batches(2, start=1))
+        self.assertEqual([len(b) for b in batches], [2, 2])
+        self.assertEqual(list(batches[1].px), [3, 4])
+        self.assertEqual(list(batches[1].offsets), [0, 1, 2])
+        self.assertEqual(list(ec.batches(2, metadata=False))[0].metadata, [{}, {}])
+        ec.close()
+
+    def test_metadata_columns(self):
+        ec = ColumnarEventCollection(self.dirname)
+        ec.add_event(GenEvent([], {'idprup': 1}))
+        ec.save()
+        ec.add_event(GenEvent([], {'idprup': 2, 'xwgtup': 0.5, 'comment': u'caf\xe9'}))
+        ec.add_event(GenEvent([], {'idprup': 3, 'comment': 'plain'}))
+        ec.save()
+        self.assertEqual(list(ec.event_column('idprup')), [1, 2, 3])
+        self.assertTrue(np.isnan(ec.event_column('xwgtup')[0]))
+        self.assertEqual(list(ec.event_column('comment')), ['', 'caf\xc3\xa9', 'plain'])
+        self.assertRaises(ValueError, ec.add_event, GenEvent([], {'idprup': 1.5, 'new': 1}))
+        ec.add_event(GenEvent([make_event(4).particles()[0]], {'idprup': 4, 'new': 2}))
+        ec.save()
+        self.assertEqual(list(ec.event_column('idprup')), [1, 2, 3, 4])
+        self.assertEqual(list(ec.event_column('new')), [0, 0, 0, 2])
+        self.assertEqual(list(ec.column('px')), [4])
+        ec.close()
+
+    def test_event_columns(self):
+        ec = ColumnarEventCollection(self.dirname)
+        batch = EventBatch.from_events([make_event(i) for i in range(3)])
+        ec.add_batch(batch, {'idprup': np.array([4, 5, 6]), 'comment': ['a', 'b', 'c']})
+        ec.add_event(GenEvent([], {'idprup': 7, 'xwgtup': 1.5}))
+        self.assertRaises(ValueError, ec.add_batch, batch, {'idprup': [1]})
+        ec.save()
+        self.assertEqual(list(ec.event_column('idprup')), [4, 5, 6, 7])
+        self.assertEqual(list(ec.event_column('comment')), ['a', 'b', 'c', ''])
+        self.assertTrue(np.isnan(ec.event_column('xwgtup')[:3]).all())
+        self.assertRaises(ValueError, ec.add_batch, batch, {'idprup': np.array([0.5, 1, 2])})
+        self.assertRaises(ValueError, ec.add_batch, batch, {'comment': np.array([1, 2, 3])})
+        ec.close()
+
+    def test_bad_event_keeps_pending_events(self):
+        ec = ColumnarEventCollection(self.dirname, commit_every=6)
+        ec.add_events(make_event(i) for i in range(3))
+        # the type of a column is set by the first pending event that has it
+        ec.add_event(GenEvent([], {'idprup': 3, 'comment': 'x'}))
+        self.assertRaises(ValueError, ec.add_event, GenEvent([], {'idprup': 4, 'comment': 4}))
+        self.assertRaises(ValueError, ec.add_event, Event([], {'idprup': 4}))
+        ec.add_event(make_event(4))
+        ec.add_event(make_event(5))
+        self.assertEqual(list(ec.event_column('idprup')), range(6))
+        self.assertEqual(list(ec.event_column('comment')), ['', '', '', 'x', '', ''])
+        ec.close()
+
+    def test_unsaved_data_is_dropped(self):
+        ec = ColumnarEventCollection(self.dirname)
+        ec.add_events(make_event(i) for i in range(3))
+        ec.save()
+        ec.close()
+        # simulate a crash part-way through appending a column
+        with open(os.path.join(self.dirname, 'px.bin'), 'ab') as f:
+            f.write('garbage!')
+        ec = ColumnarEventCollection(self.dirname)
+        ec.add_event(make_event(3))
+        ec.save()
+        self.assertEqual(list(ec.column('px')), range(4))
+        ec.close()
+
+
+class TestEventBatch(unittest.TestCase):
+    """Tests for EventBatch class"""
+
+    def setUp(self):
+        def particle(x, pdgID, charge, status):
+            return GenParticle(FourMomentum.from_x_y_z_m(x, 2*x, 3*x, 1.), pdgID, charge, status)
+        self.events = [
+            GenEvent([particle(1, 11, -1, 1), particle(2, -11, 1, 1), particle(3, 12, 0, 1)],
+                     {'idprup': 0}),
+            GenEvent([], {'idprup': 1}),
+            GenEvent([particle(4, 13, -1, 1), particle(5, 23, 0, 3), particle(6, -14, 0, 1)],
+                     {'idprup': 2}),
+        ]
+        self.batch = EventBatch.from_events(self.events)
+
+    def test_round_trip(self):
+        events = self.batch.to_events()
+        self.assertEqual(len(events), 3)
+        self.assertTrue(isinstance(events[0], GenEvent))
+        for event, original in zip(events, self.events):
+            self.assertEqual(event.metadata, original.metadata)
+            self.assertEqual([(p.pdgID, p.charge, p.status) for p in event.particles()],
+                             [(p.pdgID, p.charge, p.status) for p in original.particles()])
+            for p, q in zip(event.particles(), original.particles()):
+                self.assertTrue(p.p4.almost_equal(q.p4))
+
+    def test_selection(self):
+        self.assertEqual(list(self.batch.electrons().counts), [2, 0, 0])
+        self.assertEqual(list(self.batch.electrons().charge), [-1, 1])
+        self.assertEqual(list(self.batch.muons().counts), [0, 0, 1])
+        self.assertEqual(list(self.batch.with_status(3).pdgID), [23])
+        self.assertEqual(list(self.batch.with_status(1).electrons().px), [1, 2])
+
+    def test_pair_matrices(self):
+        for matrices, name in [(self.batch.delta_r_matrices(), 'delta_r_matrix'),
+                               (self.batch.mass_matrices(), 'mass_matrix')]:
+            self.assertEqual([m.shape for m in matrices], [(3, 3), (0, 0), (3, 3)])
+            for matrix, event in zip(matrices, self.events):
+                p4s = FourMomentumArray.from_list([p.p4 for p in event.particles()])
+                if len(p4s):
+                    self.assertTrue(np.allclose(matrix, getattr(p4s, name)()))
+
+    def test_met(self):
+        met = self.batch.met()
+        for event, px, py, energy in zip(self.events, met.px, met.py, met.energy):
+            expected = event.met()
+            self.assertAlmostEqual(px, expected.px)
+            self.assertAlmostEqual(py, expected.py)
+            self.assertAlmostEqual(energy, expected.energy)
+        self.assertEqual(list(met.px), [-3, 0, -4])
+
+
+class TestCandidates(unittest.TestCase):
+    """Tests for combinations and Candidates"""
+
+    def setUp(self):
+        import random
+        random.seed(3)
+        self.events = []
+        for i in range(50):
+            particles = []
+            for j in range(random.randint(0, 6)):
+                p4 = FourMomentum.from_x_y_z_m(random.uniform(-50, 50), random.uniform(-50, 50),
+                                               random.uniform(-50, 50), 0.1)
+                particles.append(Particle(p4, random.choice([11, -11, 13, -13]),
+                                          random.choice([-1, 1])))
+            self.events.append(Event(particles))
+        self.batch = EventBatch.from_events(self.events)
+
+    def expected(self, k, accept=lambda ps: True):
+        """Candidates built with itertools, as (event, particle indices) tuples"""
+        import itertools
+        result = []
+        for i, event in enumerate(self.events):
+            start = self.batch.offsets[i]
+            for combo in itertools.combinations(range(len(event.particles())), k):
+                if accept([event.particles()[j] for j in combo]):
+                    result.append((i, tuple(start+j for j in combo)))
+        return result
+
+    def found(self, candidates):
+        return zip(candidates.event_index.tolist(), map(tuple, candidates.indices.tolist()))
+
+    def test_all_combinations(self):
+        for k in (1, 2, 3):
+            self.assertEqual(self.found(combinations(self.batch, k)), self.expected(k))
+
+    def test_constraints(self):
+        def ossf(ps):
+            return ps[0].charge+ps[1].charge == 0 and abs(ps[0].pdgID) == abs(ps[1].pdgID)
+        pairs = combinations(self.batch, 2, total_charge=0, same_flavour=True)
+        self.assertEqual(self.found(pairs), self.expected(2, ossf))
+        for i, (event, (a, b)) in enumerate(self.found(pairs)):
+            p4 = self.events[event].particles()[a-self.batch.offsets[event]].p4 + \
+                self.events[event].particles()[b-self.batch.offsets[event]].p4
+            self.assertAlmostEqual(pairs.mass[i], p4.mass)
+
+    def test_pdgID_filter(self):
+        muons = combinations(self.batch, 2, pdgIDs=[13])
+        self.assertTrue(np.all(np.abs(muons.batch.pdgID[muons.indices]) == 13))
+        self.assertEqual(muons.counts.sum(),
+                         sum(n*(n-1)//2 for n in self.batch.muons().counts))
+
+    def test_best(self):
+        pairs = combinations(self.batch, 2)
+        best = pairs.closest_to_mass(91.19)
+        self.assertEqual(list(best.counts), list(np.minimum(pairs.counts, 1)))
+        for event, mass in zip(best.event_index, best.mass):
+            masses = pairs.mass[pairs.event_index == event]
+            self.assertAlmostEqual(mass, masses[np.argmin(np.abs(masses-91.19))])
+
+    def test_single_event(self):
+        event = max(self.events, key=lambda e: len(e.particles()))
+        n = len(event.particles())
+        self.assertEqual(len(combinations(event, 2)), n*(n-1)//2)
+
+
+class TestMatching(unittest.TestCase):
+    """Tests for the matching functions"""
+
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        counts_a = rng.poisson(8, 40)
+        counts_b = rng.poisson(8, 40)
+        self.a = self.random_batch(rng, counts_a)
+        self.b = self.random_batch(rng, counts_b)
+
+    def random_batch(self, rng, counts):
+        n = counts.sum()
+        p4 = FourMomentumArray.from_pt_eta_phi_m(rng.uniform(10, 50, n), rng.uniform(-2.5, 2.5, n),
+                                                 rng.uniform(-np.pi, np.pi, n), np.zeros(n))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return EventBatch(p4.px, p4.py, p4.pz, p4.mass, np.full(n, 11), np.ones(n), offsets)
+
+    def brute_force(self, max_dr):
+        pairs = []
+        for event in range(len(self.a)):
+            for i in range(self.a.offsets[event], self.a.offsets[event+1]):
+                for j in range(self.b.offsets[event], self.b.offsets[event+1]):
+                    dr = self.a.p4[i].delta_r(self.b.p4[j])
+                    if dr <= max_dr:
+                        pairs.append((i, j, dr))
+        return pairs
+
+    def test_match_all(self):
+        for max_dr in (0.4, 1.0, 4.0):
+            ia, ib, dr = match_all(self.a, self.b, max_dr)
+            expected = self.brute_force(max_dr)
+            self.assertEqual(sorted(zip(ia, ib)), sorted((i, j) for i, j, d in expected))
+            for i, j, d in zip(ia, ib, dr):
+                self.assertAlmostEqual(d, self.a.p4[i].delta_r(self.b.p4[j]))
+
+    def test_phi_wraparound(self):
+        a = FourMomentumArray.from_pt_eta_phi_m([10], [0], [np.pi-0.01], [0])
+        b = FourMomentumArray.from_pt_eta_phi_m([10], [0], [-np.pi+0.01], [0])
+        index, dr = match_nearest(a, b, 0.1)
+        self.assertEqual(list(index), [0])
+        self.assertAlmostEqual(dr[0], 0.02)
+
+    def test_nearest_and_unique(self):
+        pairs = self.brute_force(0.5)
+        index, dr = match_nearest(self.a, self.b, 0.5)
+        for i in range(self.a.n_particles):
+            candidates = [(d, j) for k, j, d in pairs if k == i]
+            self.assertEqual(index[i], min(candidates)[1] if candidates else -1)
+        # greedy one-to-one assignment, done the slow way
+        index, dr = match_unique(self.a, self.b, 0.5)
+        expected = -np.ones(self.a.n_particles, dtype=int)
+        used = set()
+        for i, j, d in sorted(pairs, key=lambda p: (p[2], p[0], p[1])):
+            if expected[i] == -1 and j not in used:
+                expected[i] = j
+                used.add(j)
+        self.assertEqual(list(index), list(expected))
+
+    def test_remove_overlaps(self):
+        cleaned = remove_overlaps(self.a, self.b, 0.4)
+        overlapping = set(i for i, j, d in self.brute_force(0.4))
+        self.assertEqual(cleaned.n_particles, self.a.n_particles-len(overlapping))
+        self.assertEqual(len(match_all(cleaned, self.b, 0.4)[0]), 0)
+
+
+class TestJets(unittest.TestCase):
+    """Tests for jet clustering"""
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        n = 60
+        self.p4s = FourMomentumArray.from_pt_eta_phi_m(rng.exponential(10, n), rng.uniform(-3, 3, n),
+                                                       rng.uniform(-np.pi, np.pi, n), rng.uniform(0, 1, n))
+
+    def naive_cluster(self, p4s, R, p):
+        """Look at every pair at every step"""
+        pseudojets = [(p4, [i]) for i, p4 in enumerate(p4s)]
+        jets = []
+
+        def rapidity(p4):
+            return 0.5*np.log((p4.energy+p4.pz)/(p4.energy-p4.pz))
+        while pseudojets:
+            best = None
+            for a, (pa, ca) in enumerate(pseudojets):
+                if best is None or pa.pt**(2*p) < best[0]:
+                    best = (pa.pt**(2*p), a, None)
+                for b in range(a+1, len(pseudojets)):
+                    pb = pseudojets[b][0]
+                    dr2 = (rapidity(pa)-rapidity(pb))**2 + pa.delta_phi(pb)**2
+                    dij = min(pa.pt**(2*p), pb.pt**(2*p))*dr2/R**2
+                    if dij < best[0]:
+                        best = (dij, a, b)
+            dist, a, b = best
+            if b is None:
+                jets.append(pseudojets.pop(a))
+            else:
+                pb, cb = pseudojets.pop(b)
+                pa, ca = pseudojets[a]
+                pseudojets[a] = (pa+pb, ca+cb)
+        return sorted((round(p4.pt, 6), sorted(indices)) for p4, indices in jets)
+
+    def test_against_naive(self):
+        for algorithm, p in [('antikt', -1), ('kt', 1), ('cambridge_aachen', 0)]:
+            jets = cluster(self.p4s, R=0.6, algorithm=algorithm)
+            self.assertEqual(sorted((round(jet.p4.pt, 6), jet.constituents) for jet in jets),
+                             self.naive_cluster(self.p4s, 0.6, p))
+            self.assertEqual(sorted(i for jet in jets for i in jet.constituents), range(len(self.p4s)))
+
+    def test_particles(self):
+        particles = [Particle(p4, 211, (-1)**i) for i, p4 in enumerate(self.p4s)]
+        jets = cluster(particles, R=0.4, ptmin=5.)
+        self.assertEqual([jet.p4 for jet in jets], [jet.p4 for jet in cluster(self.p4s, R=0.4, ptmin=5.)])
+        self.assertTrue(all(jet.p4.pt > 5. for jet in jets))
+        self.assertEqual(jets, sorted(jets, key=lambda jet: -jet.p4.pt))
+        for jet in jets:
+            self.assertEqual(jet.charge, sum((-1)**i for i in jet.constituents))
+            self.assertTrue(jet.p4.almost_equal(FourMomentum.sum(particles[i].p4 for i in jet.constituents)))
+
+    def test_edge_cases(self):
+        self.assertEqual(cluster([]), [])
+        self.assertRaises(ValueError, cluster, self.p4s, 0.4, 'siscone')
+        # two particles on opposite sides of phi = pi are close
+        p4s = FourMomentumArray.from_pt_eta_phi_m([10, 20], [0, 0], [np.pi-0.05, -np.pi+0.05], [0, 0])
+        self.assertEqual([jet.constituents for jet in cluster(p4s, R=0.4)], [[0, 1]])
+
+
+class TestHistogram(unittest.TestCase):
+    """Tests for Hist1D and Hist2D"""
+
+    def test_fill(self):
+        h = Hist1D([0, 1, 10, 100])
+        h.fill(np.array([-5, 0, 0.5, 1, 50, 100, np.nan]))
+        h.fill(3)
+        self.assertEqual(list(h.sumw_with_flow), [1, 2, 2, 1, 2])
+        self.assertEqual(h.entries, 8)
+        self.assertEqual(h.integral(), 5)
+        self.assertEqual(h.integral(flow=True), 8)
+
+    def test_weights(self):
+        h = Hist1D(2, 0, 2)
+        h.fill([0.5, 0.5, 1.5])
+        h.fill([0.5, 1.5], weight=[2, 0.5])
+        self.assertEqual(list(h.values), [4, 1.5])
+        self.assertEqual(list(h.sumw2), [6, 1.25])
+
+    def test_merge(self):
+        a = Hist2D(2, [0, 1, 3], xlow=0, xhigh=2)
+        b = Hist2D(2, [0, 1, 3], xlow=0, xhigh=2)
+        a.fill([0.5, 1.5], [0.5, 2])
+        b.fill([0.5], [0.5], weight=2)
+        c = sum([a, b])
+        self.assertEqual(c.values.tolist(), [[3, 0], [0, 1]])
+        self.assertEqual(c.sumw2.tolist(), [[5, 0], [0, 1]])
+        self.assertEqual(a.values.tolist(), [[1, 0], [0, 1]])
+        self.assertRaises(ValueError, lambda: a + Hist2D(2, 2, 0, 2, 0, 3))
+
+    def test_pickle(self):
+        import cPickle
+        h = Hist1D(1000, 0, 100)
+        h.fill(np.random.uniform(0, 100, 10000))
+        copy = cPickle.loads(cPickle.dumps(h, cPickle.HIGHEST_PROTOCOL))
+        self.assertTrue(np.array_equal(copy.values, h.values))
+        self.assertEqual(copy.axis, h.axis)
+        self.assertEqual(copy.entries, h.entries)
+
+
+class TestMapReduce(unittest.TestCase):
+    """Tests for map_reduce"""
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, 'events.fs')
+        ec = EventCollection(self.filename)
+        ec.add_events(make_event(i) for i in range(23))
+        ec.save()
+        ec.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_map_reduce(self):
+        for processes in (1, 2):
+            result = map_reduce(self.filename, event_idprup, processes=processes)
+            self.assertEqual(result, range(23))
+
+    def test_values_not_modified(self):
+        # results are added in place, but not to the values func returns or to initial
+        initial = [1]
+        result = map_reduce(self.filename, shared_list, initial=initial, processes=1)
+        self.assertEqual(result, [1] + [0]*23)
+        self.assertEqual(SHARED_LIST, [0])
+        self.assertEqual(initial, [1])
+
+    def test_batches(self):
+        result = map_reduce(self.filename, batch_px_sum, processes=2, batch_size=4)
+        self.assertEqual(result, sum(range(23)))
+
+    def test_histogram(self):
+        h = map_reduce(self.filename, event_px_hist, processes=2)
+        self.assertEqual(list(h.values), [5, 5, 5, 5, 3])
+
+    def test_empty_collection(self):
+        filename = os.path.join(self.dirname, 'empty.fs')
+        EventCollection(filename).close()
+        self.assertEqual(map_reduce(filename, event_idprup, initial=[]), [])
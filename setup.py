@@ -7,6 +7,6 @@ setup(name='pyHEP',
       description='Python for High Energy Physics',
       author='Nic Eggert',
       author_email='nse23@cornell.edu',
-      install_requires=['ZODB3'],
+      install_requires=['ZODB3', 'numpy'],
       packages=['pyhep']
       )